@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Body, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import httpx
 import asyncio
@@ -10,91 +10,1566 @@ import time
 import os
 import uuid
 import hashlib
-from typing import Optional, Dict, Any, Set
-from collections import defaultdict
+import json
+import fcntl
+import sqlite3
+import threading
+from typing import Optional, Dict, Any, List, Set, AsyncIterator, Awaitable, Callable
+from collections import defaultdict, deque
 import uvicorn
 import sys
 import random
-from contextlib import asynccontextmanager
-from bs4 import BeautifulSoup
+import shutil
+import mmap
+import struct
+import zipfile
+import zlib
+import bisect
+import contextvars
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from lxml import html as lxml_html
+from urllib.parse import urlsplit
 from datetime import datetime
-from curl_cffi import requests as curl_requests
 from curl_cffi.requests import AsyncSession
 
-DOWNLOADS_DIR = os.path.join(os.path.dirname(__file__), 'app_cache')
-os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
+DOWNLOADS_DIR = os.environ.get('APP_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'app_cache'))
+STORE_DIR = os.path.join(DOWNLOADS_DIR, 'objects')
+STORE_TMP_DIR = os.path.join(DOWNLOADS_DIR, 'tmp')
+STORE_SERVE_DIR = os.path.join(DOWNLOADS_DIR, 'serving')
+STORE_INDEX_PATH = os.path.join(DOWNLOADS_DIR, 'index.json')
+LOCKS_DIR = os.path.join(DOWNLOADS_DIR, 'locks')
+for directory in (STORE_DIR, STORE_TMP_DIR, STORE_SERVE_DIR, LOCKS_DIR):
+    os.makedirs(directory, exist_ok=True)
+
+# Upstream origins; overridden to point at a local stand-in for benchmarks.
+APKPURE_BASE_URL = os.environ.get('APKPURE_BASE_URL', 'https://apkpure.com').rstrip('/')
+APKPURE_DOWNLOAD_BASE_URL = os.environ.get('APKPURE_DOWNLOAD_BASE_URL', 'https://d.apkpure.com').rstrip('/')
 
 url_cache: Dict[str, tuple] = {}
 URL_CACHE_TTL = 1800
+NEGATIVE_CACHE_TTL = int(os.environ.get('NEGATIVE_CACHE_TTL', 60))
+
+resolution_inflight: Dict[str, asyncio.Future] = {}
+resolution_failures: Dict[str, tuple] = {}
+
+# The REFRESH_TOP_N most requested packages are re-resolved in the background
+# when their url_cache entry is within REFRESH_AHEAD seconds of expiring.
+REFRESH_TOP_N = int(os.environ.get('REFRESH_TOP_N', 50))
+REFRESH_AHEAD = int(os.environ.get('REFRESH_AHEAD', 300))
+REFRESH_INTERVAL = 60
+POPULARITY_DECAY = 0.9
+package_popularity: Dict[str, float] = defaultdict(float)
+
+# url_cache and the file index are backed by a SQLite database shared by every
+# worker process on the host, so restarts and extra workers start warm. Entries up to STALE_MAX_AGE past
+# their TTL are still served while a background refresh runs. Each thread has
+# its own connection; writes issued on the event loop are handed to a single
+# writer thread so a busy database never stalls requests.
+SHARED_DB_PATH = os.path.join(DOWNLOADS_DIR, 'shared.db')
+SLUG_CACHE_TTL = int(os.environ.get('SLUG_CACHE_TTL', 7 * 24 * 3600))
+STALE_MAX_AGE = int(os.environ.get('STALE_MAX_AGE', 6 * 3600))
+shared_db: Optional[sqlite3.Connection] = None
+shared_db_local = threading.local()
+shared_db_schema_lock = threading.Lock()
+shared_db_schema_ready = False
+db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shared-db-writer')
+
+# Persistent content-addressed file store. Blobs live in STORE_DIR named by
+# their SHA-256 and the "files" table maps "package:version" to a blob.
+# file_cache is this process's mirror of that table.
+STORE_MAX_BYTES = int(os.environ.get('STORE_MAX_BYTES', 20 * 1024 * 1024 * 1024))
+# A stored file is served for FILE_CACHE_TTL after it was last confirmed to
+# match upstream. The revalidator confirms files older than REVALIDATE_AFTER
+# with one conditional HEAD each, up to REVALIDATE_BATCH per REVALIDATE_INTERVAL,
+# and a re-resolution whose validator matches confirms the file for free.
+FILE_CACHE_TTL = int(os.environ.get('FILE_CACHE_TTL', 6 * 3600))
+REVALIDATE_AFTER = int(os.environ.get('REVALIDATE_AFTER', 3600))
+REVALIDATE_INTERVAL = int(os.environ.get('REVALIDATE_INTERVAL', 300))
+REVALIDATE_BATCH = int(os.environ.get('REVALIDATE_BATCH', 50))
+STORE_LFU_WEIGHT = 600
+PARTIAL_MAX_AGE = int(os.environ.get('PARTIAL_MAX_AGE', 24 * 3600))
+
+SERVE_LINK_MAX_AGE = int(os.environ.get('SERVE_LINK_MAX_AGE', 6 * 3600))
+
+# Hot tier: blobs served at least HOT_TIER_MIN_HITS times (decayed per minute)
+# are copied into a tmpfs directory and served from RAM, so popular apps cost
+# no disk I/O. The directory is the index shared by all workers; a copy's mtime
+# is its last serve, and the least recently served copies are demoted to fit
+# HOT_TIER_BYTES, which is capped at half the tmpfs so a small /dev/shm (64 MB
+# in Docker) is not filled. HOT_TIER_BYTES=0 disables the tier. A blob whose
+# promotion fails or does not fit is not tried again for HOT_TIER_RETRY seconds.
+HOT_TIER_DIR = os.environ.get('HOT_TIER_DIR', '/dev/shm/apk-hot' if os.path.isdir('/dev/shm') else '')
+HOT_TIER_BYTES = int(os.environ.get('HOT_TIER_BYTES', 1024 * 1024 * 1024)) if HOT_TIER_DIR else 0
+HOT_TIER_MAX_FILE = int(os.environ.get('HOT_TIER_MAX_FILE', 256 * 1024 * 1024))
+HOT_TIER_MIN_HITS = float(os.environ.get('HOT_TIER_MIN_HITS', 3))
+HOT_TIER_IDLE = int(os.environ.get('HOT_TIER_IDLE', 1800))
+HOT_TIER_RETRY = 600
+HOT_SERVE_DIR = os.path.join(HOT_TIER_DIR, 'serving')
+HOT_TMP_DIR = os.path.join(HOT_TIER_DIR, 'tmp')
+if HOT_TIER_BYTES:
+    try:
+        for directory in (HOT_SERVE_DIR, HOT_TMP_DIR):
+            os.makedirs(directory, exist_ok=True)
+        fs = os.statvfs(HOT_TIER_DIR)
+        if HOT_TIER_BYTES > fs.f_blocks * fs.f_frsize // 2:
+            HOT_TIER_BYTES = fs.f_blocks * fs.f_frsize // 2
+            print(f"[Hot Tier] Budget capped at {HOT_TIER_BYTES / 1024 / 1024:.0f} MB, half of {HOT_TIER_DIR}", file=sys.stderr)
+    except OSError as e:
+        print(f"[Hot Tier] Disabled: {e}", file=sys.stderr)
+        HOT_TIER_BYTES = 0
+hot_scores: Dict[str, float] = defaultdict(float)
+hot_promotions: Set[str] = set()
+hot_backoff: Dict[str, float] = {}
+# Files and bytes in the tier as of the last scan, refreshed whenever
+# demote_hot runs, so /stats and /metrics need not walk the directory.
+hot_usage = {"files": 0, "bytes": 0}
 
 file_cache: Dict[str, Dict[str, Any]] = {}
+pending_access: Dict[str, tuple] = {}
+
+# Off-peak warm-up: inside PREFETCH_WINDOW (local hours "start-end") the top
+# PREFETCH_TOP_K packages are resolved and downloaded within the budgets below:
+# at most PREFETCH_MAX_BYTES per run, started no faster than PREFETCH_MAX_RATE
+# bytes per second on average. A package whose size upstream does not announce
+# is counted as PREFETCH_UNKNOWN_SIZE until its download finishes.
+DATABASE_URL = os.environ.get('DATABASE_URL')
+PREFETCH_WINDOW = os.environ.get('PREFETCH_WINDOW', '3-6')
+PREFETCH_TOP_K = int(os.environ.get('PREFETCH_TOP_K', 100))
+PREFETCH_LOOKBACK_DAYS = int(os.environ.get('PREFETCH_LOOKBACK_DAYS', 7))
+PREFETCH_CONCURRENCY = int(os.environ.get('PREFETCH_CONCURRENCY', 4))
+PREFETCH_MAX_BYTES = int(os.environ.get('PREFETCH_MAX_BYTES', 10 * 1024 * 1024 * 1024))
+PREFETCH_MAX_RATE = int(os.environ.get('PREFETCH_MAX_RATE', 20 * 1024 * 1024))
+PREFETCH_UNKNOWN_SIZE = int(os.environ.get('PREFETCH_UNKNOWN_SIZE', 100 * 1024 * 1024))
+prefetch_state: Dict[str, Any] = {"running": False}
+prefetched_keys: Set[str] = set()
+request_log_pending: Dict[str, int] = defaultdict(int)
+
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 16))
+BATCH_MAX_PACKAGES = int(os.environ.get('BATCH_MAX_PACKAGES', 100))
+
+# Download jobs: POST /jobs admits and starts a download in the background and
+# answers at once. Progress snapshots are mirrored to the jobs table of shared.db
+# so any worker can report them, and the finished file is served by job id.
+JOB_TTL = int(os.environ.get('JOB_TTL', 3600))
+JOB_PROGRESS_INTERVAL = 1.0
+JOB_MAX_WAIT = 60
+JOB_KEEPALIVE = 15
+JOB_FINAL_STAGES = ('done', 'failed')
+jobs: Dict[str, Dict[str, Any]] = {}
+
+# Download and resolution events are queued in memory and written in batches by
+# a background task, to the api_events table in Postgres when DATABASE_URL is
+# set and in shared.db otherwise. Past EVENT_QUEUE_MAX queued events, new ones
+# are folded into per-package counts so totals stay right while the database
+# is away; past EVENT_OVERFLOW_MAX distinct counts they are dropped. Events
+# written to shared.db are kept for EVENT_RETENTION_DAYS (0 keeps them forever).
+EVENT_QUEUE_MAX = int(os.environ.get('EVENT_QUEUE_MAX', 50000))
+EVENT_BATCH_SIZE = int(os.environ.get('EVENT_BATCH_SIZE', 500))
+EVENT_FLUSH_INTERVAL = float(os.environ.get('EVENT_FLUSH_INTERVAL', 2))
+EVENT_MAX_BACKOFF = 60
+EVENT_OVERFLOW_MAX = 10000
+EVENT_RETENTION_DAYS = float(os.environ.get('EVENT_RETENTION_DAYS', 30))
+event_queue: deque = deque()
+event_overflow: Dict[tuple, list] = {}
+event_flush_wakeup = asyncio.Event()
+event_sink_state: Dict[str, Any] = {"failing_since": None, "last_error": None}
+events_conn = None
+events_sqlite: Optional[sqlite3.Connection] = None
+
+API_WORKERS = int(os.environ.get('API_WORKERS', 1))
+WORKER_STATS_INTERVAL = 10
 
 download_locks: Dict[str, asyncio.Lock] = {}
 user_downloads: Dict[str, Set[str]] = defaultdict(set)
 
-pending_deletions: Dict[str, asyncio.Task] = {}
-
 http_client: Optional[httpx.AsyncClient] = None
 
+# One pooled curl-cffi session per impersonation profile, shared by the probe
+# and download paths so connections and TLS sessions are reused.
+CURL_IMPERSONATE_PROFILES = ["chrome110", "chrome116", "chrome120", "chrome124"]
+CURL_MAX_CLIENTS = int(os.environ.get('CURL_MAX_CLIENTS', 200))
+curl_sessions: Dict[str, AsyncSession] = {}
+
 stats = {
     "total_requests": 0,
     "cache_hits": 0,
     "downloads": 0,
     "active_downloads": 0,
-    "cached_files": 0
+    "cached_files": 0,
+    "file_cache_hits": 0,
+    "evictions": 0,
+    "streamed_responses": 0,
+    "coalesced_resolutions": 0,
+    "negative_cache_hits": 0,
+    "resumed_downloads": 0,
+    "persistent_cache_hits": 0,
+    "stale_hits": 0,
+    "open_file_refs": 0,
+    "proactive_refreshes": 0,
+    "file_requests": 0,
+    "prefetch_hits": 0,
+    "prefetch_runs": 0,
+    "batch_requests": 0,
+    "queued_downloads": 0,
+    "admission_rejections": 0,
+    "breaker_stale_hits": 0,
+    "not_modified": 0,
+    "invalid_downloads": 0,
+    "jobs_created": 0,
+    "jobs_completed": 0,
+    "jobs_failed": 0,
+    "hot_tier_hits": 0,
+    "disk_tier_hits": 0,
+    "hot_tier_promotions": 0,
+    "hot_tier_demotions": 0,
+    "revalidations": 0,
+    "revalidated_unchanged": 0,
+    "revalidated_changed": 0,
+    "revalidation_errors": 0,
+    "free_revalidations": 0,
+    "events_written": 0,
+    "events_aggregated": 0,
+    "events_dropped": 0,
+    "event_flush_failures": 0
+}
+
+# In-memory histograms exported by /metrics in Prometheus text format. Each
+# series keeps per-bucket counts, so observe() is a bisect and two additions.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+THROUGHPUT_BUCKETS = (1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8)
+HISTOGRAMS = {
+    "apk_http_request_seconds": ("Time from request to the last response byte", LATENCY_BUCKETS),
+    "apk_resolution_seconds": ("Upstream resolution of a package's download URL", LATENCY_BUCKETS),
+    "apk_stage_seconds": ("Time spent in one stage of resolution or download", LATENCY_BUCKETS),
+    "apk_probe_seconds": ("HEAD probe with one impersonation profile", LATENCY_BUCKETS),
+    "apk_queue_wait_seconds": ("Wait for a download slot or an executor thread", LATENCY_BUCKETS),
+    "apk_download_throughput_bytes_per_second": ("Average speed of completed downloads", THROUGHPUT_BUCKETS),
 }
+histograms: Dict[str, Dict[tuple, Dict[str, Any]]] = defaultdict(dict)
+download_bytes_total: Dict[str, int] = defaultdict(int)
+
+def observe(name: str, value: float, **labels):
+    buckets = HISTOGRAMS[name][1]
+    key = tuple(sorted(labels.items()))
+    series = histograms[name].get(key)
+    if series is None:
+        series = histograms[name][key] = {'counts': [0] * (len(buckets) + 1), 'sum': 0.0}
+    series['counts'][bisect.bisect_left(buckets, value)] += 1
+    series['sum'] += value
+
+@contextmanager
+def timed(name: str, **labels):
+    """Observe the wall time of a block, including awaits inside it"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+async def in_executor(func: Callable, *args) -> Any:
+    """run_in_executor that also records how long the call queued for a thread"""
+    submitted = time.perf_counter()
+    
+    def run():
+        observe("apk_queue_wait_seconds", time.perf_counter() - submitted, queue="executor")
+        return func(*args)
+    
+    return await asyncio.get_event_loop().run_in_executor(None, run)
 
 def get_client() -> httpx.AsyncClient:
     if http_client is None:
         raise RuntimeError("HTTP client not initialized")
     return http_client
 
+def get_curl_session(impersonate: str) -> AsyncSession:
+    session = curl_sessions.get(impersonate)
+    if session is None:
+        session = AsyncSession(impersonate=impersonate, max_clients=CURL_MAX_CLIENTS)
+        curl_sessions[impersonate] = session
+    return session
+
+async def close_curl_sessions():
+    for session in curl_sessions.values():
+        try:
+            await session.close()
+        except Exception as e:
+            print(f"[curl-cffi] Failed to close session: {e}", file=sys.stderr)
+    curl_sessions.clear()
+
+# Impersonation profiles are raced: the historically best one starts first and
+# the next is launched after an adaptive delay or as soon as one fails.
+BLOCKED_STATUSES = {403, 429, 503}
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 0.25))
+HEDGE_MAX_DELAY = float(os.environ.get('HEDGE_MAX_DELAY', 5.0))
+profile_stats: Dict[str, Dict[str, Any]] = {
+    profile: {"successes": 0, "failures": 0, "latency_ewma": None} for profile in CURL_IMPERSONATE_PROFILES
+}
+
+def ranked_profiles() -> list:
+    def score(profile: str):
+        entry = profile_stats[profile]
+        # Laplace-smoothed success rate, then lower latency wins ties.
+        success_rate = (entry["successes"] + 1) / (entry["successes"] + entry["failures"] + 2)
+        latency = entry["latency_ewma"] if entry["latency_ewma"] is not None else HEDGE_MAX_DELAY
+        return (-round(success_rate, 2), latency)
+    return sorted(CURL_IMPERSONATE_PROFILES, key=score)
+
+def record_profile_result(profile: str, success: bool, latency: float):
+    entry = profile_stats[profile]
+    if success:
+        entry["successes"] += 1
+        previous = entry["latency_ewma"]
+        entry["latency_ewma"] = latency if previous is None else 0.8 * previous + 0.2 * latency
+    else:
+        entry["failures"] += 1
+
+def hedge_delay() -> float:
+    latency = profile_stats[ranked_profiles()[0]]["latency_ewma"]
+    if latency is None:
+        return 1.0
+    return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, latency * 1.5))
+
+async def hedged_race(attempt: Callable[[str], Awaitable[Any]], label: str, discard: Optional[Callable[[Any], Awaitable[None]]] = None) -> Any:
+    """Run attempt(profile) over the ranked profiles with hedging and return the first
+    truthy result. An attempt returning False ends the race with no result; None or
+    an exception means that profile failed and the next one starts immediately.
+    When the host's gate turns an attempt away, no further profiles start but those
+    already in flight may still win. Results that lose the race are passed to
+    discard for cleanup."""
+    profiles = ranked_profiles()
+    pending: Dict[asyncio.Task, str] = {}
+    winner = None
+    outcomes = {'hosts': {}, 'settled': False}
+    token = race_outcomes.set(outcomes)
+    
+    async def timed_attempt(profile: str) -> Any:
+        started = time.time()
+        try:
+            result = await attempt(profile)
+        except asyncio.CancelledError:
+            raise
+        except UpstreamUnavailable as e:
+            print(f"[Hedge] {label}: {e}", file=sys.stderr)
+            profiles.clear()
+            return None
+        except Exception as e:
+            print(f"[Hedge] {label} with {profile} failed: {e}", file=sys.stderr)
+            result = None
+        record_profile_result(profile, result is not None, time.time() - started)
+        return result
+    
+    try:
+        while profiles or pending:
+            if profiles:
+                profile = profiles.pop(0)
+                pending[asyncio.create_task(timed_attempt(profile))] = profile
+            done, _ = await asyncio.wait(pending, timeout=hedge_delay() if profiles else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                pending.pop(task)
+                result = task.result()
+                if winner is None and result is False:
+                    return None
+                if winner is None and result:
+                    winner = result
+                elif result and discard:
+                    await discard(result)
+            if winner is not None:
+                return winner
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if result and not isinstance(result, BaseException) and discard:
+                await discard(result)
+        race_outcomes.reset(token)
+        settle_race(outcomes)
+
+# Every upstream request passes through its host's gate: an AIMD token bucket
+# (rate grows by UPSTREAM_RATE_STEP per success and halves on 403/429/503) and
+# a circuit breaker that opens after BREAKER_THRESHOLD consecutive failures,
+# fast-failing calls for a cooldown that doubles while the host stays unhealthy.
+APKPURE_PROBE_HOST = urlsplit(APKPURE_DOWNLOAD_BASE_URL).netloc
+UPSTREAM_RATE = float(os.environ.get('UPSTREAM_RATE', 10))
+UPSTREAM_MIN_RATE = float(os.environ.get('UPSTREAM_MIN_RATE', 0.5))
+UPSTREAM_MAX_RATE = float(os.environ.get('UPSTREAM_MAX_RATE', 50))
+UPSTREAM_RATE_STEP = float(os.environ.get('UPSTREAM_RATE_STEP', 0.5))
+UPSTREAM_MAX_WAIT = float(os.environ.get('UPSTREAM_MAX_WAIT', 5))
+BREAKER_THRESHOLD = int(os.environ.get('BREAKER_THRESHOLD', 5))
+BREAKER_COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', 30))
+BREAKER_MAX_COOLDOWN = float(os.environ.get('BREAKER_MAX_COOLDOWN', 600))
+upstream_hosts: Dict[str, Dict[str, Any]] = {}
+# Requests made by the profiles of one hedged race are fed back as a single
+# outcome per host when the race ends, so a block aimed at one impersonation
+# profile does not halve the rate or trip the breaker while another profile works.
+race_outcomes: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar('race_outcomes', default=None)
+
+class UpstreamUnavailable(RuntimeError):
+    """Raised instead of contacting a host whose breaker is open or whose rate
+    limit would make the caller wait longer than UPSTREAM_MAX_WAIT"""
+    def __init__(self, host: str, retry_after: float):
+        super().__init__(f"{host} unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+def upstream_gate(host: str) -> Dict[str, Any]:
+    gate = upstream_hosts.get(host)
+    if gate is None:
+        gate = upstream_hosts[host] = {
+            'state': 'closed', 'rate': UPSTREAM_RATE, 'tokens': UPSTREAM_RATE, 'updated': time.monotonic(),
+            'failures': 0, 'cooldown': BREAKER_COOLDOWN, 'opened_at': 0.0, 'probing': False,
+            'successes': 0, 'throttled': 0, 'errors': 0, 'rejected': 0
+        }
+    return gate
+
+def http_error(e: Exception) -> HTTPException:
+    if isinstance(e, UpstreamUnavailable):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after + 0.5))})
+    return HTTPException(status_code=500, detail=str(e))
+
+def upstream_is_open(host: str) -> bool:
+    gate = upstream_hosts.get(host)
+    return gate is not None and gate['state'] == 'open' and time.monotonic() - gate['opened_at'] < gate['cooldown']
+
+def upstream_retry_after(host: str) -> float:
+    """Seconds until the host's breaker lets a trial request through, 0 if closed"""
+    gate = upstream_hosts.get(host)
+    if gate is None or gate['state'] == 'closed':
+        return 0.0
+    return max(1.0, gate['opened_at'] + gate['cooldown'] - time.monotonic())
+
+async def acquire_upstream(host: str) -> Dict[str, Any]:
+    gate = upstream_gate(host)
+    now = time.monotonic()
+    if gate['state'] == 'open' and now - gate['opened_at'] >= gate['cooldown']:
+        gate['state'] = 'half_open'
+    if gate['state'] == 'open' or (gate['state'] == 'half_open' and gate['probing']):
+        gate['rejected'] += 1
+        raise UpstreamUnavailable(host, upstream_retry_after(host))
+    if gate['state'] == 'half_open':
+        gate['probing'] = True
+    
+    tokens = min(max(1.0, gate['rate']), gate['tokens'] + (now - gate['updated']) * gate['rate'])
+    wait = (1 - tokens) / gate['rate'] if tokens < 1 else 0.0
+    if wait > UPSTREAM_MAX_WAIT:
+        gate['probing'] = False
+        gate['rejected'] += 1
+        raise UpstreamUnavailable(host, wait)
+    # Reserve the token now so concurrent callers queue behind each other.
+    gate['tokens'] = tokens - 1
+    gate['updated'] = now
+    if wait:
+        await asyncio.sleep(wait)
+    return gate
+
+def record_upstream(gate: Dict[str, Any], host: str, status: Optional[int]):
+    """Feed one outcome back: status None means a transport error or timeout"""
+    gate['probing'] = False
+    if status is not None and status not in BLOCKED_STATUSES and status < 500:
+        gate['successes'] += 1
+        gate['failures'] = 0
+        gate['rate'] = min(UPSTREAM_MAX_RATE, gate['rate'] + UPSTREAM_RATE_STEP)
+        if gate['state'] != 'closed':
+            print(f"[Breaker] {host} recovered", file=sys.stderr)
+            gate['state'] = 'closed'
+            gate['cooldown'] = BREAKER_COOLDOWN
+        return
+    
+    if status in BLOCKED_STATUSES:
+        gate['throttled'] += 1
+        gate['rate'] = max(UPSTREAM_MIN_RATE, gate['rate'] / 2)
+    else:
+        gate['errors'] += 1
+    gate['failures'] += 1
+    if gate['state'] == 'half_open':
+        gate['cooldown'] = min(BREAKER_MAX_COOLDOWN, gate['cooldown'] * 2)
+    if gate['state'] == 'half_open' or gate['failures'] >= BREAKER_THRESHOLD:
+        if gate['state'] != 'open':
+            print(f"[Breaker] {host} open for {gate['cooldown']:.0f}s after {gate['failures']} failures", file=sys.stderr)
+        gate['state'] = 'open'
+        gate['opened_at'] = time.monotonic()
+
+def report_upstream(gate: Dict[str, Any], host: str, status: Optional[int]):
+    """record_upstream, or hold the outcome back for the hedged race this request belongs to"""
+    outcomes = race_outcomes.get()
+    if outcomes is None or outcomes['settled']:
+        record_upstream(gate, host, status)
+        return
+    gate['probing'] = False
+    outcomes['hosts'].setdefault(host, (gate, []))[1].append(status)
+
+def settle_race(outcomes: Dict[str, Any]):
+    """Record one outcome per host for a finished race: a success if any profile
+    got through, otherwise its block (which throttles) or last error"""
+    outcomes['settled'] = True
+    for host, (gate, statuses) in outcomes['hosts'].items():
+        succeeded = [status for status in statuses
+                     if status is not None and status not in BLOCKED_STATUSES and status < 500]
+        blocked = [status for status in statuses if status in BLOCKED_STATUSES]
+        record_upstream(gate, host, (succeeded or blocked or statuses)[-1])
+
+async def upstream_request(url: str, send: Callable[[], Awaitable[Any]]) -> Any:
+    """Run send() (one HTTP request to url) under the host's rate limit and breaker"""
+    host = urlsplit(url).netloc
+    gate = await acquire_upstream(host)
+    try:
+        response = await send()
+    except asyncio.CancelledError:
+        # Hedging losers are cancelled on purpose and say nothing about the host.
+        gate['probing'] = False
+        raise
+    except Exception:
+        report_upstream(gate, host, None)
+        raise
+    report_upstream(gate, host, getattr(response, 'status_code', None))
+    return response
+
+def upstream_state() -> Dict[str, Any]:
+    return {
+        host: {
+            "state": gate['state'],
+            "rate": round(gate['rate'], 2),
+            "retry_after": round(upstream_retry_after(host), 1),
+            **{key: gate[key] for key in ('failures', 'successes', 'throttled', 'errors', 'rejected')}
+        }
+        for host, gate in upstream_hosts.items()
+    }
+
 def get_download_lock(package_name: str) -> asyncio.Lock:
     if package_name not in download_locks:
         download_locks[package_name] = asyncio.Lock()
     return download_locks[package_name]
 
 def generate_user_file_id(package_name: str, user_id: Optional[str] = None) -> str:
-    unique_id = user_id or str(uuid.uuid4())[:8]
+    unique_id = f"{user_id}-{uuid.uuid4().hex[:8]}" if user_id else str(uuid.uuid4())[:8]
     return f"{package_name}_{unique_id}_{int(time.time())}"
 
-async def schedule_file_deletion(file_path: str, delay: int = 30):
-    await asyncio.sleep(delay)
+def get_shared_db() -> Optional[sqlite3.Connection]:
+    """This thread's connection to shared.db; the first one creates the schema.
+    shared_db is the event loop's connection, closed at shutdown."""
+    global shared_db, shared_db_schema_ready
+    db = getattr(shared_db_local, 'db', None)
+    if db is None:
+        try:
+            db = sqlite3.connect(SHARED_DB_PATH, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            with shared_db_schema_lock:
+                if not shared_db_schema_ready:
+                    create_shared_schema(db)
+                    shared_db_schema_ready = True
+        except Exception as e:
+            print(f"[SharedDB] Disabled: {e}", file=sys.stderr)
+            return None
+        shared_db_local.db = db
+        if threading.current_thread() is threading.main_thread():
+            shared_db = db
+    return db
+
+def create_shared_schema(db: sqlite3.Connection):
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS slugs (
+            package_name TEXT PRIMARY KEY,
+            slug TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS resolutions (
+            package_name TEXT PRIMARY KEY,
+            info TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS resolution_failures (
+            package_name TEXT PRIMARY KEY,
+            error TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            key TEXT PRIMARY KEY,
+            package_name TEXT NOT NULL,
+            version TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            version_code INTEGER,
+            version_name TEXT,
+            source_url TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            validated_at REAL,
+            superseded_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_files_sha256 ON files(sha256);
+        CREATE TABLE IF NOT EXISTS package_requests (
+            package_name TEXT NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (package_name, day)
+        );
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS worker_stats (
+            pid INTEGER PRIMARY KEY,
+            stats TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS api_events (
+            id INTEGER PRIMARY KEY,
+            event_type TEXT NOT NULL,
+            package_name TEXT NOT NULL,
+            version TEXT,
+            user_id TEXT,
+            outcome TEXT NOT NULL,
+            file_type TEXT,
+            file_size INTEGER,
+            duration_ms INTEGER,
+            count INTEGER NOT NULL DEFAULT 1,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_api_events_package ON api_events(package_name, created_at);
+        CREATE INDEX IF NOT EXISTS idx_api_events_date ON api_events(created_at);
+    """)
+    # Columns added after the files table first shipped.
+    existing = {row[1] for row in db.execute("PRAGMA table_info(files)")}
+    for column, column_type in (('version_code', 'INTEGER'), ('version_name', 'TEXT'), ('source_url', 'TEXT'),
+                                ('etag', 'TEXT'), ('last_modified', 'TEXT'), ('validated_at', 'REAL'),
+                                ('superseded_at', 'REAL')):
+        if column not in existing:
+            db.execute(f"ALTER TABLE files ADD COLUMN {column} {column_type}")
+
+def db_query(sql: str, params: tuple = ()) -> Optional[tuple]:
+    db = get_shared_db()
+    if db is None:
+        return None
     try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            print(f"[Cleanup] Deleted: {os.path.basename(file_path)}", file=sys.stderr)
-            
-            for pkg, info in list(file_cache.items()):
-                if info.get('file_path') == file_path:
-                    del file_cache[pkg]
-                    stats["cached_files"] = max(0, stats["cached_files"] - 1)
-                    break
+        return db.execute(sql, params).fetchone()
+    except Exception as e:
+        print(f"[SharedDB] {e}", file=sys.stderr)
+        return None
+
+def db_query_all(sql: str, params: tuple = ()) -> list:
+    db = get_shared_db()
+    if db is None:
+        return []
+    try:
+        return db.execute(sql, params).fetchall()
+    except Exception as e:
+        print(f"[SharedDB] {e}", file=sys.stderr)
+        return []
+
+def on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+def run_db_write(sql: str, rows: list):
+    """Apply one statement per parameter row, all in one transaction"""
+    db = get_shared_db()
+    if db is None:
+        return
+    try:
+        if len(rows) == 1:
+            db.execute(sql, rows[0])
+            return
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(sql, rows)
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
     except Exception as e:
-        print(f"[Cleanup Error] {file_path}: {e}", file=sys.stderr)
+        print(f"[SharedDB] {e}", file=sys.stderr)
+
+def db_execute_many(sql: str, rows: list):
+    """Write to shared.db. On the event loop the write is queued to the writer
+    thread, in order, and this returns at once; elsewhere it runs in place."""
+    if not rows:
+        return
+    if on_event_loop():
+        try:
+            db_writer.submit(run_db_write, sql, rows)
+            return
+        except RuntimeError:
+            pass  # Writer already shut down.
+    run_db_write(sql, rows)
+
+def db_execute(sql: str, params: tuple = ()):
+    db_execute_many(sql, [params])
+
+async def settle_db_writes():
+    """Wait for every write queued so far, for reads that must see them"""
+    await asyncio.wrap_future(db_writer.submit(lambda: None))
+
+def load_persisted_resolution(package_name: str) -> Optional[tuple]:
+    row = db_query("SELECT info, updated_at FROM resolutions WHERE package_name = ?", (package_name,))
+    if row is None:
+        return None
+    return json.loads(row[0]), row[1]
+
+def persist_resolution(package_name: str, result: Dict[str, Any], timestamp: float):
+    db_execute("INSERT OR REPLACE INTO resolutions (package_name, info, updated_at) VALUES (?, ?, ?)",
+               (package_name, json.dumps(result), timestamp))
+
+def forget_resolution(package_name: str, version: Optional[str]):
+    """Drop the cached and persisted resolution if it still names this version,
+    leaving a newer one alone"""
+    cached = url_cache.get(package_name)
+    if cached and (cached[0].get('version') or 'latest') == (version or 'latest'):
+        url_cache.pop(package_name, None)
+    persisted = load_persisted_resolution(package_name)
+    if persisted and (persisted[0].get('version') or 'latest') == (version or 'latest'):
+        db_execute("DELETE FROM resolutions WHERE package_name = ?", (package_name,))
+
+def load_persisted_failure(package_name: str) -> Optional[tuple]:
+    return db_query("SELECT error, updated_at FROM resolution_failures WHERE package_name = ?", (package_name,))
+
+def persist_failure(package_name: str, error: Optional[str], timestamp: float):
+    if error is None:
+        db_execute("DELETE FROM resolution_failures WHERE package_name = ?", (package_name,))
+    else:
+        db_execute("INSERT OR REPLACE INTO resolution_failures (package_name, error, updated_at) VALUES (?, ?, ?)",
+                   (package_name, error, timestamp))
+
+def load_persisted_slug(package_name: str) -> Optional[str]:
+    row = db_query("SELECT slug, updated_at FROM slugs WHERE package_name = ?", (package_name,))
+    if row is None or time.time() - row[1] > SLUG_CACHE_TTL:
+        return None
+    return row[0]
+
+def persist_slug(package_name: str, slug: str):
+    db_execute("INSERT OR REPLACE INTO slugs (package_name, slug, updated_at) VALUES (?, ?, ?)",
+               (package_name, slug, time.time()))
+
+def store_key(package_name: str, version: Optional[str] = None) -> str:
+    return f"{package_name}:{version or 'latest'}"
+
+def blob_path(sha256: str, file_type: str) -> str:
+    return os.path.join(STORE_DIR, f"{sha256}.{file_type}")
+
+# Post-download verification. SHA-256 is computed over a read-only mapping of
+# the file, without copying it through Python buffers, and zipfile then reads
+# only the central directory and manifest, so a truncated or corrupt archive is
+# rejected before it reaches the store.
+ANDROID_VERSION_CODE_ATTR = 0x0101021b
+ANDROID_VERSION_NAME_ATTR = 0x0101021c
+
+class InvalidPackage(ValueError):
+    pass
+
+def axml_strings(data: bytes, offset: int) -> list:
+    """Decode a binary XML string pool chunk"""
+    header_size, = struct.unpack_from('<H', data, offset + 2)
+    count, _, flags, strings_start = struct.unpack_from('<IIII', data, offset + 8)
+    utf8 = flags & 0x100
+    strings = []
+    for i in range(count):
+        position = offset + strings_start + struct.unpack_from('<I', data, offset + header_size + i * 4)[0]
+        if utf8:
+            # Character count, then byte count, each one or two bytes long.
+            for _ in range(2):
+                length = data[position]
+                position += 1
+                if length & 0x80:
+                    length = ((length & 0x7f) << 8) | data[position]
+                    position += 1
+            strings.append(data[position:position + length].decode('utf-8', 'replace'))
+        else:
+            length, = struct.unpack_from('<H', data, position)
+            position += 2
+            if length & 0x8000:
+                length = ((length & 0x7fff) << 16) | struct.unpack_from('<H', data, position)[0]
+                position += 2
+            strings.append(data[position:position + length * 2].decode('utf-16-le', 'replace'))
+    return strings
+
+def parse_axml_manifest(data: bytes) -> Dict[str, Any]:
+    """versionCode and versionName from the <manifest> element of a compiled
+    AndroidManifest.xml"""
+    strings, resource_ids = [], []
+    offset = struct.unpack_from('<H', data, 2)[0]
+    while offset + 8 <= len(data):
+        chunk_type, header_size, chunk_size = struct.unpack_from('<HHI', data, offset)
+        if chunk_size < 8:
+            break
+        if chunk_type == 0x0001:
+            strings = axml_strings(data, offset)
+        elif chunk_type == 0x0180:
+            resource_ids = list(struct.unpack_from(f'<{(chunk_size - header_size) // 4}I', data, offset + header_size))
+        elif chunk_type == 0x0102:
+            name_index, attr_start, attr_size, attr_count = struct.unpack_from('<4xIHHH', data, offset + header_size)
+            if strings[name_index] != 'manifest':
+                break
+            metadata = {}
+            for i in range(attr_count):
+                attr = offset + header_size + attr_start + i * attr_size
+                name, raw_value, value_type, value = struct.unpack_from('<4xII3xBI', data, attr)
+                resource_id = resource_ids[name] if name < len(resource_ids) else None
+                if resource_id == ANDROID_VERSION_CODE_ATTR or strings[name] == 'versionCode':
+                    metadata['version_code'] = value
+                elif resource_id == ANDROID_VERSION_NAME_ATTR or strings[name] == 'versionName':
+                    if value_type == 0x03:
+                        metadata['version_name'] = strings[value]
+                    elif raw_value != 0xffffffff:
+                        metadata['version_name'] = strings[raw_value]
+                elif strings[name] == 'package':
+                    metadata['manifest_package'] = strings[raw_value]
+            return metadata
+        offset += chunk_size
+    return {}
+
+def inspect_apk(archive: zipfile.ZipFile) -> Dict[str, Any]:
+    manifest = archive.read('AndroidManifest.xml')
+    try:
+        return parse_axml_manifest(manifest)
+    except (struct.error, IndexError) as e:
+        print(f"[Verify] Unreadable AndroidManifest.xml: {e}", file=sys.stderr)
+        return {}
+
+def inspect_xapk(archive: zipfile.ZipFile) -> Dict[str, Any]:
+    try:
+        manifest = json.loads(archive.read('manifest.json'))
+    except ValueError as e:
+        raise InvalidPackage(f"XAPK manifest.json is not valid JSON: {e}")
+    
+    names = set(archive.namelist())
+    listed = [split.get('file') for split in manifest.get('split_apks', [])]
+    listed += [expansion.get('file') for expansion in manifest.get('expansions', [])]
+    missing = [name for name in listed if name and name not in names]
+    if missing:
+        raise InvalidPackage(f"XAPK is missing {', '.join(missing)}")
+    if not any(name.endswith('.apk') for name in names):
+        raise InvalidPackage("XAPK contains no APK")
+    
+    metadata = {'manifest_package': manifest.get('package_name'), 'version_name': manifest.get('version_name')}
+    if str(manifest.get('version_code', '')).isdigit():
+        metadata['version_code'] = int(manifest['version_code'])
+    return metadata
+
+def inspect_package(file_path: str) -> Dict[str, Any]:
+    """Hash and validate a finished download in one mapping of the file. The
+    type is taken from the content, since APKPure's APK links may serve XAPKs.
+    Raises InvalidPackage for anything that is not a complete APK/XAPK archive."""
+    size = os.path.getsize(file_path)
+    if size == 0:
+        raise InvalidPackage("empty file")
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        digest = hashlib.sha256()
+        view = memoryview(mapped)
+        try:
+            for start in range(0, size, 8 * 1024 * 1024):
+                digest.update(view[start:start + 8 * 1024 * 1024])
+        finally:
+            view.release()
+        
+        try:
+            with zipfile.ZipFile(f) as archive:
+                # Every member must lie inside the file; a truncated body fails here.
+                for info in archive.infolist():
+                    if info.header_offset + info.compress_size > size:
+                        raise InvalidPackage(f"{info.filename} extends past end of file")
+                names = archive.namelist()
+                if 'AndroidManifest.xml' in names:
+                    metadata = {'file_type': 'apk', **inspect_apk(archive)}
+                elif 'manifest.json' in names:
+                    metadata = {'file_type': 'xapk', **inspect_xapk(archive)}
+                else:
+                    raise InvalidPackage("archive is neither an APK nor an XAPK")
+        except (zipfile.BadZipFile, zlib.error) as e:
+            raise InvalidPackage(f"not a valid ZIP archive: {e}")
+    
+    return {'sha256': digest.hexdigest(), 'size': size, **metadata}
+
+FILE_COLUMNS = ('key', 'package_name', 'version', 'sha256', 'file_path', 'file_type', 'size', 'created_at', 'last_access', 'hits',
+                'version_code', 'version_name', 'source_url', 'etag', 'last_modified', 'validated_at')
+
+def row_to_entry(row: tuple) -> Dict[str, Any]:
+    return dict(zip(FILE_COLUMNS[1:], row[1:]))
+
+@contextmanager
+def store_lock():
+    """Serialise index and blob mutations across worker processes"""
+    fd = os.open(os.path.join(LOCKS_DIR, 'store.lock'), os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+@asynccontextmanager
+async def cross_process_lock(name: str):
+    """Per-package lock shared by all workers, polled so the event loop never blocks"""
+    path = os.path.join(LOCKS_DIR, re.sub(r'[^\w.-]', '_', name) + '.lock')
+    fd = os.open(path, os.O_CREAT | os.O_RDWR)
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(0.2)
+        yield
+    finally:
+        os.close(fd)
+
+def flush_store_access():
+    """Write accumulated hit counts and access times to the shared index in one
+    transaction. Safe off the loop: each key is taken out before it is written."""
+    rows = []
+    for key in list(pending_access):
+        taken = pending_access.pop(key, None)
+        if taken:
+            rows.append((*taken, key))
+    db_execute_many("UPDATE files SET hits = hits + ?, last_access = MAX(last_access, ?) WHERE key = ?", rows)
+
+def import_legacy_index():
+    """One-time import of the index.json written by single-process versions"""
+    try:
+        with open(STORE_INDEX_PATH) as f:
+            entries = json.load(f).get("entries", {})
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print(f"[Store] Ignoring corrupt legacy index: {e}", file=sys.stderr)
+        entries = {}
+    
+    for key, entry in entries.items():
+        db_execute(f"INSERT OR IGNORE INTO files ({', '.join(FILE_COLUMNS)}) VALUES ({', '.join('?' * len(FILE_COLUMNS))})",
+                   (key, *(entry.get(column) for column in FILE_COLUMNS[1:])))
+    os.remove(STORE_INDEX_PATH)
+    print(f"[Store] Imported {len(entries)} entries from legacy index", file=sys.stderr)
+
+def load_store_index():
+    """Rebuild the file_cache mirror from the shared index, dropping entries whose blob is gone"""
+    with store_lock():
+        import_legacy_index()
+        
+        file_cache.clear()
+        for row in db_query_all(f"SELECT {', '.join(FILE_COLUMNS)} FROM files"):
+            entry = row_to_entry(row)
+            if os.path.exists(entry['file_path']):
+                file_cache[row[0]] = entry
+            else:
+                db_execute("DELETE FROM files WHERE key = ?", (row[0],))
+        
+        # Blobs are renamed into place and indexed under the same lock, so anything
+        # unindexed here is an orphan; the age check only guards against clock skew.
+        referenced = {os.path.basename(e['file_path']) for e in file_cache.values()}
+        for filename in os.listdir(STORE_DIR):
+            file_path = os.path.join(STORE_DIR, filename)
+            if filename not in referenced and time.time() - os.path.getmtime(file_path) > 60:
+                try:
+                    os.remove(file_path)
+                    print(f"[Store] Removed orphan blob: {filename}", file=sys.stderr)
+                except OSError:
+                    pass
+        # Same for hot copies, which is why each store needs its own HOT_TIER_DIR.
+        for path, _, _, links in hot_tier_files():
+            if os.path.basename(path) not in referenced and links == 1:
+                os.remove(path)
+        demote_hot()
+    
+    stats["cached_files"] = len(file_cache)
+    print(f"[Store] Loaded {len(file_cache)} entries ({store_bytes() / 1024 / 1024:.2f} MB)", file=sys.stderr)
+
+def refresh_store_entry(key: str) -> Optional[Dict[str, Any]]:
+    """Re-read one entry from the shared index, since another worker may have changed it"""
+    row = db_query(f"SELECT {', '.join(FILE_COLUMNS)} FROM files WHERE key = ?", (key,))
+    if row is None:
+        file_cache.pop(key, None)
+        return None
+    file_cache[key] = row_to_entry(row)
+    return file_cache[key]
+
+def store_bytes() -> int:
+    row = db_query("SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM files GROUP BY sha256)")
+    return row[0] if row else sum({e['sha256']: e['size'] for e in file_cache.values()}.values())
+
+def store_count() -> int:
+    row = db_query("SELECT COUNT(*) FROM files")
+    return row[0] if row else len(file_cache)
+
+def is_pinned(file_path: str) -> bool:
+    """A blob is being served, by any worker, while it has serving hardlinks"""
+    try:
+        return os.stat(file_path).st_nlink > 1
+    except FileNotFoundError:
+        return False
+
+def acquire_file(entry: Dict[str, Any]) -> str:
+    """Hardlink the blob for one response so eviction can never remove the data
+    from under the reader; the link count doubles as a cross-process refcount.
+    The link points at the hot copy when there is one."""
+    link_name = f"{uuid.uuid4().hex}.{entry['file_type']}"
+    hot = hot_copy(entry)
+    try:
+        if hot is None:
+            raise FileNotFoundError
+        link_path = os.path.join(HOT_SERVE_DIR, link_name)
+        os.link(hot, link_path)
+        stats["hot_tier_hits"] += 1
+    except FileNotFoundError:
+        # No hot copy, or it was demoted a moment ago.
+        link_path = os.path.join(STORE_SERVE_DIR, link_name)
+        os.link(entry['file_path'], link_path)
+        stats["disk_tier_hits"] += 1
+    stats["open_file_refs"] += 1
+    return link_path
+
+def release_file(link_path: str):
+    stats["open_file_refs"] -= 1
+    try:
+        os.remove(link_path)
+    except FileNotFoundError:
+        pass
+
+def remove_store_entry(key: str):
+    """Drop an index entry and its blob unless another entry shares the content.
+    Callers hold store_lock."""
+    row = db_query(f"SELECT {', '.join(FILE_COLUMNS)} FROM files WHERE key = ?", (key,))
+    entry = row_to_entry(row) if row else file_cache.get(key)
+    file_cache.pop(key, None)
+    pending_access.pop(key, None)
+    prefetched_keys.discard(key)
+    if entry is None:
+        return
+    db_execute("DELETE FROM files WHERE key = ?", (key,))
+    stats["cached_files"] = len(file_cache)
+    if db_query("SELECT 1 FROM files WHERE sha256 = ?", (entry['sha256'],)):
+        return
+    drop_hot_copy(entry)
+    try:
+        os.remove(entry['file_path'])
+        print(f"[Store] Evicted: {key} ({entry['size'] / 1024 / 1024:.2f} MB)", file=sys.stderr)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"[Store] Failed to remove {entry['file_path']}: {e}", file=sys.stderr)
+
+def hot_path(entry: Dict[str, Any]) -> str:
+    return os.path.join(HOT_TIER_DIR, f"{entry['sha256']}.{entry['file_type']}")
+
+def hot_tier_files() -> list:
+    """(path, size, last serve, link count) of every hot copy"""
+    if not HOT_TIER_BYTES:
+        return []
+    files = []
+    for item in os.scandir(HOT_TIER_DIR):
+        if item.is_file():
+            st = item.stat()
+            files.append((item.path, st.st_size, st.st_mtime, st.st_nlink))
+    return files
+
+def hot_bytes() -> int:
+    return hot_usage["bytes"]
+
+def drop_hot_copy(entry: Dict[str, Any]):
+    if not HOT_TIER_BYTES:
+        return
+    try:
+        os.remove(hot_path(entry))
+    except FileNotFoundError:
+        return
+    hot_usage.update(files=max(0, hot_usage["files"] - 1), bytes=max(0, hot_usage["bytes"] - entry['size']))
+
+def hot_copy(entry: Dict[str, Any]) -> Optional[str]:
+    """Path of the blob's hot copy, marked as just served. Without one, count the
+    request and start a promotion once the blob is requested often enough."""
+    if not HOT_TIER_BYTES:
+        return None
+    path = hot_path(entry)
+    try:
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+    
+    sha256 = entry['sha256']
+    hot_scores[sha256] += 1
+    if (hot_scores[sha256] >= HOT_TIER_MIN_HITS and entry['size'] <= min(HOT_TIER_MAX_FILE, HOT_TIER_BYTES)
+            and sha256 not in hot_promotions and hot_backoff.get(sha256, 0) <= time.time()):
+        hot_promotions.add(sha256)
+        future = asyncio.get_event_loop().run_in_executor(None, promote_hot, dict(entry))
+        
+        def promoted(f: asyncio.Future):
+            hot_promotions.discard(sha256)
+            if f.exception() is not None:
+                print(f"[Hot Tier] Promotion of {entry['package_name']} failed: {f.exception()}", file=sys.stderr)
+            if f.exception() is not None or not f.result():
+                hot_scores.pop(sha256, None)
+                hot_backoff[sha256] = time.time() + HOT_TIER_RETRY
+        
+        future.add_done_callback(promoted)
+    return None
+
+def demote_hot(needed: int = 0) -> int:
+    """Drop hot copies idle for HOT_TIER_IDLE, then the least recently served
+    ones until needed more bytes fit. Copies being served are kept. Returns the
+    bytes left in the tier; callers hold store_lock."""
+    files = sorted(hot_tier_files(), key=lambda item: item[2])
+    total = sum(size for _, size, _, _ in files)
+    count = len(files)
+    now = time.time()
+    for path, size, last_served, links in files:
+        if total + needed <= HOT_TIER_BYTES and now - last_served < HOT_TIER_IDLE:
+            break
+        if links > 1:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        total -= size
+        count -= 1
+        stats["hot_tier_demotions"] += 1
+    hot_usage.update(files=count, bytes=total)
+    return total
+
+def hot_room(size: int) -> bool:
+    """Whether a copy of size bytes fits the budget, after demotions, and the
+    filesystem's free space; callers hold store_lock"""
+    if demote_hot(size) + size > HOT_TIER_BYTES:
+        return False
+    fs = os.statvfs(HOT_TIER_DIR)
+    return fs.f_bavail * fs.f_frsize >= size
+
+def promote_hot(entry: Dict[str, Any]) -> bool:
+    """Copy a blob into the hot tier if it fits the budget. Runs in the executor.
+    Returns False when the copy was rejected, so the caller can back off."""
+    # Room is checked before copying and again before the copy is published,
+    # since other workers may have promoted blobs in between.
+    with store_lock():
+        if os.path.exists(hot_path(entry)):
+            return True
+        if not os.path.exists(entry['file_path']) or not hot_room(entry['size']):
+            return False
+    tmp_path = os.path.join(HOT_TMP_DIR, f"{uuid.uuid4().hex}.{entry['file_type']}")
+    try:
+        shutil.copyfile(entry['file_path'], tmp_path)
+        with store_lock():
+            # The blob may have been evicted, or promoted by another worker, meanwhile.
+            if os.path.exists(hot_path(entry)):
+                return True
+            if not os.path.exists(entry['file_path']) or demote_hot(entry['size']) + entry['size'] > HOT_TIER_BYTES:
+                return False
+            os.replace(tmp_path, hot_path(entry))
+            hot_usage.update(files=hot_usage["files"] + 1, bytes=hot_usage["bytes"] + entry['size'])
+        stats["hot_tier_promotions"] += 1
+        print(f"[Hot Tier] Promoted {entry['package_name']} ({entry['size'] / 1024 / 1024:.2f} MB)", file=sys.stderr)
+        return True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def maintain_hot_tier():
+    """Demote idle copies, drop leftover links and copies, and decay request counts"""
+    if not HOT_TIER_BYTES:
+        return
+    with store_lock():
+        demote_hot()
+    now = time.time()
+    for directory, max_age in ((HOT_SERVE_DIR, SERVE_LINK_MAX_AGE), (HOT_TMP_DIR, 3600)):
+        for filename in os.listdir(directory):
+            file_path = os.path.join(directory, filename)
+            if now - os.path.getmtime(file_path) > max_age:
+                os.remove(file_path)
+    for sha256 in list(hot_scores):
+        hot_scores[sha256] *= POPULARITY_DECAY
+        if hot_scores[sha256] < 0.1:
+            del hot_scores[sha256]
+    for sha256, retry_at in list(hot_backoff.items()):
+        if retry_at <= now:
+            del hot_backoff[sha256]
+
+def evict_store(max_bytes: int = STORE_MAX_BYTES):
+    """Evict least valuable entries (recency plus a bonus per hit) until under budget.
+    Blobs being served by any worker are skipped."""
+    if store_bytes() <= max_bytes:
+        return
+    
+    flush_store_access()
+    with store_lock():
+        rows = db_query_all("SELECT key, sha256, size, last_access, hits, file_path FROM files")
+        blob_sizes = {row[1]: row[2] for row in rows}
+        total = sum(blob_sizes.values())
+        candidates = sorted(
+            (row for row in rows if not is_pinned(row[5])),
+            key=lambda row: row[3] + row[4] * STORE_LFU_WEIGHT
+        )
+        for key, sha256, size, _, _, _ in candidates:
+            if total <= max_bytes:
+                break
+            remove_store_entry(key)
+            stats["evictions"] += 1
+            if not db_query("SELECT 1 FROM files WHERE sha256 = ?", (sha256,)):
+                total -= blob_sizes.pop(sha256, 0)
+
+def discard_store_entry(key: str):
+    """Drop an entry whose blob has vanished. store_lock can block, so from the
+    event loop the removal runs in the executor."""
+    def remove():
+        try:
+            with store_lock():
+                remove_store_entry(key)
+        except Exception as e:
+            print(f"[Store] Failed to drop {key}: {e}", file=sys.stderr)
+    
+    if not on_event_loop():
+        remove()
+        return
+    file_cache.pop(key, None)
+    asyncio.get_running_loop().run_in_executor(None, remove)
+
+def validated_at(entry: Dict[str, Any]) -> float:
+    return entry.get('validated_at') or entry['created_at']
+
+def find_store_entry(key: str) -> Optional[Dict[str, Any]]:
+    """Return a fresh store entry without counting it as an access"""
+    entry = file_cache.get(key)
+    if entry is None or not os.path.exists(entry['file_path']):
+        entry = refresh_store_entry(key)
+    if entry is None:
+        return None
+    
+    if not os.path.exists(entry['file_path']):
+        discard_store_entry(key)
+        return None
+    
+    if time.time() - validated_at(entry) > FILE_CACHE_TTL:
+        # Another worker may have revalidated it since this mirror was loaded.
+        entry = refresh_store_entry(key)
+        if entry is None or time.time() - validated_at(entry) > FILE_CACHE_TTL:
+            return None
+    return entry
+
+def lookup_store(package_name: str, version: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    key = store_key(package_name, version)
+    entry = find_store_entry(key)
+    if entry is None:
+        return None
+    
+    now = time.time()
+    entry['last_access'] = now
+    entry['hits'] += 1
+    hits, _ = pending_access.get(key, (0, now))
+    pending_access[key] = (hits + 1, now)
+    return entry
+
+def latest_store_entry(package_name: str) -> Optional[Dict[str, Any]]:
+    """Best stored file for a package using only local state: the version of the
+    last known resolution if it is stored, otherwise the newest stored version"""
+    known = url_cache.get(package_name) or load_persisted_resolution(package_name)
+    if known:
+        entry = find_store_entry(store_key(package_name, known[0].get('version')))
+        if entry:
+            return entry
+    row = db_query("SELECT key FROM files WHERE package_name = ? ORDER BY created_at DESC LIMIT 1", (package_name,))
+    return find_store_entry(row[0]) if row else None
+
+def commit_to_store(package_name: str, version: Optional[str], file_type: str, tmp_path: str, sha256: str,
+                    metadata: Optional[Dict[str, Any]] = None, upstream: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Move a finished download into the store, deduplicating identical content.
+    metadata carries the version fields read from the package by inspect_package,
+    upstream the URL and validators (ETag, Last-Modified) it was fetched with.
+    Runs in the executor, since store_lock can block."""
+    metadata = metadata or {}
+    upstream = upstream or {}
+    final_path = blob_path(sha256, file_type)
+    now = time.time()
+    key = store_key(package_name, version)
+    
+    with store_lock():
+        if os.path.exists(final_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, final_path)
+        
+        previous = refresh_store_entry(key)
+        entry = {
+            'package_name': package_name,
+            'version': version or 'latest',
+            'sha256': sha256,
+            'file_path': final_path,
+            'file_type': file_type,
+            'size': os.path.getsize(final_path),
+            'created_at': now,
+            'last_access': now,
+            'hits': previous['hits'] if previous else 0,
+            'version_code': metadata.get('version_code'),
+            'version_name': metadata.get('version_name'),
+            'source_url': upstream.get('url'),
+            'etag': upstream.get('etag'),
+            'last_modified': upstream.get('last_modified'),
+            'validated_at': now
+        }
+        if previous and previous['sha256'] != sha256:
+            remove_store_entry(key)
+        db_execute(f"INSERT OR REPLACE INTO files ({', '.join(FILE_COLUMNS)}) VALUES ({', '.join('?' * len(FILE_COLUMNS))})",
+                   (key, *(entry[column] for column in FILE_COLUMNS[1:])))
+        file_cache[key] = entry
+    
+    stats["cached_files"] = store_count()
+    evict_store()
+    return entry
 
 def cleanup_old_files():
+    """Remove abandoned partial downloads and flush index access times. Runs in the executor."""
     try:
         now = time.time()
-        max_age = 300
+        max_age = PARTIAL_MAX_AGE
         
-        for filename in os.listdir(DOWNLOADS_DIR):
-            file_path = os.path.join(DOWNLOADS_DIR, filename)
+        for filename in os.listdir(STORE_TMP_DIR):
+            file_path = os.path.join(STORE_TMP_DIR, filename)
             if os.path.isfile(file_path):
                 file_age = now - os.path.getmtime(file_path)
                 if file_age > max_age:
                     os.remove(file_path)
-                    print(f"[Cleanup] Removed old file: {filename}", file=sys.stderr)
+                    print(f"[Cleanup] Removed stale partial: {filename}", file=sys.stderr)
+        
+        # Serving links belong to responses in any worker; only ones far older
+        # than any transfer could take are leftovers from a crash.
+        for filename in os.listdir(STORE_SERVE_DIR):
+            file_path = os.path.join(STORE_SERVE_DIR, filename)
+            if now - os.path.getmtime(file_path) > SERVE_LINK_MAX_AGE:
+                os.remove(file_path)
+        
+        flush_store_access()
+        evict_store()
+        maintain_hot_tier()
+        if prefetched_keys:
+            # Other workers evict too; forget prefetched files no longer stored.
+            stored = {row[0] for row in db_query_all("SELECT key FROM files")}
+            prefetched_keys.intersection_update(stored)
     except Exception as e:
         print(f"[Cleanup Error] {e}", file=sys.stderr)
 
 async def periodic_cleanup():
     while True:
         await asyncio.sleep(60)
-        cleanup_old_files()
+        await in_executor(cleanup_old_files)
+        await in_executor(prune_events)
+        expire_jobs()
+        prune_finish_tags()
+
+def publish_worker_stats():
+    db_execute("INSERT OR REPLACE INTO worker_stats (pid, stats, updated_at) VALUES (?, ?, ?)",
+               (os.getpid(), json.dumps(stats), time.time()))
+
+def cluster_stats() -> Dict[str, Any]:
+    """Sum the counters of every worker that reported recently"""
+    rows = db_query_all("SELECT stats FROM worker_stats WHERE updated_at > ?", (time.time() - 3 * WORKER_STATS_INTERVAL,))
+    totals: Dict[str, Any] = defaultdict(int)
+    for (worker_json,) in rows:
+        for name, value in json.loads(worker_json).items():
+            # cached_files describes the shared store, not the worker.
+            if isinstance(value, (int, float)) and name != "cached_files":
+                totals[name] += value
+    return {"workers": len(rows), **totals}
+
+def flush_request_log():
+    """Persist per-day request counts that feed the prefetch scheduler"""
+    day = datetime.now().strftime('%Y-%m-%d')
+    for package_name, count in list(request_log_pending.items()):
+        db_execute("INSERT INTO package_requests (package_name, day, count) VALUES (?, ?, ?) "
+                   "ON CONFLICT(package_name, day) DO UPDATE SET count = count + excluded.count",
+                   (package_name, day, count))
+    request_log_pending.clear()
+
+async def periodic_stats_sync():
+    while True:
+        publish_worker_stats()
+        flush_request_log()
+        await asyncio.sleep(WORKER_STATS_INTERVAL)
+
+EVENT_COLUMNS = ("created_at", "event_type", "package_name", "version", "user_id", "outcome",
+                 "file_type", "file_size", "duration_ms", "count")
+EVENTS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS api_events (
+        id BIGSERIAL PRIMARY KEY,
+        event_type VARCHAR(20) NOT NULL,
+        package_name VARCHAR(255) NOT NULL,
+        version VARCHAR(100),
+        user_id VARCHAR(100),
+        outcome VARCHAR(20) NOT NULL,
+        file_type VARCHAR(10),
+        file_size BIGINT,
+        duration_ms INTEGER,
+        count INTEGER NOT NULL DEFAULT 1,
+        created_at TIMESTAMP DEFAULT NOW()
+    );
+    CREATE INDEX IF NOT EXISTS idx_api_events_package ON api_events(package_name, created_at);
+    CREATE INDEX IF NOT EXISTS idx_api_events_date ON api_events(created_at);
+"""
+event_flush_lock = asyncio.Lock()
+
+def fold_event(row: tuple) -> bool:
+    """Merge an event into the per-package counts; False once those are full too.
+    A folded row keeps the total file_size of the events it counts."""
+    key = (row[1], row[2], row[5], row[6])
+    folded = event_overflow.get(key)
+    if folded is None:
+        if len(event_overflow) >= EVENT_OVERFLOW_MAX:
+            return False
+        folded = event_overflow[key] = [row[0], 0, 0]
+    folded[1] += row[9]
+    folded[2] += row[7] or 0
+    return True
+
+def record_event(event_type: str, package_name: str, outcome: str, user: Optional[str] = None,
+                 version: Optional[str] = None, file_type: Optional[str] = None, size: Optional[int] = None,
+                 duration: Optional[float] = None):
+    """Queue an event for the write-behind flusher. Never waits for the database."""
+    row = (time.time(), event_type, package_name, version, user, outcome, file_type, size,
+           None if duration is None else int(duration * 1000), 1)
+    if len(event_queue) < EVENT_QUEUE_MAX:
+        event_queue.append(row)
+        if len(event_queue) >= EVENT_BATCH_SIZE:
+            event_flush_wakeup.set()
+    elif fold_event(row):
+        stats["events_aggregated"] += 1
+    else:
+        stats["events_dropped"] += 1
+
+def take_event_batch() -> list:
+    batch = [event_queue.popleft() for _ in range(min(EVENT_BATCH_SIZE, len(event_queue)))]
+    for (event_type, package_name, outcome, file_type), (first_seen, count, size) in event_overflow.items():
+        batch.append((first_seen, event_type, package_name, None, None, outcome, file_type, size or None, None, count))
+    event_overflow.clear()
+    return batch
+
+def requeue_events(batch: list):
+    """Put a batch that failed to write back in front of newer events, folding
+    whatever no longer fits"""
+    for row in reversed(batch):
+        if row[9] == 1 and len(event_queue) < EVENT_QUEUE_MAX:
+            event_queue.appendleft(row)
+        elif not fold_event(row):
+            stats["events_dropped"] += row[9]
+
+def write_events_postgres(batch: list):
+    global events_conn
+    try:
+        if events_conn is None or events_conn.closed:
+            events_conn = psycopg2.connect(DATABASE_URL, connect_timeout=5)
+            with events_conn, events_conn.cursor() as cursor:
+                cursor.execute(EVENTS_TABLE_SQL)
+        with events_conn, events_conn.cursor() as cursor:
+            psycopg2.extras.execute_values(
+                cursor, f"INSERT INTO api_events ({', '.join(EVENT_COLUMNS)}) VALUES %s", batch,
+                template="(to_timestamp(%s), %s, %s, %s, %s, %s, %s, %s, %s, %s)", page_size=len(batch))
+    except Exception:
+        # Reconnect on the next flush rather than reuse a connection in an unknown state.
+        if events_conn is not None:
+            events_conn.close()
+            events_conn = None
+        raise
+
+def write_events_sqlite(batch: list):
+    """Runs in the executor on its own connection, so a busy shared.db never
+    holds up the event loop; flush_events serialises the calls"""
+    global events_sqlite
+    if events_sqlite is None:
+        events_sqlite = sqlite3.connect(SHARED_DB_PATH, timeout=5, isolation_level=None, check_same_thread=False)
+    events_sqlite.execute("BEGIN")
+    try:
+        events_sqlite.executemany(
+            f"INSERT INTO api_events ({', '.join(EVENT_COLUMNS)}) VALUES ({', '.join('?' * len(EVENT_COLUMNS))})", batch)
+        events_sqlite.execute("COMMIT")
+    except Exception:
+        if events_sqlite.in_transaction:
+            events_sqlite.execute("ROLLBACK")
+        raise
+
+def event_sink() -> str:
+    return "postgres" if psycopg2 is not None and DATABASE_URL else "sqlite"
+
+def prune_events():
+    """Delete shared.db events older than EVENT_RETENTION_DAYS. Runs in the executor."""
+    if event_sink() != "sqlite" or not EVENT_RETENTION_DAYS:
+        return
+    db_execute("DELETE FROM api_events WHERE created_at < ?", (time.time() - EVENT_RETENTION_DAYS * 86400,))
+
+async def flush_events():
+    """Write one batch of queued events plus any folded counts in a single
+    multi-row insert; on failure they go back to the queue and the error is raised"""
+    async with event_flush_lock:
+        batch = take_event_batch()
+        if not batch:
+            return
+        try:
+            if event_sink() == "postgres":
+                await in_executor(write_events_postgres, batch)
+            elif get_shared_db() is None:
+                # get_shared_db creates the api_events table the writer inserts into.
+                raise RuntimeError("shared.db unavailable")
+            else:
+                await in_executor(write_events_sqlite, batch)
+        except Exception:
+            requeue_events(batch)
+            raise
+        stats["events_written"] += sum(row[9] for row in batch)
+
+async def periodic_event_flush():
+    backoff = EVENT_FLUSH_INTERVAL
+    while True:
+        try:
+            await asyncio.wait_for(event_flush_wakeup.wait(), EVENT_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        event_flush_wakeup.clear()
+        try:
+            await flush_events()
+            while len(event_queue) >= EVENT_BATCH_SIZE:
+                await flush_events()
+        except Exception as e:
+            stats["event_flush_failures"] += 1
+            event_sink_state["failing_since"] = event_sink_state["failing_since"] or time.time()
+            event_sink_state["last_error"] = str(e)
+            print(f"[Events] {event_sink()} write failed, {len(event_queue)} queued, retrying in {backoff:.0f}s: {e}",
+                  file=sys.stderr)
+            # Wake-ups from a filling queue are ignored until the backoff has passed.
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, EVENT_MAX_BACKOFF)
+            continue
+        if event_sink_state["failing_since"] is not None:
+            print(f"[Events] {event_sink()} writes recovered", file=sys.stderr)
+            event_sink_state["failing_since"] = None
+        backoff = EVENT_FLUSH_INTERVAL
+
+async def drain_events():
+    """Best-effort final flush at shutdown"""
+    global events_conn, events_sqlite
+    try:
+        while event_queue or event_overflow:
+            await asyncio.wait_for(flush_events(), 10)
+    except Exception as e:
+        print(f"[Events] {len(event_queue)} events not written at shutdown: {e}", file=sys.stderr)
+    if events_conn is not None:
+        events_conn.close()
+        events_conn = None
+    if events_sqlite is not None:
+        events_sqlite.close()
+        events_sqlite = None
 
 @asynccontextmanager
-async def lifespan(app: FastAPI):
+async def upstream_clients():
+    """HTTP client, curl-cffi sessions and store index, for the server and for
+    tools such as scrap.py that work on the same store in their own process"""
     global http_client
     http_client = httpx.AsyncClient(
         timeout=httpx.Timeout(120.0, connect=30.0),
@@ -105,18 +1580,33 @@ async def lifespan(app: FastAPI):
             'Accept-Language': 'en-US,en;q=0.9',
         }
     )
-    
-    asyncio.create_task(periodic_cleanup())
-    
-    print("[Server] Started with high-performance configuration", file=sys.stderr)
-    yield
-    
-    for task in pending_deletions.values():
-        task.cancel()
-    
-    if http_client:
+    await in_executor(load_store_index)
+    try:
+        yield
+    finally:
+        flush_store_access()
+        await settle_db_writes()
+        await close_curl_sessions()
         await http_client.aclose()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with upstream_clients():
+        asyncio.create_task(periodic_cleanup())
+        asyncio.create_task(periodic_stats_sync())
+        asyncio.create_task(periodic_refresh())
+        asyncio.create_task(periodic_prefetch())
+        asyncio.create_task(periodic_revalidation())
+        asyncio.create_task(periodic_event_flush())
+        
+        print("[Server] Started with high-performance configuration", file=sys.stderr)
+        yield
+        
+        await drain_events()
+        db_execute("DELETE FROM worker_stats WHERE pid = ?", (os.getpid(),))
+    if shared_db is not None:
+        shared_db.close()
+
 app = FastAPI(title="AppOmar APK Download API", version="4.0.0", lifespan=lifespan)
 
 app.add_middleware(
@@ -127,6 +1617,53 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def request_timing(app):
+    """ASGI middleware observing each request until its last body chunk is sent,
+    labelled by route template so package names do not explode cardinality"""
+    async def middleware(scope, receive, send):
+        if scope['type'] != 'http':
+            return await app(scope, receive, send)
+        started = time.perf_counter()
+        status = [500]
+        
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+        
+        try:
+            await app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get('route')
+            observe("apk_http_request_seconds", time.perf_counter() - started,
+                    route=getattr(route, 'path', 'unmatched'), method=scope['method'], status=str(status[0]))
+    return middleware
+
+app.add_middleware(request_timing)
+
+def after_response(app):
+    """ASGI middleware running callbacks registered with on_response_done once the
+    response has finished, failed or lost its client. Starlette skips background
+    tasks when the client disconnects, which would leak slots and serving links."""
+    async def middleware(scope, receive, send):
+        if scope['type'] != 'http':
+            return await app(scope, receive, send)
+        callbacks = scope['apk.after_response'] = []
+        try:
+            await app(scope, receive, send)
+        finally:
+            for callback, args in reversed(callbacks):
+                try:
+                    callback(*args)
+                except Exception as e:
+                    print(f"[After Response] {callback.__name__}: {e}", file=sys.stderr)
+    return middleware
+
+def on_response_done(request: Request, callback: Callable, *args):
+    request.scope['apk.after_response'].append((callback, args))
+
+app.add_middleware(after_response)
+
 USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
@@ -137,6 +1674,63 @@ USER_AGENTS = [
 
 download_semaphore = asyncio.Semaphore(200)
 
+# Admission control for /download and /file. Every request takes one of
+# DOWNLOAD_SLOTS, at most USER_MAX_ACTIVE per user; the rest wait in a weighted
+# fair queue ordered by virtual finish tags (cost in MB of the expected file
+# divided by the user's weight), and are turned away with 429 once a user has
+# USER_MAX_QUEUED waiting or DOWNLOAD_QUEUE_MAX are waiting in total. Limits
+# apply per worker process.
+DOWNLOAD_SLOTS = int(os.environ.get('DOWNLOAD_SLOTS', 64))
+USER_MAX_ACTIVE = int(os.environ.get('USER_MAX_ACTIVE', 2))
+USER_MAX_QUEUED = int(os.environ.get('USER_MAX_QUEUED', 4))
+DOWNLOAD_QUEUE_MAX = int(os.environ.get('DOWNLOAD_QUEUE_MAX', 256))
+# "user:weight,user:weight"; unlisted users weigh 1.
+USER_WEIGHTS = {user: float(weight) for user, _, weight in
+                (item.partition(':') for item in os.environ.get('USER_WEIGHTS', '').split(',') if item)}
+# Total bytes/second across all responses; 0 leaves serving unthrottled.
+DOWNLOAD_BANDWIDTH = int(os.environ.get('DOWNLOAD_BANDWIDTH', 0))
+
+scheduler = {'active': 0, 'virtual_time': 0.0, 'waiting': [], 'service_ewma': 5.0}
+user_finish_tags: Dict[str, float] = {}
+bandwidth_bucket = {'tokens': float(DOWNLOAD_BANDWIDTH), 'updated': time.monotonic()}
+
+# Downloads are streamed to disk through a write buffer of DOWNLOAD_BUFFER_SIZE
+# bytes. At most DOWNLOAD_MEMORY_LIMIT // DOWNLOAD_BUFFER_SIZE upstream streams
+# are open at once: each takes a slot before its request is sent and holds it
+# until the body is drained or closed. This bounds the number of buffers, not
+# the bytes in them, because curl-cffi reads ahead into an unbounded queue
+# while a disk write is in progress; that backlog stays small as long as the
+# disk keeps up with the network. DOWNLOAD_MAX_RECV_SPEED (bytes per second
+# per stream, 0 for no limit) caps how fast a backlog can grow on slow disks.
+DOWNLOAD_BUFFER_SIZE = int(os.environ.get('DOWNLOAD_BUFFER_SIZE', 1024 * 1024))
+DOWNLOAD_MEMORY_LIMIT = int(os.environ.get('DOWNLOAD_MEMORY_LIMIT', 256 * 1024 * 1024))
+DOWNLOAD_MAX_RECV_SPEED = int(os.environ.get('DOWNLOAD_MAX_RECV_SPEED', 0))
+download_buffer_semaphore = asyncio.Semaphore(max(1, DOWNLOAD_MEMORY_LIMIT // DOWNLOAD_BUFFER_SIZE))
+
+STREAM_WHILE_DOWNLOADING = os.environ.get('STREAM_WHILE_DOWNLOADING', '1') == '1'
+# Read size for stored files when the server cannot send them by path; larger
+# reads mean fewer thread hand-offs per served megabyte.
+SERVE_CHUNK_SIZE = int(os.environ.get('SERVE_CHUNK_SIZE', 1024 * 1024))
+
+# Large files from servers that accept ranges are fetched as DOWNLOAD_SEGMENTS
+# concurrent byte ranges, each at least MIN_SEGMENT_SIZE bytes.
+SEGMENTED_DOWNLOADS = os.environ.get('SEGMENTED_DOWNLOADS', '1') == '1'
+DOWNLOAD_SEGMENTS = int(os.environ.get('DOWNLOAD_SEGMENTS', 4))
+MIN_SEGMENT_SIZE = int(os.environ.get('MIN_SEGMENT_SIZE', 16 * 1024 * 1024))
+SEGMENT_RETRIES = int(os.environ.get('SEGMENT_RETRIES', 3))
+
+def supports_ranges(headers) -> bool:
+    return headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+# APKPure names files "<title>_<versionName>_APKPure.<ext>".
+APKPURE_FILENAME_VERSION = re.compile(r'_([0-9][^_"/]*)_APKPure\.x?apk', re.IGNORECASE)
+
+def version_from_headers(headers) -> Optional[str]:
+    """Version named in the upstream filename, so the store can key files by real
+    version; None (stored as "latest") when the response does not say"""
+    match = APKPURE_FILENAME_VERSION.search(headers.get('Content-Disposition', ''))
+    return match.group(1) if match else None
+
 def get_headers() -> Dict[str, str]:
     return {
         'User-Agent': random.choice(USER_AGENTS),
@@ -154,7 +1748,7 @@ async def root() -> Dict[str, Any]:
         "version": "4.0.0",
         "status": "running",
         "source": "APKPure Only",
-        "features": ["file_caching", "auto_cleanup", "concurrent_downloads"]
+        "features": ["persistent_file_store", "auto_cleanup", "concurrent_downloads"]
     }
 
 @app.get("/health")
@@ -163,34 +1757,191 @@ async def health_check() -> Dict[str, str]:
 
 @app.get("/stats")
 async def get_stats() -> Dict[str, Any]:
-    return {
+    response = {
         **stats,
         "cached_urls": len(url_cache),
-        "cached_files": len([f for f in os.listdir(DOWNLOADS_DIR) if os.path.isfile(os.path.join(DOWNLOADS_DIR, f))]),
+        "inflight_resolutions": len(resolution_inflight),
+        "cached_files": store_count(),
+        "store_bytes": store_bytes(),
+        "store_max_bytes": STORE_MAX_BYTES,
         "active_locks": len([l for l in download_locks.values() if l.locked()]),
-        "pending_deletions": len(pending_deletions)
+        "active_transfers": len(active_transfers),
+        "impersonation_profiles": {profile: profile_stats[profile] for profile in ranked_profiles()},
+        "hit_ratios": hit_ratios(),
+        "scheduler": scheduler_state(),
+        "upstream": upstream_state(),
+        "tiers": {
+            "hot": {"files": hot_usage["files"], "bytes": hot_bytes(), "max_bytes": HOT_TIER_BYTES,
+                    "dir": HOT_TIER_DIR if HOT_TIER_BYTES else None},
+            "disk": {"files": store_count(), "bytes": store_bytes(), "max_bytes": STORE_MAX_BYTES}
+        },
+        "events": {
+            "sink": event_sink(),
+            "queued": len(event_queue),
+            "folded": sum(folded[1] for folded in event_overflow.values()),
+            "failing_since": event_sink_state["failing_since"],
+            "last_error": event_sink_state["last_error"]
+        },
+        "jobs": {
+            "active": sum(1 for job in jobs.values() if job['stage'] not in JOB_FINAL_STAGES),
+            "tracked": len(jobs)
+        },
+        "prefetch": {
+            "prefetched_files": len(prefetched_keys),
+            # Share of requests served by files that would otherwise have been misses.
+            "hit_ratio_gain": round(stats["prefetch_hits"] / stats["file_requests"], 4) if stats["file_requests"] else None,
+            "last_run": dict(prefetch_state)
+        }
+    }
+    if API_WORKERS > 1:
+        publish_worker_stats()
+        response["cluster"] = cluster_stats()
+    return response
+
+COUNTER_STATS = {key for key in stats if key not in ("active_downloads", "cached_files", "open_file_refs")}
+
+def hit_ratios() -> Dict[str, Optional[float]]:
+    """Share of requests answered by each cache layer, in lookup order"""
+    def ratio(hits: int, total: int) -> Optional[float]:
+        return round(hits / total, 4) if total else None
+    return {
+        "url": ratio(stats["cache_hits"], stats["total_requests"]),
+        "persistent": ratio(stats["persistent_cache_hits"], stats["total_requests"]),
+        "stale": ratio(stats["stale_hits"], stats["total_requests"]),
+        "negative": ratio(stats["negative_cache_hits"], stats["total_requests"]),
+        "file": ratio(stats["file_cache_hits"], stats["file_requests"]),
+        # Of the files served from the store, the share read from each tier.
+        "hot_tier": ratio(stats["hot_tier_hits"], stats["hot_tier_hits"] + stats["disk_tier_hits"]),
+        "disk_tier": ratio(stats["disk_tier_hits"], stats["hot_tier_hits"] + stats["disk_tier_hits"])
+    }
+
+def metric_labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = ((k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+def render_metrics() -> str:
+    lines = []
+    for key, value in stats.items():
+        if key in COUNTER_STATS:
+            lines += [f"# TYPE apk_{key}_total counter", f"apk_{key}_total {value}"]
+        else:
+            lines += [f"# TYPE apk_{key} gauge", f"apk_{key} {value}"]
+    
+    gauges = {
+        "apk_store_bytes": store_bytes(),
+        "apk_store_max_bytes": STORE_MAX_BYTES,
+        "apk_hot_tier_bytes": hot_bytes(),
+        "apk_hot_tier_max_bytes": HOT_TIER_BYTES,
+        "apk_cached_urls": len(url_cache),
+        "apk_inflight_resolutions": len(resolution_inflight),
+        "apk_active_transfers": len(active_transfers),
+        "apk_active_jobs": sum(1 for job in jobs.values() if job['stage'] not in JOB_FINAL_STAGES),
     }
+    for name, value in gauges.items():
+        lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    
+    lines.append("# TYPE apk_cache_hit_ratio gauge")
+    for layer, value in hit_ratios().items():
+        if value is not None:
+            lines.append(f"apk_cache_hit_ratio{metric_labels([('layer', layer)])} {value}")
+    
+    lines.append("# TYPE apk_upstream_rate gauge")
+    for host, gate in upstream_hosts.items():
+        lines.append(f"apk_upstream_rate{metric_labels([('host', host)])} {gate['rate']}")
+    lines.append("# TYPE apk_upstream_breaker_open gauge")
+    for host, gate in upstream_hosts.items():
+        lines.append(f"apk_upstream_breaker_open{metric_labels([('host', host)])} {int(gate['state'] != 'closed')}")
+    
+    lines.append("# TYPE apk_download_bytes_total counter")
+    for method, value in download_bytes_total.items():
+        lines.append(f"apk_download_bytes_total{metric_labels([('method', method)])} {value}")
+    
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for key, series in histograms[name].items():
+            cumulative = 0
+            for bound, count in zip(buckets + (float('inf'),), series['counts']):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(float(bound))
+                lines.append(f"{name}_bucket{metric_labels(key + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{metric_labels(key)} {series['sum']}")
+            lines.append(f"{name}_count{metric_labels(key)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+@app.get("/metrics")
+async def get_metrics() -> PlainTextResponse:
+    """Prometheus exposition of this worker's counters and histograms"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# Page extraction runs on lxml's C parser in the default executor and only looks
+# at the handful of elements resolution needs, keeping the event loop free.
+APK_URL_IN_SCRIPT = re.compile(r'(https?://[^"\'<>\s]+\.(?:apk|xapk)[^"\'<>\s]*)', re.IGNORECASE)
+META_REFRESH_URL = re.compile(r'url=(.+)', re.IGNORECASE)
+
+def extract_app_slug(page: str, package_name: str) -> str:
+    if f'/{package_name}' not in page:
+        return package_name
+    
+    tree = lxml_html.fromstring(page)
+    for href in tree.xpath('//a/@href'):
+        if f'/{package_name}' in href and '/download' not in href:
+            parts = urlsplit(href).path.strip('/').split('/')
+            if parts[0]:
+                return parts[0]
+    
+    return package_name
+
+def extract_download_url(page: str) -> Optional[str]:
+    """Find the direct file URL on an APKPure download page, in order of reliability"""
+    if not page.strip():
+        return None
+    
+    tree = lxml_html.fromstring(page)
+    
+    for href in tree.xpath('(//a[@id="download_link"])[1]/@href'):
+        if href.startswith('http'):
+            return href
+    
+    for href in tree.xpath('//a[contains(@href, "apkpure.com")]/@href'):
+        if 'download.apkpure.com' in href or 'd.apkpure.com' in href:
+            if 'token' in href or 'key' in href:
+                return href
+    
+    for src in tree.xpath('(//iframe[@id="iframe_download"])[1]/@src'):
+        if src:
+            return src
+    
+    for content in tree.xpath('(//meta[@http-equiv="refresh"])[1]/@content'):
+        match = META_REFRESH_URL.search(content)
+        if match:
+            return match.group(1).strip()
+    
+    for script_text in tree.xpath('//script/text()'):
+        url_match = APK_URL_IN_SCRIPT.search(script_text)
+        if url_match:
+            return url_match.group(1)
+    
+    return None
 
 async def get_apkpure_app_slug(package_name: str) -> Optional[str]:
+    cached_slug = load_persisted_slug(package_name)
+    if cached_slug:
+        return cached_slug
+    
     try:
         client = get_client()
-        search_url = f"https://apkpure.com/search?q={package_name}"
-        response = await client.get(search_url, headers=get_headers())
-        
-        if response.status_code != 200:
-            return None
+        search_url = f"{APKPURE_BASE_URL}/search?q={package_name}"
+        with timed("apk_stage_seconds", stage="slug"):
+            response = await upstream_request(search_url, lambda: client.get(search_url, headers=get_headers()))
             
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        for link in soup.find_all('a', href=True):
-            href_attr = link.get('href')
-            href = str(href_attr) if href_attr else ''
-            if f'/{package_name}' in href and '/download' not in href:
-                parts = href.strip('/').split('/')
-                if len(parts) >= 1:
-                    return parts[0]
-        
-        return package_name
+            if response.status_code != 200:
+                return None
+            
+            slug = await in_executor(extract_app_slug, response.text, package_name)
+        persist_slug(package_name, slug)
+        return slug
     except Exception as e:
         print(f"[Slug] {package_name}: {e}", file=sys.stderr)
         return package_name
@@ -202,135 +1953,113 @@ async def resolve_apkpure_download_url(package_name: str, file_type: str = "XAPK
         if not slug:
             slug = package_name
         
-        download_page_url = f"https://apkpure.com/{slug}/{package_name}/download"
+        download_page_url = f"{APKPURE_BASE_URL}/{slug}/{package_name}/download"
         
-        response = await client.get(download_page_url, headers=get_headers())
-        
-        if response.status_code != 200:
-            return None
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        download_link = soup.find('a', {'id': 'download_link'})
-        if download_link:
-            href_attr = download_link.get('href')
-            if href_attr:
-                url = str(href_attr)
-                if url.startswith('http'):
-                    return url
-        
-        for a_tag in soup.find_all('a', href=True):
-            href_attr = a_tag.get('href')
-            href = str(href_attr) if href_attr else ''
-            if 'download.apkpure.com' in href or 'd.apkpure.com' in href:
-                if 'token' in href or 'key' in href:
-                    return href
-        
-        iframe = soup.find('iframe', {'id': 'iframe_download'})
-        if iframe:
-            src_attr = iframe.get('src')
-            if src_attr:
-                return str(src_attr)
-        
-        meta_refresh = soup.find('meta', {'http-equiv': 'refresh'})
-        if meta_refresh:
-            content_attr = meta_refresh.get('content')
-            content = str(content_attr) if content_attr else ''
-            match = re.search(r'url=(.+)', content, re.IGNORECASE)
-            if match:
-                return match.group(1).strip()
-        
-        scripts = soup.find_all('script')
-        for script in scripts:
-            script_text = script.string or ''
-            url_match = re.search(r'(https?://[^"\'<>\s]+\.(?:apk|xapk)[^"\'<>\s]*)', script_text, re.IGNORECASE)
-            if url_match:
-                return url_match.group(1)
-        
-        return None
+        with timed("apk_stage_seconds", stage="scrape"):
+            response = await upstream_request(download_page_url, lambda: client.get(download_page_url, headers=get_headers()))
+            
+            if response.status_code != 200:
+                return None
+            
+            return await in_executor(extract_download_url, response.text)
         
     except Exception as e:
         print(f"[APKPure Resolve] {package_name}: {e}", file=sys.stderr)
         return None
 
-def get_apkpure_info_sync(package_name: str) -> Optional[Dict[str, Any]]:
-    """Use curl-cffi with Chrome impersonation to bypass CloudFlare"""
+async def probe_apkpure_profile(package_name: str, chrome_ver: str) -> Any:
+    """Probe with one impersonation profile. Returns the info dict on success, None
+    when the profile looks blocked (so another should be tried) and False when
+    upstream answered but has nothing usable."""
+    session = get_curl_session(chrome_ver)
+    blocked = False
+    
+    xapk_url = f"{APKPURE_DOWNLOAD_BASE_URL}/b/XAPK/{package_name}?version=latest"
+    response = await upstream_request(xapk_url, lambda: session.head(
+        xapk_url,
+        timeout=30,
+        allow_redirects=True
+    ))
+    
+    if response.status_code == 200:
+        content_type = response.headers.get('Content-Type', '')
+        if 'html' not in content_type.lower():
+            content_length = int(response.headers.get('Content-Length', 0))
+            if content_length > 1000000:
+                print(f"[APKPure curl-cffi] Found XAPK for {package_name} with {chrome_ver}: {content_length} bytes", file=sys.stderr)
+                return {
+                    "source": "apkpure",
+                    "download_url": xapk_url,
+                    "size": content_length,
+                    "file_type": "xapk",
+                    "accept_ranges": supports_ranges(response.headers),
+                    "version": version_from_headers(response.headers),
+                    "validator": response_validator(response.headers),
+                    "impersonate": chrome_ver
+                }
+    blocked = blocked or response.status_code in BLOCKED_STATUSES
+    
+    apk_url = f"{APKPURE_DOWNLOAD_BASE_URL}/b/APK/{package_name}?version=latest"
+    response = await upstream_request(apk_url, lambda: session.head(
+        apk_url,
+        timeout=30,
+        allow_redirects=True
+    ))
+    
+    if response.status_code == 200:
+        content_type = response.headers.get('Content-Type', '')
+        if 'html' not in content_type.lower():
+            content_length = int(response.headers.get('Content-Length', 0))
+            final_url = str(response.url)
+            
+            file_type = 'xapk' if 'xapk' in final_url.lower() else 'apk'
+            
+            if content_length > 100000:
+                print(f"[APKPure curl-cffi] Found {file_type.upper()} for {package_name} with {chrome_ver}: {content_length} bytes", file=sys.stderr)
+                return {
+                    "source": "apkpure",
+                    "download_url": apk_url,
+                    "size": content_length,
+                    "file_type": file_type,
+                    "accept_ranges": supports_ranges(response.headers),
+                    "version": version_from_headers(response.headers),
+                    "validator": response_validator(response.headers),
+                    "impersonate": chrome_ver
+                }
+    blocked = blocked or response.status_code in BLOCKED_STATUSES
+    
+    return None if blocked else False
+
+async def timed_probe(package_name: str, chrome_ver: str) -> Any:
+    # Losers cancelled by the race are not observed; they would only measure the winner.
+    started = time.perf_counter()
     try:
-        chrome_versions = ["chrome110", "chrome116", "chrome120", "chrome124"]
-        
-        for chrome_ver in chrome_versions:
-            try:
-                xapk_url = f"https://d.apkpure.com/b/XAPK/{package_name}?version=latest"
-                response = curl_requests.head(
-                    xapk_url,
-                    impersonate=chrome_ver,
-                    timeout=30,
-                    allow_redirects=True
-                )
-                
-                if response.status_code == 200:
-                    content_type = response.headers.get('Content-Type', '')
-                    if 'html' not in content_type.lower():
-                        content_length = int(response.headers.get('Content-Length', 0))
-                        if content_length > 1000000:
-                            print(f"[APKPure curl-cffi] Found XAPK for {package_name}: {content_length} bytes", file=sys.stderr)
-                            return {
-                                "source": "apkpure",
-                                "download_url": xapk_url,
-                                "size": content_length,
-                                "file_type": "xapk",
-                                "impersonate": chrome_ver
-                            }
-                
-                apk_url = f"https://d.apkpure.com/b/APK/{package_name}?version=latest"
-                response = curl_requests.head(
-                    apk_url,
-                    impersonate=chrome_ver,
-                    timeout=30,
-                    allow_redirects=True
-                )
-                
-                if response.status_code == 200:
-                    content_type = response.headers.get('Content-Type', '')
-                    if 'html' not in content_type.lower():
-                        content_length = int(response.headers.get('Content-Length', 0))
-                        final_url = str(response.url)
-                        
-                        file_type = 'xapk' if 'xapk' in final_url.lower() else 'apk'
-                        
-                        if content_length > 100000:
-                            print(f"[APKPure curl-cffi] Found {file_type.upper()} for {package_name}: {content_length} bytes", file=sys.stderr)
-                            return {
-                                "source": "apkpure",
-                                "download_url": apk_url,
-                                "size": content_length,
-                                "file_type": file_type,
-                                "impersonate": chrome_ver
-                            }
-                
-                break
-                
-            except Exception as e:
-                print(f"[APKPure curl-cffi] {chrome_ver} failed: {e}", file=sys.stderr)
-                continue
-        
-        return None
+        result = await probe_apkpure_profile(package_name, chrome_ver)
+    except Exception:
+        observe("apk_probe_seconds", time.perf_counter() - started, profile=chrome_ver, outcome="error")
+        raise
+    outcome = "found" if result else "blocked" if result is None else "missing"
+    observe("apk_probe_seconds", time.perf_counter() - started, profile=chrome_ver, outcome=outcome)
+    return result
+
+async def get_apkpure_info_curl(package_name: str) -> Optional[Dict[str, Any]]:
+    """Use curl-cffi with Chrome impersonation to bypass CloudFlare, racing profiles"""
+    try:
+        return await hedged_race(lambda chrome_ver: timed_probe(package_name, chrome_ver), "probe")
     except Exception as e:
         print(f"[APKPure curl-cffi] {package_name}: {e}", file=sys.stderr)
         return None
 
 async def get_apkpure_info(package_name: str) -> Optional[Dict[str, Any]]:
-    """Async wrapper for curl-cffi APKPure download"""
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(None, get_apkpure_info_sync, package_name)
+    result = await get_apkpure_info_curl(package_name)
     
     if result:
         return result
     
     try:
         client = get_client()
-        xapk_url = f"https://d.apkpure.com/b/XAPK/{package_name}?version=latest"
-        response = await client.head(xapk_url, headers=get_headers(), follow_redirects=True)
+        xapk_url = f"{APKPURE_DOWNLOAD_BASE_URL}/b/XAPK/{package_name}?version=latest"
+        response = await upstream_request(xapk_url, lambda: client.head(xapk_url, headers=get_headers(), follow_redirects=True))
         
         if response.status_code == 200:
             content_type = response.headers.get('Content-Type', '')
@@ -341,11 +2070,14 @@ async def get_apkpure_info(package_name: str) -> Optional[Dict[str, Any]]:
                         "source": "apkpure",
                         "download_url": xapk_url,
                         "size": content_length,
-                        "file_type": "xapk"
+                        "file_type": "xapk",
+                        "accept_ranges": supports_ranges(response.headers),
+                        "version": version_from_headers(response.headers),
+                        "validator": response_validator(response.headers)
                     }
         
-        apk_url = f"https://d.apkpure.com/b/APK/{package_name}?version=latest"
-        response = await client.head(apk_url, headers=get_headers(), follow_redirects=True)
+        apk_url = f"{APKPURE_DOWNLOAD_BASE_URL}/b/APK/{package_name}?version=latest"
+        response = await upstream_request(apk_url, lambda: client.head(apk_url, headers=get_headers(), follow_redirects=True))
         
         if response.status_code == 200:
             content_type = response.headers.get('Content-Type', '')
@@ -362,13 +2094,16 @@ async def get_apkpure_info(package_name: str) -> Optional[Dict[str, Any]]:
                         "source": "apkpure",
                         "download_url": apk_url,
                         "size": content_length,
-                        "file_type": file_type
+                        "file_type": file_type,
+                        "accept_ranges": supports_ranges(response.headers),
+                        "version": version_from_headers(response.headers),
+                        "validator": response_validator(response.headers)
                     }
         
         resolved_url = await resolve_apkpure_download_url(package_name, "XAPK")
         if resolved_url:
             try:
-                check_response = await client.head(resolved_url, headers=get_headers(), follow_redirects=True)
+                check_response = await upstream_request(resolved_url, lambda: client.head(resolved_url, headers=get_headers(), follow_redirects=True))
                 if check_response.status_code == 200:
                     content_type = check_response.headers.get('Content-Type', '')
                     content_length = int(check_response.headers.get('Content-Length', 0))
@@ -379,76 +2114,266 @@ async def get_apkpure_info(package_name: str) -> Optional[Dict[str, Any]]:
                             "source": "apkpure",
                             "download_url": resolved_url,
                             "size": content_length,
-                            "file_type": file_type
+                            "file_type": file_type,
+                            "accept_ranges": supports_ranges(check_response.headers),
+                            "version": version_from_headers(check_response.headers),
+                            "validator": response_validator(check_response.headers)
                         }
             except Exception as e:
                 pass
         
         return None
+    except UpstreamUnavailable:
+        raise
     except Exception as e:
         print(f"[APKPure] {package_name}: {e}", file=sys.stderr)
         return None
 
-async def get_download_info(package_name: str) -> Dict[str, Any]:
-    stats["total_requests"] += 1
+async def resolve_download_info(package_name: str) -> Dict[str, Any]:
+    now = time.time()
+    started = time.perf_counter()
+    try:
+        # Primary and only source: APKPure
+        result = await get_apkpure_info(package_name)
+    except UpstreamUnavailable:
+        # An upstream outage says nothing about this package, so it is not cached.
+        observe("apk_resolution_seconds", time.perf_counter() - started, outcome="unavailable")
+        record_event("resolution", package_name, "unavailable", duration=time.perf_counter() - started)
+        raise
+    except Exception as e:
+        observe("apk_resolution_seconds", time.perf_counter() - started, outcome="error")
+        record_event("resolution", package_name, "error", duration=time.perf_counter() - started)
+        resolution_failures[package_name] = (str(e), now)
+        persist_failure(package_name, str(e), now)
+        raise
+    
+    # Last resort: Direct APKPure XAPK URL, cached only for NEGATIVE_CACHE_TTL
+    # so resolution is retried soon instead of pinning a blind guess.
+    if not result:
+        print(f"[Fallback] Using direct APKPure XAPK URL for {package_name}", file=sys.stderr)
+        xapk_url = f"{APKPURE_DOWNLOAD_BASE_URL}/b/XAPK/{package_name}?version=latest"
+        result = {
+            "source": "apkpure",
+            "download_url": xapk_url,
+            "size": 0,
+            "file_type": "xapk",
+            "resolved": False
+        }
+    
+    outcome = "resolved" if result.get('resolved', True) else "fallback"
+    observe("apk_resolution_seconds", time.perf_counter() - started, outcome=outcome)
+    record_event("resolution", package_name, outcome, version=result.get('version'), file_type=result.get('file_type'),
+                 size=int(result.get('size') or 0) or None, duration=time.perf_counter() - started)
+    result["package_name"] = package_name
+    url_cache[package_name] = (result, now)
+    persist_resolution(package_name, result, now)
+    if resolution_failures.pop(package_name, None):
+        persist_failure(package_name, None, now)
+    confirm_stored_build(package_name, result)
+    
+    print(f"[Download Info] {package_name} -> Source: {result.get('source')}, Size: {result.get('size', 0)} bytes", file=sys.stderr)
+    return result
+
+def start_resolution(package_name: str) -> asyncio.Future:
+    """Single-flight: concurrent requests for the same package share one resolution"""
+    future = resolution_inflight.get(package_name)
+    if future is not None:
+        stats["coalesced_resolutions"] += 1
+        return future
+    
+    future = asyncio.ensure_future(resolve_download_info(package_name))
+    resolution_inflight[package_name] = future
+    
+    def forget(f: asyncio.Future):
+        if resolution_inflight.get(package_name) is f:
+            del resolution_inflight[package_name]
+        if not f.cancelled():
+            f.exception()
+    
+    future.add_done_callback(forget)
+    return future
+
+def resolution_ttl(result: Dict[str, Any]) -> int:
+    return URL_CACHE_TTL if result.get('resolved', True) else NEGATIVE_CACHE_TTL
+
+def refresh_hot_packages():
+    """Re-resolve the most requested packages shortly before their entries expire,
+    then decay request counts so popularity follows recent traffic"""
+    now = time.time()
+    hottest = sorted(package_popularity.items(), key=lambda item: item[1], reverse=True)[:REFRESH_TOP_N]
+    for package_name, _ in hottest:
+        cached = url_cache.get(package_name)
+        if cached is None or not cached[0].get('resolved', True):
+            continue
+        expires_in = cached[1] + URL_CACHE_TTL - now
+        if expires_in < REFRESH_AHEAD and package_name not in resolution_inflight:
+            stats["proactive_refreshes"] += 1
+            start_resolution(package_name)
+    
+    for package_name in list(package_popularity):
+        package_popularity[package_name] *= POPULARITY_DECAY
+        if package_popularity[package_name] < 0.1:
+            del package_popularity[package_name]
+
+async def periodic_refresh():
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        try:
+            refresh_hot_packages()
+        except Exception as e:
+            print(f"[Refresh Error] {e}", file=sys.stderr)
+
+async def get_download_info(package_name: str, record: bool = True) -> Dict[str, Any]:
+    """Resolve download info through the cache layers. record=False keeps internal
+    callers such as prefetch out of the request counters and popularity data."""
     cache_key = package_name
     now = time.time()
     
+    if record:
+        stats["total_requests"] += 1
+        package_popularity[cache_key] += 1
+        request_log_pending[cache_key] += 1
+    
+    stale = None
     if cache_key in url_cache:
         cached, timestamp = url_cache[cache_key]
-        if now - timestamp < URL_CACHE_TTL:
+        if now - timestamp < resolution_ttl(cached):
             stats["cache_hits"] += 1
             print(f"[Cache Hit] {package_name} from {cached.get('source', 'unknown')}", file=sys.stderr)
             return cached
+        stale = url_cache[cache_key]
     
-    # Primary and only source: APKPure
-    result = await get_apkpure_info(package_name)
+    persisted = load_persisted_resolution(cache_key)
+    if persisted:
+        cached, timestamp = persisted
+        if now - timestamp < resolution_ttl(cached):
+            url_cache[cache_key] = persisted
+            stats["persistent_cache_hits"] += 1
+            print(f"[Persistent Hit] {package_name}", file=sys.stderr)
+            return cached
+        if stale is None or timestamp > stale[1]:
+            stale = persisted
     
-    # Last resort: Direct APKPure XAPK URL
-    if not result:
-        print(f"[Fallback] Using direct APKPure XAPK URL for {package_name}", file=sys.stderr)
-        xapk_url = f"https://d.apkpure.com/b/XAPK/{package_name}?version=latest"
-        result = {
-            "source": "apkpure",
-            "download_url": xapk_url,
-            "size": 0,
-            "file_type": "xapk"
-        }
+    # Stale-while-revalidate: a recently valid answer is returned immediately
+    # and the single-flight resolver refreshes it in the background.
+    if stale:
+        cached, timestamp = stale
+        if cached.get('resolved', True) and now - timestamp < URL_CACHE_TTL + STALE_MAX_AGE:
+            stats["stale_hits"] += 1
+            print(f"[Stale Hit] {package_name}, refreshing in background", file=sys.stderr)
+            start_resolution(cache_key)
+            return cached
     
-    result["package_name"] = package_name
-    url_cache[cache_key] = (result, now)
+    # While APKPure's breaker is open any earlier answer beats an error, and
+    # without one the caller fails fast instead of queueing on a sick upstream.
+    if upstream_is_open(APKPURE_PROBE_HOST):
+        if stale and stale[0].get('resolved', True):
+            stats["breaker_stale_hits"] += 1
+            print(f"[Breaker] Serving expired entry for {package_name}", file=sys.stderr)
+            return stale[0]
+        raise UpstreamUnavailable(APKPURE_PROBE_HOST, upstream_retry_after(APKPURE_PROBE_HOST))
     
-    print(f"[Download Info] {package_name} -> Source: {result.get('source')}, Size: {result.get('size', 0)} bytes", file=sys.stderr)
-    return result
+    failure = resolution_failures.get(cache_key) or load_persisted_failure(cache_key)
+    if failure:
+        error, timestamp = failure
+        if now - timestamp < NEGATIVE_CACHE_TTL:
+            stats["negative_cache_hits"] += 1
+            raise RuntimeError(f"Recent resolution failure for {package_name}: {error}")
+    
+    return await asyncio.shield(start_resolution(cache_key))
+
+def info_payload(package_name: str, info: Dict[str, Any]) -> Dict[str, Any]:
+    """Resolution fields, overridden by what verification read from the stored file"""
+    payload = {
+        "package_name": package_name,
+        "source": info.get("source"),
+        "size": info.get("size", 0),
+        "file_type": info.get("file_type", "apk"),
+        "version": info.get("version") or "Latest"
+    }
+    entry = find_store_entry(store_key(package_name, info.get("version")))
+    if entry:
+        payload.update({
+            "size": entry['size'],
+            "file_type": entry['file_type'],
+            "version": entry['version_name'] or payload["version"],
+            "version_code": entry['version_code'],
+            "sha256": entry['sha256'],
+            "cached": True
+        })
+    return payload
+
+def url_payload(package_name: str, info: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "success": True,
+        "url": info['download_url'],
+        "filename": f"{package_name}.{info.get('file_type', 'apk')}",
+        "size": info.get('size', 0),
+        "source": info.get('source'),
+        "file_type": info.get('file_type', 'apk')
+    }
+
+async def resolve_batch(packages: list, payload: Callable[[str, Dict[str, Any]], Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """Resolve packages concurrently and yield one NDJSON line per package as soon
+    as it is ready, so a list view waits for the slowest app rather than the sum"""
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def resolve_one(package_name: str) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                return {"package_name": package_name, **payload(package_name, await get_download_info(package_name))}
+            except Exception as e:
+                return {"package_name": package_name, "success": False, "error": str(e)}
+    
+    tasks = [asyncio.create_task(resolve_one(package_name)) for package_name in packages]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield (json.dumps(await next_done) + "\n").encode()
+    finally:
+        # Resolutions are shielded single-flights, so cancelling here after a client
+        # disconnect only drops this batch's interest in them.
+        for task in tasks:
+            task.cancel()
+
+def batch_response(packages: list, payload: Callable[[str, Dict[str, Any]], Dict[str, Any]]) -> StreamingResponse:
+    packages = list(dict.fromkeys(name.strip() for name in packages if name and name.strip()))
+    if not packages:
+        raise HTTPException(status_code=400, detail="No packages given")
+    if len(packages) > BATCH_MAX_PACKAGES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_PACKAGES} packages per batch")
+    stats["batch_requests"] += 1
+    return StreamingResponse(resolve_batch(packages, payload), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache"})
+
+@app.post("/info/batch")
+async def get_apk_info_batch(packages: List[str] = Body(..., embed=True)) -> StreamingResponse:
+    return batch_response(packages, info_payload)
+
+@app.post("/url/batch")
+async def get_download_url_batch(packages: List[str] = Body(..., embed=True)) -> StreamingResponse:
+    return batch_response(packages, url_payload)
 
 @app.get("/info/{package_name}")
 async def get_apk_info(package_name: str) -> Dict[str, Any]:
     try:
         info = await get_download_info(package_name)
-        return {
-            "package_name": package_name,
-            "source": info.get("source"),
-            "size": info.get("size", 0),
-            "file_type": info.get("file_type", "apk"),
-            "version": info.get("version", "Latest")
-        }
+        return info_payload(package_name, info)
+    except UpstreamUnavailable as e:
+        # The store index alone can still describe files we already hold.
+        entry = latest_store_entry(package_name)
+        if entry is None:
+            raise http_error(e)
+        return info_payload(package_name, {"source": "store", "version": entry['version']})
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/url/{package_name}")
 async def get_download_url(package_name: str) -> Dict[str, Any]:
     try:
         info = await get_download_info(package_name)
-        return {
-            "success": True,
-            "url": info['download_url'],
-            "filename": f"{package_name}.{info.get('file_type', 'apk')}",
-            "size": info.get('size', 0),
-            "source": info.get('source'),
-            "file_type": info.get('file_type', 'apk')
-        }
+        return url_payload(package_name, info)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/direct-url/{package_name}")
 async def get_direct_download_url(package_name: str) -> Dict[str, Any]:
@@ -468,8 +2393,8 @@ async def get_direct_download_url(package_name: str) -> Dict[str, Any]:
             'Accept-Encoding': 'gzip, deflate, br',
             'Cache-Control': 'no-cache',
             'Connection': 'keep-alive',
-            'Referer': 'https://apkpure.com/',
-            'Origin': 'https://apkpure.com',
+            'Referer': f'{APKPURE_BASE_URL}/',
+            'Origin': APKPURE_BASE_URL,
             'Sec-Ch-Ua': '"Chromium";v="122", "Not(A:Brand";v="24", "Google Chrome";v="122"',
             'Sec-Ch-Ua-Mobile': '?0',
             'Sec-Ch-Ua-Platform': '"Windows"',
@@ -491,191 +2416,1374 @@ async def get_direct_download_url(package_name: str) -> Dict[str, Any]:
         }
     except Exception as e:
         print(f"[Direct URL Error] {package_name}: {e}", file=sys.stderr)
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+def new_transfer(expected_size: int, accept_ranges: bool = False, validator: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    return {
+        'path': None,
+        'expected_size': expected_size,
+        'accept_ranges': accept_ranges,
+        'validator': validator or {},
+        'written': 0,
+        'attempt': 0,
+        'stage': 'waiting',
+        'done': False,
+        'error': None,
+        'entry': None,
+        'cond': asyncio.Condition(),
+        'task': None
+    }
+
+async def publish_transfer(transfer: Optional[Dict[str, Any]], **changes):
+    """Update a transfer's progress and wake up every reader tailing it"""
+    if transfer is None:
+        return
+    async with transfer['cond']:
+        transfer.update(changes)
+        transfer['cond'].notify_all()
+
+def partial_path(package_name: str, version: Optional[str], file_type: str) -> str:
+    safe_version = re.sub(r'[^\w.-]', '_', version or 'latest')
+    return os.path.join(STORE_TMP_DIR, f"{package_name}_{safe_version}.{file_type}.part")
+
+def load_checkpoint(file_path: str) -> Dict[str, Any]:
+    """Read the sidecar describing a .part file; missing or unreadable means start over"""
+    try:
+        with open(f"{file_path}.json") as f:
+            checkpoint = json.load(f)
+        if os.path.exists(file_path):
+            return checkpoint
+    except (OSError, ValueError):
+        pass
+    return {}
+
+def save_checkpoint(file_path: str, checkpoint: Dict[str, Any]):
+    checkpoint['updated_at'] = time.time()
+    tmp_path = f"{file_path}.json.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, f"{file_path}.json")
+    except Exception as e:
+        print(f"[Resume] Failed to save checkpoint for {os.path.basename(file_path)}: {e}", file=sys.stderr)
 
-def download_with_curl_cffi(download_url: str, file_path: str, package_name: str) -> bool:
-    """Download file using curl-cffi to bypass CloudFlare"""
-    chrome_versions = ["chrome110", "chrome116", "chrome120", "chrome124"]
+def discard_partial(file_path: str):
+    for path in (file_path, f"{file_path}.json"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def response_validator(headers) -> Dict[str, Any]:
+    content_range = headers.get('Content-Range', '')
+    if '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        size = int(total) if total.isdigit() else 0
+    else:
+        size = int(headers.get('Content-Length') or 0)
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'size': size
+    }
+
+def same_validator(old: Dict[str, Any], new: Dict[str, Any]) -> bool:
+    if old.get('size') != new.get('size'):
+        return False
+    if old.get('etag') and new.get('etag'):
+        return old['etag'] == new['etag']
+    if old.get('last_modified') and new.get('last_modified'):
+        return old['last_modified'] == new['last_modified']
+    return True
+
+def resume_headers(offset: int, validator: Dict[str, Any], end: Optional[int] = None) -> Dict[str, str]:
+    headers = {'Range': f"bytes={offset}-{'' if end is None else end}"}
+    if_range = validator.get('etag') or validator.get('last_modified')
+    if if_range:
+        headers['If-Range'] = if_range
+    return headers
+
+def resume_offset(file_path: str, checkpoint: Dict[str, Any]) -> int:
+    """Bytes of a .part file that can be kept when continuing as a single stream"""
+    if not checkpoint.get('validator'):
+        return 0
+    if checkpoint.get('mode') == 'segments':
+        return contiguous_bytes(checkpoint['segments'], checkpoint['progress'])
+    # Single streams only ever append flushed data, so the file size is exact.
+    return os.path.getsize(file_path)
+
+async def stream_to_file(chunks: AsyncIterator[bytes], file_path: str, transfer: Optional[Dict[str, Any]] = None,
+                         offset: int = 0, checkpoint: Optional[Dict[str, Any]] = None) -> int:
+    """Write an async byte stream to disk starting at offset, buffering at most
+    DOWNLOAD_BUFFER_SIZE bytes and checkpointing progress when a sidecar is given.
+    The caller holds a download_buffer_semaphore slot from before the stream was opened."""
+    written = offset
+    buffer = bytearray()
+    last_checkpoint = time.time()
+    async with aiofiles.open(file_path, 'r+b' if offset and os.path.exists(file_path) else 'wb') as f:
+        await f.truncate(offset)
+        await f.seek(offset)
+        if transfer is not None:
+            await publish_transfer(transfer, path=file_path, written=offset, attempt=transfer['attempt'] + 1)
+        async for chunk in chunks:
+            buffer += chunk
+            if len(buffer) >= DOWNLOAD_BUFFER_SIZE:
+                with timed("apk_stage_seconds", stage="disk_write"):
+                    await f.write(bytes(buffer))
+                    await f.flush()
+                written += len(buffer)
+                buffer.clear()
+                await publish_transfer(transfer, written=written)
+                if checkpoint is not None and time.time() - last_checkpoint >= 1:
+                    checkpoint['received'] = written
+                    save_checkpoint(file_path, checkpoint)
+                    last_checkpoint = time.time()
+        if buffer:
+            with timed("apk_stage_seconds", stage="disk_write"):
+                await f.write(bytes(buffer))
+                await f.flush()
+            written += len(buffer)
+            await publish_transfer(transfer, written=written)
+    if checkpoint is not None:
+        checkpoint['received'] = written
+        save_checkpoint(file_path, checkpoint)
+    return written
+
+def is_probably_html(content_type: str, content_length: int) -> bool:
+    """APKPure sometimes labels real files as HTML; only small HTML bodies are rejected"""
+    return 'html' in content_type.lower() and content_length < 500000
+
+async def open_download(download_url: str, headers: Dict[str, str], offset: int, checkpoint: Dict[str, Any], chrome_ver: str) -> Optional[tuple]:
+    """Start a streamed GET with one profile; returns (profile, response, start, validator)
+    once headers show a usable body, or None after closing an unusable response"""
+    session = get_curl_session(chrome_ver)
+    response = await upstream_request(download_url, lambda: session.get(download_url, headers=headers, timeout=300,
+                                                                       allow_redirects=True, stream=True,
+                                                                       max_recv_speed=DOWNLOAD_MAX_RECV_SPEED))
+    validator = response_validator(response.headers)
+    if response.status_code == 206 and offset and same_validator(checkpoint['validator'], validator):
+        start = offset
+    elif response.status_code == 200:
+        start = 0
+    else:
+        print(f"[curl-cffi] {chrome_ver} returned {response.status_code}", file=sys.stderr)
+        await response.aclose()
+        return None
     
-    for chrome_ver in chrome_versions:
+    content_type = response.headers.get('Content-Type', '')
+    content_length = int(response.headers.get('Content-Length') or 0)
+    if not start and content_length and is_probably_html(content_type, content_length):
+        print(f"[curl-cffi] {chrome_ver} returned HTML", file=sys.stderr)
+        await response.aclose()
+        return None
+    return (chrome_ver, response, start, validator)
+
+def note_served_version(transfer: Optional[Dict[str, Any]], headers):
+    """Remember the version upstream actually sent, which a stale resolution may not know"""
+    version = version_from_headers(headers)
+    if transfer is not None and version:
+        transfer['served_version'] = version
+
+async def close_download(opened: tuple):
+    await opened[1].aclose()
+
+async def download_with_curl_cffi(download_url: str, file_path: str, package_name: str, transfer: Optional[Dict[str, Any]] = None) -> bool:
+    """Stream file to disk using curl-cffi to bypass CloudFlare. Profiles are raced on
+    time-to-headers, and a checkpointed .part file is continued with a Range request"""
+    for _ in CURL_IMPERSONATE_PROFILES:
         try:
-            print(f"[curl-cffi] Downloading {package_name} with {chrome_ver}...", file=sys.stderr)
-            response = curl_requests.get(
-                download_url,
-                impersonate=chrome_ver,
-                timeout=300,
-                allow_redirects=True
-            )
-            
-            if response.status_code == 200:
-                content_type = response.headers.get('Content-Type', '')
-                if 'html' not in content_type.lower() or len(response.content) > 500000:
-                    with open(file_path, 'wb') as f:
-                        f.write(response.content)
-                    file_size = os.path.getsize(file_path)
-                    print(f"[curl-cffi] Downloaded {package_name}: {file_size / 1024 / 1024:.2f} MB", file=sys.stderr)
-                    return True
+            checkpoint = load_checkpoint(file_path)
+            offset = resume_offset(file_path, checkpoint)
+            headers = resume_headers(offset, checkpoint['validator']) if offset else {}
             
-            print(f"[curl-cffi] {chrome_ver} returned {response.status_code}", file=sys.stderr)
+            print(f"[curl-cffi] Downloading {package_name}" + (f" from byte {offset}" if offset else "") + "...", file=sys.stderr)
+            async with download_buffer_semaphore:
+                opened = await hedged_race(
+                    lambda chrome_ver: open_download(download_url, headers, offset, checkpoint, chrome_ver),
+                    f"download {package_name}",
+                    discard=close_download
+                )
+                if opened is None:
+                    return False
+                
+                chrome_ver, response, start, validator = opened
+                note_served_version(transfer, response.headers)
+                try:
+                    if start:
+                        print(f"[Resume] {package_name}: continuing at {start / 1024 / 1024:.2f} MB with {chrome_ver}", file=sys.stderr)
+                        stats["resumed_downloads"] += 1
+                    
+                    content_type = response.headers.get('Content-Type', '')
+                    checkpoint = {'mode': 'stream', 'url': download_url, 'validator': validator, 'received': start}
+                    save_checkpoint(file_path, checkpoint)
+                    file_size = await stream_to_file(response.aiter_content(), file_path, transfer, start, checkpoint)
+                    if not is_probably_html(content_type, file_size):
+                        print(f"[curl-cffi] Downloaded {package_name} with {chrome_ver}: {file_size / 1024 / 1024:.2f} MB", file=sys.stderr)
+                        return True
+                    discard_partial(file_path)
+                    return False
+                finally:
+                    await response.aclose()
             
         except Exception as e:
-            print(f"[curl-cffi] {chrome_ver} failed: {e}", file=sys.stderr)
+            # The .part file and its checkpoint are kept so the next round resumes.
+            print(f"[curl-cffi] {package_name} transfer failed: {e}", file=sys.stderr)
             continue
     
     return False
 
-async def download_file_to_cache(package_name: str, download_url: str, file_type: str) -> Optional[str]:
-    lock = get_download_lock(package_name)
+def plan_segments(total_size: int) -> list:
+    count = min(DOWNLOAD_SEGMENTS, total_size // MIN_SEGMENT_SIZE)
+    if count < 2:
+        return []
+    step = total_size // count
+    return [[i * step, total_size - 1 if i == count - 1 else (i + 1) * step - 1] for i in range(count)]
+
+def contiguous_bytes(segments: list, progress: list) -> int:
+    """Length of the fully written prefix, which is what growing-file readers may see"""
+    total = 0
+    for (start, end), done in zip(segments, progress):
+        total += done
+        if done < end - start + 1:
+            break
+    return total
+
+async def download_segmented(download_url: str, file_path: str, package_name: str, total_size: int, transfer: Optional[Dict[str, Any]] = None) -> bool:
+    """Fetch byte ranges concurrently into a preallocated file with positional writes.
+    Each segment retries from where it stopped and per-segment progress is
+    checkpointed, so a restart continues every segment; any unrecoverable
+    segment fails the whole attempt so the caller can fall back to a single stream."""
+    segments = plan_segments(total_size)
+    if not segments:
+        return False
     
-    async with lock:
-        cache_key = f"{package_name}_{hashlib.md5(download_url.encode()).hexdigest()[:8]}"
-        
-        if cache_key in file_cache:
-            cached_info = file_cache[cache_key]
-            if os.path.exists(cached_info['file_path']):
-                if cache_key in pending_deletions:
-                    pending_deletions[cache_key].cancel()
-                    del pending_deletions[cache_key]
-                
-                deletion_task = asyncio.create_task(schedule_file_deletion(cached_info['file_path'], 30))
-                pending_deletions[cache_key] = deletion_task
-                
-                return cached_info['file_path']
-        
-        file_id = generate_user_file_id(package_name)
-        file_path = os.path.join(DOWNLOADS_DIR, f"{file_id}.{file_type}")
-        
-        async with download_semaphore:
-            stats["active_downloads"] += 1
+    checkpoint = load_checkpoint(file_path)
+    if checkpoint.get('mode') == 'stream' and resume_offset(file_path, checkpoint):
+        return False
+    if (checkpoint.get('mode') == 'segments' and checkpoint.get('segments') == segments
+            and checkpoint['validator'].get('size') == total_size):
+        progress = checkpoint['progress']
+        print(f"[Resume] {package_name}: continuing {len(segments)} segments at {sum(progress) / 1024 / 1024:.2f} MB", file=sys.stderr)
+        stats["resumed_downloads"] += 1
+    else:
+        progress = [0] * len(segments)
+        checkpoint = {'mode': 'segments', 'url': download_url, 'validator': {'size': total_size},
+                      'segments': segments, 'progress': progress}
+        with open(file_path, 'wb') as f:
+            f.truncate(total_size)
+        save_checkpoint(file_path, checkpoint)
+    
+    session = get_curl_session(ranked_profiles()[0])
+    fd = os.open(file_path, os.O_WRONLY)
+    await publish_transfer(transfer, path=file_path, written=contiguous_bytes(segments, progress),
+                           attempt=transfer['attempt'] + 1 if transfer else 0)
+    last_checkpoint = [time.time()]
+    
+    async def record(index: int, written: int):
+        progress[index] = written
+        await publish_transfer(transfer, written=contiguous_bytes(segments, progress))
+        if time.time() - last_checkpoint[0] >= 1:
+            save_checkpoint(file_path, checkpoint)
+            last_checkpoint[0] = time.time()
+    
+    async def fetch_segment(index: int, start: int, end: int):
+        for attempt in range(SEGMENT_RETRIES):
+            offset = start + progress[index]
+            if offset > end:
+                return
             try:
-                loop = asyncio.get_event_loop()
-                success = await loop.run_in_executor(
-                    None, 
-                    download_with_curl_cffi, 
-                    download_url, 
-                    file_path, 
-                    package_name
-                )
-                
-                if not success:
-                    print(f"[Download] curl-cffi failed, trying httpx...", file=sys.stderr)
-                    async with httpx.AsyncClient(timeout=httpx.Timeout(300.0, connect=30.0), follow_redirects=True) as client:
-                        async with client.stream("GET", download_url, headers=get_headers()) as response:
-                            if response.status_code != 200:
-                                raise HTTPException(status_code=response.status_code, detail="Download failed")
-                            
-                            content_type = response.headers.get('Content-Type', '')
-                            if 'html' in content_type.lower():
-                                content = await response.aread()
-                                if len(content) < 500000:
-                                    raise HTTPException(status_code=400, detail="Got HTML instead of file")
-                                async with aiofiles.open(file_path, 'wb') as f:
-                                    await f.write(content)
-                            else:
-                                async with aiofiles.open(file_path, 'wb') as f:
-                                    async for chunk in response.aiter_bytes(chunk_size=131072):
-                                        await f.write(chunk)
-                
-                file_size = os.path.getsize(file_path)
-                
-                file_cache[cache_key] = {
-                    'file_path': file_path,
-                    'file_type': file_type,
-                    'size': file_size,
-                    'created_at': time.time()
-                }
-                stats["cached_files"] += 1
-                stats["downloads"] += 1
-                
-                deletion_task = asyncio.create_task(schedule_file_deletion(file_path, 30))
-                pending_deletions[cache_key] = deletion_task
-                
-                print(f"[Download] {package_name}: {file_size / 1024 / 1024:.2f} MB saved to cache", file=sys.stderr)
-                return file_path
+                async with download_buffer_semaphore:
+                    response = await upstream_request(download_url, lambda: session.get(
+                        download_url,
+                        headers=resume_headers(offset, checkpoint['validator'], end),
+                        timeout=300,
+                        allow_redirects=True,
+                        stream=True,
+                        max_recv_speed=DOWNLOAD_MAX_RECV_SPEED
+                    ))
+                    try:
+                        if response.status_code != 206:
+                            raise RuntimeError(f"expected 206, got {response.status_code}")
+                        validator = response_validator(response.headers)
+                        if not same_validator(checkpoint['validator'], validator):
+                            raise RuntimeError(f"upstream file changed ({validator})")
+                        checkpoint['validator'].update({k: v for k, v in validator.items() if v})
+                        note_served_version(transfer, response.headers)
+                        
+                        buffer = bytearray()
+                        async for chunk in response.aiter_content():
+                            buffer += chunk
+                            if len(buffer) >= DOWNLOAD_BUFFER_SIZE:
+                                with timed("apk_stage_seconds", stage="disk_write"):
+                                    await in_executor(os.pwrite, fd, bytes(buffer), offset)
+                                offset += len(buffer)
+                                buffer.clear()
+                                await record(index, offset - start)
+                        if buffer:
+                            with timed("apk_stage_seconds", stage="disk_write"):
+                                await in_executor(os.pwrite, fd, bytes(buffer), offset)
+                            offset += len(buffer)
+                            await record(index, offset - start)
+                    finally:
+                        await response.aclose()
                 
+                if offset > end:
+                    return
+                raise RuntimeError(f"segment ended early at {offset}/{end + 1}")
             except Exception as e:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                raise e
-            finally:
-                stats["active_downloads"] -= 1
+                print(f"[Segmented] {package_name} segment {index} attempt {attempt + 1} failed: {e}", file=sys.stderr)
+        raise RuntimeError(f"segment {index} failed after {SEGMENT_RETRIES} attempts")
+    
+    tasks = [asyncio.create_task(fetch_segment(i, start, end)) for i, (start, end) in enumerate(segments)]
+    try:
+        print(f"[Segmented] Downloading {package_name} in {len(segments)} segments", file=sys.stderr)
+        await asyncio.gather(*tasks)
+        print(f"[Segmented] Downloaded {package_name}: {total_size / 1024 / 1024:.2f} MB", file=sys.stderr)
+        return True
+    except Exception as e:
+        print(f"[Segmented] {package_name} falling back to single stream: {e}", file=sys.stderr)
+        return False
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        os.close(fd)
+        save_checkpoint(file_path, checkpoint)
+
+# In-flight downloads keyed like file_cache. Readers tail the partial file as
+# it grows (see iter_growing_file) so they need not wait for the whole fetch.
+active_transfers: Dict[str, Dict[str, Any]] = {}
+
+def get_or_start_transfer(package_name: str, download_url: str, file_type: str, version: Optional[str] = None, expected_size: int = 0,
+                          accept_ranges: bool = False, validator: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    key = store_key(package_name, version)
+    transfer = active_transfers.get(key)
+    if transfer is None:
+        transfer = new_transfer(expected_size, accept_ranges, validator)
+        active_transfers[key] = transfer
+        task = asyncio.create_task(run_transfer(key, transfer, package_name, download_url, file_type, version))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        transfer['task'] = task
+    return transfer
+
+async def run_transfer(key: str, transfer: Dict[str, Any], package_name: str, download_url: str, file_type: str, version: Optional[str]) -> Dict[str, Any]:
+    lock = get_download_lock(package_name)
+    
+    try:
+        # The asyncio lock orders requests inside this worker; the file lock keeps
+        # other workers from fetching the same package at the same time.
+        async with lock, cross_process_lock(key):
+            cached_entry = lookup_store(package_name, version)
+            if cached_entry:
+                stats["file_cache_hits"] += 1
+                print(f"[Store Hit] {package_name} ({cached_entry['sha256'][:12]})", file=sys.stderr)
+                await publish_transfer(transfer, path=cached_entry['file_path'], written=cached_entry['size'],
+                                       attempt=transfer['attempt'] + 1, entry=cached_entry, done=True)
+                return cached_entry
+            
+            file_path = partial_path(package_name, version, file_type)
+            
+            queued = time.perf_counter()
+            async with download_semaphore:
+                started = time.perf_counter()
+                observe("apk_queue_wait_seconds", started - queued, queue="download")
+                stats["active_downloads"] += 1
+                transfer['stage'] = 'downloading'
+                try:
+                    success = False
+                    method = "segmented"
+                    if SEGMENTED_DOWNLOADS and transfer['accept_ranges'] and transfer['expected_size']:
+                        success = await download_segmented(download_url, file_path, package_name, transfer['expected_size'], transfer)
+                    if not success:
+                        method = "curl"
+                        success = await download_with_curl_cffi(download_url, file_path, package_name, transfer)
+                    
+                    if not success:
+                        method = "httpx"
+                        print(f"[Download] curl-cffi failed, trying httpx...", file=sys.stderr)
+                        discard_partial(file_path)
+                        client = get_client()
+                        request = client.build_request("GET", download_url, headers=get_headers(),
+                                                       timeout=httpx.Timeout(300.0, connect=30.0))
+                        async with download_buffer_semaphore:
+                            response = await upstream_request(download_url, lambda: client.send(request, stream=True))
+                            try:
+                                if response.status_code != 200:
+                                    raise HTTPException(status_code=response.status_code, detail="Download failed")
+                                note_served_version(transfer, response.headers)
+                                
+                                content_type = response.headers.get('Content-Type', '')
+                                file_size = await stream_to_file(response.aiter_bytes(chunk_size=131072), file_path, transfer)
+                                if is_probably_html(content_type, file_size):
+                                    discard_partial(file_path)
+                                    raise HTTPException(status_code=400, detail="Got HTML instead of file")
+                            finally:
+                                await response.aclose()
+                    
+                    elapsed = time.perf_counter() - started
+                    observe("apk_stage_seconds", elapsed, stage="download", method=method)
+                    size = os.path.getsize(file_path)
+                    observe("apk_download_throughput_bytes_per_second", size / max(elapsed, 1e-6), method=method)
+                    download_bytes_total[method] += size
+                    
+                    transfer['stage'] = 'verifying'
+                    try:
+                        with timed("apk_stage_seconds", stage="verify"):
+                            metadata = await in_executor(inspect_package, file_path)
+                    except InvalidPackage as e:
+                        # Never resume from or serve a corrupt file; start over next time.
+                        stats["invalid_downloads"] += 1
+                        discard_partial(file_path)
+                        raise RuntimeError(f"Downloaded file failed verification: {e}")
+                    if metadata.get('manifest_package') not in (None, package_name):
+                        print(f"[Verify] {package_name}: archive declares {metadata['manifest_package']}", file=sys.stderr)
+                    sha256 = metadata['sha256']
+                    served = transfer.get('served_version')
+                    if version and served and served != version:
+                        # A stale resolution fetched a newer build through ?version=latest:
+                        # store it under the version it really is and let the next
+                        # request resolve again instead of looking for the old one.
+                        print(f"[Download] {package_name}: resolved {version}, upstream sent {served}", file=sys.stderr)
+                        forget_resolution(package_name, version)
+                        version = served
+                    entry = await in_executor(commit_to_store, package_name, version, metadata['file_type'], file_path,
+                                              sha256, metadata, {'url': download_url, **transfer['validator']})
+                    discard_partial(file_path)
+                    stats["downloads"] += 1
+                    
+                    await publish_transfer(transfer, path=entry['file_path'], written=entry['size'],
+                                           attempt=transfer['attempt'] + 1, entry=entry, done=True)
+                    print(f"[Download] {package_name}: {entry['size'] / 1024 / 1024:.2f} MB saved to store ({sha256[:12]})", file=sys.stderr)
+                    return entry
+                    
+                finally:
+                    # A failed transfer leaves its .part file and checkpoint behind so
+                    # the next attempt, even after a restart, can resume it.
+                    stats["active_downloads"] -= 1
+    except BaseException as e:
+        await publish_transfer(transfer, error=str(e) or type(e).__name__, done=True)
+        raise
+    finally:
+        if active_transfers.get(key) is transfer:
+            del active_transfers[key]
+
+async def download_file_to_cache(package_name: str, download_url: str, file_type: str, version: Optional[str] = None,
+                                 expected_size: int = 0, accept_ranges: bool = False,
+                                 validator: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    transfer = get_or_start_transfer(package_name, download_url, file_type, version, expected_size, accept_ranges, validator)
+    # Shielded so a disconnecting client does not abort a download others share.
+    return await asyncio.shield(transfer['task'])
+
+async def iter_growing_file(transfer: Dict[str, Any], chunk_size: int = 262144) -> AsyncIterator[bytes]:
+    """Yield a transfer's bytes as they land on disk, following it to the final blob.
+    An open descriptor keeps the data readable even if the file is renamed or evicted.
+    Bytes beyond the announced size are never sent: the stream fails as soon as
+    upstream turns out to be larger, e.g. after a release the stale resolution missed."""
+    position = 0
+    opened_attempt = None
+    expected = transfer['expected_size']
+    f = None
+    try:
+        while True:
+            async with transfer['cond']:
+                while not transfer['done'] and transfer['written'] <= position:
+                    await transfer['cond'].wait()
+                if transfer['error']:
+                    raise RuntimeError(f"Upstream download failed: {transfer['error']}")
+                available = transfer['written']
+                attempt = transfer['attempt']
+                path = transfer['path']
+                done = transfer['done']
+            
+            if expected and available > expected:
+                raise RuntimeError(f"Size mismatch: announced {expected}, upstream sent at least {available}")
+            if done and position >= available:
+                if expected and position != expected:
+                    raise RuntimeError(f"Size mismatch: announced {expected}, got {position}")
+                break
+            
+            if attempt != opened_attempt:
+                if f is not None:
+                    await f.close()
+                f = await aiofiles.open(path, 'rb')
+                opened_attempt = attempt
+            
+            await f.seek(position)
+            data = await f.read(min(chunk_size, available - position))
+            if not data:
+                continue
+            await consume_bandwidth(len(data))
+            position += len(data)
+            yield data
+    finally:
+        if f is not None:
+            await f.close()
+
+def user_key(user_id: Optional[str], request: Request) -> str:
+    if user_id:
+        return user_id
+    return f"ip:{request.client.host}" if request.client else "anonymous"
+
+def request_cost(package_name: str) -> float:
+    cached = url_cache.get(package_name)
+    size = int(cached[0].get('size') or 0) if cached else 0
+    return max(1.0, size / (1024 * 1024))
+
+def queue_position(ticket: Dict[str, Any]) -> int:
+    return 1 + sum(1 for other in scheduler['waiting'] if other['tag'] < ticket['tag'])
+
+def retry_after() -> int:
+    backlog = len(scheduler['waiting']) + 1
+    return max(1, int(scheduler['service_ewma'] * backlog / DOWNLOAD_SLOTS + 0.5))
+
+def start_ticket(ticket: Dict[str, Any]):
+    scheduler['active'] += 1
+    user_downloads[ticket['user']].add(ticket['id'])
+    ticket['started_at'] = time.monotonic()
+
+def dispatch_waiting():
+    """Hand free slots to the waiting tickets with the smallest finish tags,
+    skipping users who are already at their concurrency cap"""
+    while scheduler['active'] < DOWNLOAD_SLOTS:
+        eligible = [t for t in scheduler['waiting'] if len(user_downloads.get(t['user'], ())) < USER_MAX_ACTIVE]
+        if not eligible:
+            return
+        ticket = min(eligible, key=lambda t: t['tag'])
+        scheduler['waiting'].remove(ticket)
+        if ticket['future'].done():
+            # Cancelled earlier in this loop turn, before wait_for_slot could dequeue it.
+            forget_finish_tag(ticket['user'])
+            continue
+        scheduler['virtual_time'] = max(scheduler['virtual_time'], ticket['tag'])
+        start_ticket(ticket)
+        ticket['future'].set_result(None)
+
+def enqueue_download(user: str, package_name: str) -> Dict[str, Any]:
+    """Take a free slot or join the fair queue; raises 429 when the queue is too deep"""
+    ticket = {'id': generate_user_file_id(package_name, user), 'user': user, 'package_name': package_name,
+              'queued_at': time.monotonic(), 'future': None}
+    # dispatch_waiting leaves no eligible ticket behind a free slot, so a user
+    # under the cap may take a free slot without queueing.
+    if scheduler['active'] < DOWNLOAD_SLOTS and len(user_downloads.get(user, ())) < USER_MAX_ACTIVE:
+        start_ticket(ticket)
+        ticket['position'] = 0
+        return ticket
+    
+    queued = sum(1 for t in scheduler['waiting'] if t['user'] == user)
+    if queued >= USER_MAX_QUEUED or len(scheduler['waiting']) >= DOWNLOAD_QUEUE_MAX:
+        stats["admission_rejections"] += 1
+        raise HTTPException(status_code=429, detail="Too many downloads queued, retry later",
+                            headers={"Retry-After": str(retry_after())})
+    
+    weight = USER_WEIGHTS.get(user, 1.0)
+    start = max(scheduler['virtual_time'], user_finish_tags.get(user, 0.0))
+    ticket['tag'] = user_finish_tags[user] = start + request_cost(package_name) / weight
+    ticket['future'] = asyncio.get_event_loop().create_future()
+    scheduler['waiting'].append(ticket)
+    ticket['position'] = queue_position(ticket)
+    stats["queued_downloads"] += 1
+    dispatch_waiting()
+    return ticket
+
+async def wait_for_slot(ticket: Dict[str, Any]) -> Dict[str, Any]:
+    if ticket['future'] is None:
+        return ticket
+    try:
+        await ticket['future']
+    except asyncio.CancelledError:
+        # The client went away while queued, or just as its slot was granted.
+        if ticket in scheduler['waiting']:
+            scheduler['waiting'].remove(ticket)
+            forget_finish_tag(ticket['user'])
+        else:
+            release_download(ticket)
+        raise
+    observe("apk_queue_wait_seconds", time.monotonic() - ticket['queued_at'], queue="admission")
+    return ticket
+
+async def admit_download(user: str, package_name: str) -> Dict[str, Any]:
+    """Wait for a download slot, or raise 429 when the queue is too deep"""
+    return await wait_for_slot(enqueue_download(user, package_name))
+
+def forget_finish_tag(user: str, waiting_users: Optional[Set[str]] = None):
+    """Drop a user's finish tag once virtual time has passed it and the user has
+    nothing active or queued; a new request would start at virtual time anyway"""
+    tag = user_finish_tags.get(user)
+    if tag is None or tag > scheduler['virtual_time'] or user in user_downloads:
+        return
+    if waiting_users is None:
+        waiting_users = {t['user'] for t in scheduler['waiting']}
+    if user not in waiting_users:
+        del user_finish_tags[user]
+
+def prune_finish_tags():
+    waiting_users = {t['user'] for t in scheduler['waiting']}
+    for user in list(user_finish_tags):
+        forget_finish_tag(user, waiting_users)
+
+def release_download(ticket: Dict[str, Any]):
+    """Free a ticket's slot and hand it on. Called from finally blocks and
+    after-response callbacks, so it never raises."""
+    if ticket['id'] not in user_downloads.get(ticket['user'], ()):
+        return
+    user_downloads[ticket['user']].discard(ticket['id'])
+    if not user_downloads[ticket['user']]:
+        del user_downloads[ticket['user']]
+        forget_finish_tag(ticket['user'])
+    scheduler['active'] -= 1
+    held = time.monotonic() - ticket['started_at']
+    scheduler['service_ewma'] = 0.9 * scheduler['service_ewma'] + 0.1 * held
+    try:
+        dispatch_waiting()
+    except Exception as e:
+        print(f"[Scheduler] Dispatch after release failed: {e}", file=sys.stderr)
+
+def scheduler_state() -> Dict[str, Any]:
+    return {
+        "active": scheduler['active'],
+        "slots": DOWNLOAD_SLOTS,
+        "waiting": len(scheduler['waiting']),
+        "active_users": len(user_downloads),
+        "estimated_wait": retry_after() if scheduler['waiting'] else 0,
+        "bandwidth_limit": DOWNLOAD_BANDWIDTH
+    }
+
+async def consume_bandwidth(size: int):
+    """Global token bucket with one second of burst. Tokens may go negative, so
+    concurrent senders are paced in the order they asked."""
+    if not DOWNLOAD_BANDWIDTH:
+        return
+    now = time.monotonic()
+    tokens = bandwidth_bucket['tokens'] + (now - bandwidth_bucket['updated']) * DOWNLOAD_BANDWIDTH
+    bandwidth_bucket['tokens'] = min(float(DOWNLOAD_BANDWIDTH), tokens) - size
+    bandwidth_bucket['updated'] = now
+    if bandwidth_bucket['tokens'] < 0:
+        await asyncio.sleep(-bandwidth_bucket['tokens'] / DOWNLOAD_BANDWIDTH)
+
+async def iter_file_paced(file_path: str, chunk_size: int = 262144) -> AsyncIterator[bytes]:
+    async with aiofiles.open(file_path, 'rb') as f:
+        while True:
+            data = await f.read(chunk_size)
+            if not data:
+                break
+            await consume_bandwidth(len(data))
+            yield data
+
+@app.get("/queue")
+async def get_queue(request: Request, user_id: Optional[str] = None) -> Dict[str, Any]:
+    """Scheduler state plus the caller's active downloads and queue positions"""
+    user = user_key(user_id, request)
+    return {
+        **scheduler_state(),
+        "user": user,
+        "user_active": len(user_downloads.get(user, ())),
+        "user_queued": [
+            {"package_name": t['package_name'], "position": queue_position(t),
+             "waiting_for": round(time.monotonic() - t['queued_at'], 1)}
+            for t in scheduler['waiting'] if t['user'] == user
+        ]
+    }
+
+def entity_tag(entry: Dict[str, Any]) -> str:
+    return f'"{entry["sha256"]}"'
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """If-None-Match comparison; weak tags match too since blobs are content-addressed"""
+    if not header:
+        return False
+    tags = (tag.strip() for tag in header.split(','))
+    return any(tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+
+def file_headers(entry: Dict[str, Any], source: Any, filename: str) -> Dict[str, str]:
+    return {
+        "ETag": entity_tag(entry),
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "X-Source": str(source or 'apkpure'),
+        "X-File-Type": entry['file_type'],
+        "X-File-Size": str(entry['size']),
+        "X-Content-SHA256": entry['sha256'],
+        # Clients revalidate with If-None-Match and get 304 while the content is unchanged.
+        "Cache-Control": "no-cache"
+    }
+
+def not_modified(request: Request, entry: Dict[str, Any]) -> Optional[Response]:
+    if not etag_matches(request.headers.get('if-none-match'), entity_tag(entry)):
+        return None
+    stats["not_modified"] += 1
+    return Response(status_code=304, headers={"ETag": entity_tag(entry), "Cache-Control": "no-cache"})
+
+def serve_store_entry(request: Request, entry: Dict[str, Any], source: Any, filename: str,
+                      extra_headers: Dict[str, str]) -> Response:
+    # Pin the blob until the response body has been fully sent so eviction
+    # cannot unlink it from under the reader.
+    serve_path = acquire_file(entry)
+    on_response_done(request, release_file, serve_path)
+    headers = {**file_headers(entry, source, filename), **extra_headers}
+    if DOWNLOAD_BANDWIDTH:
+        # Paced bodies are always complete; ignoring Range is allowed by HTTP.
+        return StreamingResponse(
+            iter_file_paced(serve_path),
+            media_type="application/vnd.android.package-archive",
+            headers={**headers, "Accept-Ranges": "none", "Content-Length": str(entry['size'])}
+        )
+    # FileResponse answers Range and If-Range (checked against the ETag) and
+    # hands the path to the server when it supports http.response.pathsend.
+    response = FileResponse(
+        path=serve_path,
+        media_type="application/vnd.android.package-archive",
+        headers=headers
+    )
+    response.chunk_size = SERVE_CHUNK_SIZE
+    return response
+
+@app.head("/download/{package_name}")
+async def head_apk(package_name: str) -> Response:
+    """Metadata of the stored file, answered from the store index without upstream"""
+    entry = latest_store_entry(package_name)
+    if entry is None:
+        return Response(status_code=404, headers={"Cache-Control": "no-cache"})
+    filename = f"{package_name}.{entry['file_type']}"
+    return Response(
+        media_type="application/vnd.android.package-archive",
+        headers={**file_headers(entry, 'store', filename), "Content-Length": str(entry['size'])}
+    )
 
 @app.get("/download/{package_name}")
-async def download_apk(package_name: str, background_tasks: BackgroundTasks, user_id: Optional[str] = None):
+async def download_apk(package_name: str, request: Request, background_tasks: BackgroundTasks, user_id: Optional[str] = None):
+    ticket = await admit_download(user_key(user_id, request), package_name)
+    on_response_done(request, release_download, ticket)
+    started = time.perf_counter()
     try:
         info = await get_download_info(package_name)
         download_url = info['download_url']
         file_type = info.get('file_type', 'apk')
         
-        file_path = await download_file_to_cache(package_name, download_url, file_type)
-        
-        if not file_path or not os.path.exists(file_path):
-            raise HTTPException(status_code=500, detail="Failed to download file")
-        
         filename = f"{package_name}.{file_type}"
+        expected_size = int(info.get('size') or 0)
         
-        return FileResponse(
-            path=file_path,
-            filename=filename,
-            media_type="application/vnd.android.package-archive",
-            headers={
-                "X-Source": str(info.get('source', 'apkpure')),
-                "X-File-Type": file_type,
-                "X-File-Size": str(os.path.getsize(file_path)),
-                "Cache-Control": "no-cache"
-            }
-        )
+        entry = lookup_store(package_name, info.get('version'))
+        hit = entry is not None
+        record_file_request(package_name, info.get('version'), hit)
+        unchanged = not_modified(request, entry) if entry else None
+        if unchanged is not None:
+            record_event("download", package_name, "not_modified", ticket['user'], info.get('version'),
+                         entry['file_type'], duration=time.perf_counter() - started)
+            return unchanged
+        # Range requests need the complete file, so they wait instead of streaming.
+        if not entry and STREAM_WHILE_DOWNLOADING and expected_size > 0 and 'range' not in request.headers:
+            # Cache miss with a known size from the HEAD probe: start (or join) the
+            # upstream transfer and stream bytes to the client as they arrive.
+            transfer = get_or_start_transfer(package_name, download_url, file_type, info.get('version'),
+                                             expected_size, bool(info.get('accept_ranges')), info.get('validator'))
+            # A joined transfer started from another resolution may have another
+            # size, so this response's Content-Length could be wrong: wait instead.
+            if transfer['expected_size'] == expected_size:
+                stats["streamed_responses"] += 1
+                record_event("download", package_name, "miss", ticket['user'], info.get('version'), file_type,
+                             expected_size, time.perf_counter() - started)
+                return StreamingResponse(
+                    iter_growing_file(transfer),
+                    media_type="application/vnd.android.package-archive",
+                    headers={
+                        "Content-Length": str(expected_size),
+                        "Content-Disposition": f'attachment; filename="{filename}"',
+                        "X-Source": str(info.get('source', 'apkpure')),
+                        "X-File-Type": file_type,
+                        "X-File-Size": str(expected_size),
+                        "X-Queue-Position": str(ticket['position']),
+                        "Cache-Control": "no-cache"
+                    }
+                )
+            entry = await asyncio.shield(transfer['task'])
+        elif not entry:
+            entry = await download_file_to_cache(package_name, download_url, file_type, info.get('version'),
+                                                 expected_size, bool(info.get('accept_ranges')), info.get('validator'))
+        
+        if not entry or not os.path.exists(entry['file_path']):
+            raise HTTPException(status_code=500, detail="Failed to download file")
+        record_event("download", package_name, "hit" if hit else "miss", ticket['user'], info.get('version'),
+                     entry['file_type'], entry['size'], time.perf_counter() - started)
+        return serve_store_entry(request, entry, info.get('source'), f"{package_name}.{entry['file_type']}",
+                                 {"X-Queue-Position": str(ticket['position'])})
             
     except HTTPException:
+        record_event("download", package_name, "failed", ticket['user'], duration=time.perf_counter() - started)
         raise
     except Exception as e:
         print(f"[Error] {package_name}: {e}", file=sys.stderr)
-        raise HTTPException(status_code=500, detail=str(e))
+        record_event("download", package_name, "failed", ticket['user'], duration=time.perf_counter() - started)
+        raise http_error(e)
 
 @app.get("/file/{package_name}")
-async def get_cached_file(package_name: str):
+async def get_cached_file(package_name: str, request: Request, user_id: Optional[str] = None):
+    ticket = await admit_download(user_key(user_id, request), package_name)
+    on_response_done(request, release_download, ticket)
+    started = time.perf_counter()
     try:
         info = await get_download_info(package_name)
         download_url = info['download_url']
         file_type = info.get('file_type', 'apk')
         
-        file_path = await download_file_to_cache(package_name, download_url, file_type)
+        entry = lookup_store(package_name, info.get('version'))
+        hit = entry is not None
+        record_file_request(package_name, info.get('version'), hit)
+        if not entry:
+            entry = await download_file_to_cache(package_name, download_url, file_type, info.get('version'),
+                                                 int(info.get('size') or 0), bool(info.get('accept_ranges')),
+                                                 info.get('validator'))
         
-        if not file_path or not os.path.exists(file_path):
+        if not entry or not os.path.exists(entry['file_path']):
             raise HTTPException(status_code=500, detail="Failed to get file")
         
+        record_event("download", package_name, "hit" if hit else "miss", ticket['user'], info.get('version'),
+                     entry['file_type'], entry['size'], time.perf_counter() - started)
         return {
             "success": True,
-            "file_path": file_path,
+            "file_path": entry['file_path'],
             "file_type": file_type,
-            "size": os.path.getsize(file_path),
+            "size": entry['size'],
+            "sha256": entry['sha256'],
             "package_name": package_name,
             "source": info.get('source')
         }
             
     except HTTPException:
+        record_event("download", package_name, "failed", ticket['user'], duration=time.perf_counter() - started)
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        record_event("download", package_name, "failed", ticket['user'], duration=time.perf_counter() - started)
+        raise http_error(e)
 
-@app.delete("/cache")
-async def clear_cache():
-    global url_cache, file_cache
+def job_snapshot(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in job.items() if key not in ('cond', 'task')}
+
+def persist_job(job: Dict[str, Any]):
+    db_execute("INSERT OR REPLACE INTO jobs (job_id, state, updated_at) VALUES (?, ?, ?)",
+               (job['job_id'], json.dumps(job_snapshot(job)), job['updated_at']))
+
+async def update_job(job: Dict[str, Any], **changes):
+    """Apply a progress update, wake local long-polls and mirror it for other workers"""
+    async with job['cond']:
+        job.update(changes)
+        job['seq'] += 1
+        job['updated_at'] = time.time()
+        job['cond'].notify_all()
+    persist_job(job)
+
+def load_job(job_id: str) -> Optional[Dict[str, Any]]:
+    job = jobs.get(job_id)
+    if job is not None:
+        return job_snapshot(job)
+    row = db_query("SELECT state FROM jobs WHERE job_id = ?", (job_id,))
+    return json.loads(row[0]) if row else None
+
+async def wait_for_job(job_id: str, since: int, timeout: float) -> Optional[Dict[str, Any]]:
+    """Return the job's snapshot once its seq passes since, it has finished, or
+    timeout expires"""
+    deadline = time.monotonic() + timeout
+    while True:
+        snapshot = load_job(job_id)
+        remaining = deadline - time.monotonic()
+        if (snapshot is None or snapshot['seq'] > since or snapshot['stage'] in JOB_FINAL_STAGES
+                or remaining <= 0):
+            return snapshot
+        job = jobs.get(job_id)
+        if job is None:
+            # Another worker runs this job; its updates arrive through shared.db.
+            await asyncio.sleep(min(remaining, JOB_PROGRESS_INTERVAL))
+            continue
+        async with job['cond']:
+            if job['seq'] <= since:
+                try:
+                    await asyncio.wait_for(job['cond'].wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+async def follow(job: Dict[str, Any], task: asyncio.Future, progress: Callable[[], Dict[str, Any]]) -> Any:
+    """Await task, publishing whatever progress() reports every JOB_PROGRESS_INTERVAL"""
+    while not task.done():
+        await asyncio.wait({task}, timeout=JOB_PROGRESS_INTERVAL)
+        changes = progress()
+        if any(job.get(key) != value for key, value in changes.items()):
+            await update_job(job, **changes)
+    return task.result()
+
+async def follow_transfer(job: Dict[str, Any], transfer: Dict[str, Any]) -> Dict[str, Any]:
+    sample = {'bytes': transfer['written'], 'time': time.monotonic(), 'rate': 0.0}
+    
+    def progress() -> Dict[str, Any]:
+        now = time.monotonic()
+        written = transfer['written']
+        # A retry restarts the count, so negative deltas are not speed samples.
+        speed = max(0, written - sample['bytes']) / max(now - sample['time'], 1e-6)
+        sample['rate'] = speed if not sample['rate'] else 0.7 * sample['rate'] + 0.3 * speed
+        sample['bytes'], sample['time'] = written, now
+        total = transfer['expected_size']
+        rate = sample['rate']
+        return {
+            "stage": transfer['stage'],
+            "bytes": written,
+            "total": total,
+            "rate": round(rate),
+            "eta": round((total - written) / rate, 1) if rate and total > written else None
+        }
+    
+    return await follow(job, transfer['task'], progress)
+
+async def run_job(job: Dict[str, Any], ticket: Dict[str, Any]):
+    package_name = job['package_name']
+    try:
+        await follow(job, asyncio.ensure_future(wait_for_slot(ticket)),
+                     lambda: {"queue_position": queue_position(ticket)} if ticket in scheduler['waiting'] else {})
+        await update_job(job, stage="resolving", queue_position=0)
+        info = await get_download_info(package_name)
+        version = info.get('version')
+        await update_job(job, version=version, source=info.get('source'), file_type=info.get('file_type', 'apk'),
+                         total=int(info.get('size') or 0))
+        
+        entry = lookup_store(package_name, version)
+        hit = entry is not None
+        record_file_request(package_name, version, hit)
+        if not entry:
+            transfer = get_or_start_transfer(package_name, info['download_url'], info.get('file_type', 'apk'), version,
+                                             int(info.get('size') or 0), bool(info.get('accept_ranges')),
+                                             info.get('validator'))
+            entry = await follow_transfer(job, transfer)
+        
+        result = {
+            "stage": "done",
+            "file_type": entry['file_type'],
+            "bytes": entry['size'],
+            "total": entry['size'],
+            "eta": 0,
+            "sha256": entry['sha256'],
+            "version_code": entry.get('version_code'),
+            "version_name": entry.get('version_name')
+        }
+        stats["jobs_completed"] += 1
+        record_event("download", package_name, "hit" if hit else "miss", job['user'], version, entry['file_type'],
+                     entry['size'], time.time() - job['created_at'])
+    except Exception as e:
+        print(f"[Job] {job['job_id']} ({package_name}): {e}", file=sys.stderr)
+        result = {"stage": "failed", "error": str(e.detail if isinstance(e, HTTPException) else e) or type(e).__name__}
+        stats["jobs_failed"] += 1
+        record_event("download", package_name, "failed", job['user'], duration=time.time() - job['created_at'])
+    finally:
+        # Free the slot before announcing the result, so a client fetching the
+        # file right away is not queued behind its own job.
+        release_download(ticket)
+    await update_job(job, finished_at=time.time(), **result)
+
+def expire_jobs():
+    cutoff = time.time() - JOB_TTL
+    for job_id, job in list(jobs.items()):
+        if job['stage'] in JOB_FINAL_STAGES and job['updated_at'] < cutoff:
+            del jobs[job_id]
+    db_execute("DELETE FROM jobs WHERE updated_at < ?", (cutoff,))
+
+def job_links(snapshot: Dict[str, Any]) -> Dict[str, Any]:
+    job_id = snapshot['job_id']
+    return {**snapshot, "status_url": f"/jobs/{job_id}", "events_url": f"/jobs/{job_id}/events",
+            "file_url": f"/jobs/{job_id}/file"}
+
+@app.post("/jobs", status_code=202)
+async def create_job(request: Request, package_name: str = Body(..., embed=True),
+                     user_id: Optional[str] = Body(None, embed=True)) -> Dict[str, Any]:
+    """Start downloading a package into the store and return its job at once. A
+    user asking again for a package still in progress gets the running job."""
+    user = user_key(user_id, request)
+    for job in jobs.values():
+        if job['package_name'] == package_name and job['user'] == user and job['stage'] not in JOB_FINAL_STAGES:
+            return job_links(job_snapshot(job))
     
-    for task in pending_deletions.values():
-        task.cancel()
-    pending_deletions.clear()
+    ticket = enqueue_download(user, package_name)
+    now = time.time()
+    job = {
+        "job_id": uuid.uuid4().hex,
+        "package_name": package_name,
+        "user": user,
+        "stage": "queued",
+        "queue_position": ticket['position'],
+        "bytes": 0,
+        "total": 0,
+        "rate": 0,
+        "eta": None,
+        "version": None,
+        "source": None,
+        "file_type": None,
+        "error": None,
+        "seq": 0,
+        "created_at": now,
+        "updated_at": now,
+        "finished_at": None,
+        "cond": asyncio.Condition()
+    }
+    jobs[job['job_id']] = job
+    persist_job(job)
+    job['task'] = asyncio.create_task(run_job(job, ticket))
+    stats["jobs_created"] += 1
+    return job_links(job_snapshot(job))
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0, since: int = -1) -> Dict[str, Any]:
+    """Job progress. With wait, long-polls up to that many seconds for an update
+    newer than seq since."""
+    snapshot = await wait_for_job(job_id, since, min(max(wait, 0), JOB_MAX_WAIT))
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return snapshot
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str, request: Request) -> StreamingResponse:
+    """Server-Sent Events: a progress event per update, then done or failed"""
+    if load_job(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def events() -> AsyncIterator[bytes]:
+        since = int(request.headers.get('last-event-id') or -1)
+        while True:
+            snapshot = await wait_for_job(job_id, since, JOB_KEEPALIVE)
+            if snapshot is None:
+                return
+            if snapshot['seq'] <= since and snapshot['stage'] not in JOB_FINAL_STAGES:
+                yield b": keepalive\n\n"
+                continue
+            since = snapshot['seq']
+            final = snapshot['stage'] in JOB_FINAL_STAGES
+            yield f"id: {since}\nevent: {snapshot['stage'] if final else 'progress'}\ndata: {json.dumps(snapshot)}\n\n".encode()
+            if final:
+                return
+    
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/jobs/{job_id}/file")
+async def get_job_file(job_id: str, request: Request):
+    """The finished job's file from the store, with ETag and Range support"""
+    snapshot = load_job(job_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if snapshot['stage'] == 'failed':
+        raise HTTPException(status_code=409, detail=f"Job failed: {snapshot['error']}")
+    if snapshot['stage'] != 'done':
+        raise HTTPException(status_code=409, detail=f"Job is still {snapshot['stage']}",
+                            headers={"Retry-After": str(int(snapshot['eta'] or 1) + 1)})
     
-    for filename in os.listdir(DOWNLOADS_DIR):
+    package_name = snapshot['package_name']
+    entry = lookup_store(package_name, snapshot['version'])
+    if entry is None:
+        raise HTTPException(status_code=410, detail="File is no longer in the store")
+    unchanged = not_modified(request, entry)
+    if unchanged is not None:
+        return unchanged
+    
+    ticket = await admit_download(snapshot['user'], package_name)
+    on_response_done(request, release_download, ticket)
+    return serve_store_entry(request, entry, snapshot['source'], f"{package_name}.{entry['file_type']}",
+                             {"X-Job-Id": job_id, "X-Queue-Position": str(ticket['position'])})
+
+def record_file_request(package_name: str, version: Optional[str], hit: bool):
+    stats["file_requests"] += 1
+    if hit:
+        stats["file_cache_hits"] += 1
+        if store_key(package_name, version) in prefetched_keys:
+            stats["prefetch_hits"] += 1
+
+def top_packages_from_postgres(limit: int) -> list:
+    conn = psycopg2.connect(DATABASE_URL, connect_timeout=5)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT app_id, COUNT(*) AS n FROM downloads "
+                "WHERE downloaded_at > NOW() - make_interval(days => %s) "
+                "GROUP BY app_id ORDER BY n DESC LIMIT %s",
+                (PREFETCH_LOOKBACK_DAYS, limit)
+            )
+            return [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+async def top_packages(limit: int) -> list:
+    """Most requested packages, from the bot's downloads table when Postgres is
+    configured, otherwise from this server's own request log"""
+    if psycopg2 is not None and DATABASE_URL:
         try:
-            os.remove(os.path.join(DOWNLOADS_DIR, filename))
-        except:
-            pass
+            return await in_executor(top_packages_from_postgres, limit)
+        except Exception as e:
+            print(f"[Prefetch] Postgres unavailable, using request log: {e}", file=sys.stderr)
+    
+    flush_request_log()
+    await settle_db_writes()
+    rows = db_query_all(
+        "SELECT package_name, SUM(count) FROM package_requests WHERE day >= date('now', ?) "
+        "GROUP BY package_name ORDER BY 2 DESC LIMIT ?",
+        (f"-{PREFETCH_LOOKBACK_DAYS} days", limit)
+    )
+    return [row[0] for row in rows]
+
+async def run_prefetch(packages: list, max_bytes: int = 0, concurrency: int = 0, max_rate: int = 0) -> Dict[str, Any]:
+    """Resolve and download packages into the store within a byte, rate and concurrency budget"""
+    max_bytes = max_bytes or PREFETCH_MAX_BYTES
+    max_rate = max_rate or PREFETCH_MAX_RATE
+    semaphore = asyncio.Semaphore(concurrency or PREFETCH_CONCURRENCY)
+    prefetch_state.clear()
+    prefetch_state.update({
+        "running": True,
+        "started_at": time.time(),
+        "finished_at": None,
+        "packages": len(packages),
+        "downloaded": 0,
+        "already_cached": 0,
+        "over_budget": 0,
+        "failed": 0,
+        "bytes": 0,
+        "max_bytes": max_bytes,
+        "max_rate": max_rate
+    })
+    
+    async def prefetch_one(package_name: str):
+        async with semaphore:
+            try:
+                info = await get_download_info(package_name, record=False)
+                version = info.get('version')
+                if find_store_entry(store_key(package_name, version)):
+                    prefetch_state["already_cached"] += 1
+                    return
+                
+                size = int(info.get('size') or 0)
+                reserved = size or PREFETCH_UNKNOWN_SIZE
+                if prefetch_state["bytes"] + reserved > max_bytes:
+                    prefetch_state["over_budget"] += 1
+                    return
+                # Start each download only once the bytes reserved before it fit the rate.
+                start_at = prefetch_state["started_at"] + prefetch_state["bytes"] / max_rate
+                prefetch_state["bytes"] += reserved
+                await asyncio.sleep(max(0.0, start_at - time.time()))
+                
+                entry = await download_file_to_cache(package_name, info['download_url'], info.get('file_type', 'apk'),
+                                                     version, size, bool(info.get('accept_ranges')), info.get('validator'))
+                prefetch_state["bytes"] += entry['size'] - reserved
+                prefetched_keys.add(store_key(package_name, version))
+                prefetch_state["downloaded"] += 1
+            except Exception as e:
+                prefetch_state["failed"] += 1
+                print(f"[Prefetch] {package_name}: {e}", file=sys.stderr)
+    
+    try:
+        await asyncio.gather(*(prefetch_one(package_name) for package_name in packages))
+    finally:
+        prefetch_state["running"] = False
+        prefetch_state["finished_at"] = time.time()
+        stats["prefetch_runs"] += 1
+        print(f"[Prefetch] Done: {prefetch_state['downloaded']} downloaded, {prefetch_state['already_cached']} cached, "
+              f"{prefetch_state['failed']} failed, {prefetch_state['bytes'] / 1024 / 1024:.2f} MB", file=sys.stderr)
+    return dict(prefetch_state)
+
+def in_prefetch_window(hour: int) -> bool:
+    start, end = (int(part) for part in PREFETCH_WINDOW.split('-'))
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+async def periodic_prefetch():
+    """Warm the store once per day inside PREFETCH_WINDOW. Only the worker holding
+    the scheduler lock runs it."""
+    fd = os.open(os.path.join(LOCKS_DIR, 'prefetch-scheduler.lock'), os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return
+    
+    last_run_day = None
+    while True:
+        await asyncio.sleep(300)
+        now = datetime.now()
+        if last_run_day == now.date() or not in_prefetch_window(now.hour) or prefetch_state.get("running"):
+            continue
+        last_run_day = now.date()
+        try:
+            await run_prefetch(await top_packages(PREFETCH_TOP_K))
+        except Exception as e:
+            print(f"[Prefetch Error] {e}", file=sys.stderr)
+
+@app.post("/prefetch")
+async def start_prefetch(packages: Optional[str] = None, top_k: int = 0, max_bytes: int = 0, concurrency: int = 0,
+                         max_rate: int = 0) -> Dict[str, Any]:
+    """Warm the file store now. packages is a comma-separated list; without it the
+    top_k most requested packages are used."""
+    if prefetch_state.get("running"):
+        raise HTTPException(status_code=409, detail="Prefetch already running")
+    
+    if packages:
+        package_list = [name.strip() for name in packages.split(',') if name.strip()]
+    else:
+        package_list = await top_packages(top_k or PREFETCH_TOP_K)
+    
+    prefetch_state["running"] = True
+    asyncio.create_task(run_prefetch(package_list, max_bytes, concurrency, max_rate))
+    return {"status": "started", "packages": package_list}
+
+@app.get("/prefetch")
+async def get_prefetch_status() -> Dict[str, Any]:
+    return dict(prefetch_state)
+
+def stored_validator(entry: Dict[str, Any]) -> Dict[str, Any]:
+    return {'etag': entry.get('etag'), 'last_modified': entry.get('last_modified'), 'size': entry['size']}
+
+def mark_validated(key: str, validator: Optional[Dict[str, Any]] = None):
+    """Record that a stored file still matches upstream, adopting any newer validators"""
+    validator = validator or {}
+    now = time.time()
+    db_execute("UPDATE files SET validated_at = ?, etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified) "
+               "WHERE key = ?", (now, validator.get('etag'), validator.get('last_modified'), key))
+    entry = file_cache.get(key)
+    if entry:
+        entry['validated_at'] = now
+        entry.update({field: validator[field] for field in ('etag', 'last_modified') if validator.get(field)})
+
+def confirm_stored_build(package_name: str, info: Dict[str, Any]):
+    """A fresh resolution whose HEAD validator matches the stored file confirms it
+    without another request"""
+    validator = info.get('validator')
+    if not validator or not validator.get('size'):
+        return
+    key = store_key(package_name, info.get('version'))
+    entry = file_cache.get(key) or refresh_store_entry(key)
+    if entry and same_validator(stored_validator(entry), validator):
+        mark_validated(key, validator)
+        stats["free_revalidations"] += 1
+
+def revalidation_url(entry: Dict[str, Any]) -> str:
+    if entry.get('source_url'):
+        return entry['source_url']
+    kind = 'XAPK' if entry['file_type'] == 'xapk' else 'APK'
+    return f"{APKPURE_DOWNLOAD_BASE_URL}/b/{kind}/{entry['package_name']}?version=latest"
+
+async def revalidate_entry(entry: Dict[str, Any]) -> tuple:
+    """One conditional HEAD for a stored file. Returns (same, validator): same is
+    True when upstream still serves this build, False when it changed and None
+    when the answer says neither."""
+    url = revalidation_url(entry)
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    session = get_curl_session(ranked_profiles()[0])
+    response = await upstream_request(url, lambda: session.head(url, headers=headers, timeout=30, allow_redirects=True))
+    
+    if response.status_code == 304:
+        return True, None
+    if response.status_code != 200 or 'html' in response.headers.get('Content-Type', '').lower():
+        return None, None
+    validator = response_validator(response.headers)
+    version = version_from_headers(response.headers)
+    # APKPure never rebuilds a published version, so a matching name settles it
+    # even when the CDN hands out a new ETag.
+    if version and entry['version'] != 'latest':
+        return version == entry['version'], validator
+    return same_validator(stored_validator(entry), validator), validator
+
+def forget_build(key: str, entry: Dict[str, Any]):
+    """Upstream serves a different build now: drop the resolution if it still
+    points at this build, so the next request resolves and downloads the new one.
+    A versioned file is still a correct copy of its version and stays until
+    evicted, marked superseded so later rounds skip it; an unversioned one is removed."""
+    package_name = entry['package_name']
+    forget_resolution(package_name, entry['version'])
+    if entry['version'] == 'latest':
+        with store_lock():
+            remove_store_entry(key)
+    else:
+        db_execute("UPDATE files SET superseded_at = ? WHERE key = ?", (time.time(), key))
+    print(f"[Revalidate] {package_name}: upstream build changed", file=sys.stderr)
+
+async def run_revalidation(limit: int = 0) -> Dict[str, Any]:
+    """Confirm stored files last validated more than REVALIDATE_AFTER ago, most
+    used first. Files nobody asked for within FILE_CACHE_TTL, and builds already
+    found to be superseded, are left to expire."""
+    flush_store_access()
+    await settle_db_writes()
+    now = time.time()
+    rows = db_query_all(
+        f"SELECT {', '.join(FILE_COLUMNS)} FROM files WHERE COALESCE(validated_at, created_at) < ? AND last_access > ? "
+        "AND superseded_at IS NULL ORDER BY hits DESC, last_access DESC LIMIT ?",
+        (now - REVALIDATE_AFTER, now - FILE_CACHE_TTL, limit or REVALIDATE_BATCH)
+    )
+    summary = {"checked": 0, "unchanged": 0, "changed": 0, "errors": 0}
+    for row in rows:
+        key, entry = row[0], row_to_entry(row)
+        try:
+            same, validator = await revalidate_entry(entry)
+        except UpstreamUnavailable:
+            break
+        except Exception as e:
+            print(f"[Revalidate] {entry['package_name']}: {e}", file=sys.stderr)
+            same, validator = None, None
+        
+        summary["checked"] += 1
+        stats["revalidations"] += 1
+        if same is None:
+            summary["errors"] += 1
+            stats["revalidation_errors"] += 1
+        elif same:
+            mark_validated(key, validator)
+            summary["unchanged"] += 1
+            stats["revalidated_unchanged"] += 1
+        else:
+            await in_executor(forget_build, key, entry)
+            summary["changed"] += 1
+            stats["revalidated_changed"] += 1
+    return summary
+
+async def periodic_revalidation():
+    """Only the worker holding the scheduler lock revalidates"""
+    fd = os.open(os.path.join(LOCKS_DIR, 'revalidate-scheduler.lock'), os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return
+    
+    while True:
+        await asyncio.sleep(REVALIDATE_INTERVAL)
+        try:
+            summary = await run_revalidation()
+            if summary["checked"]:
+                print(f"[Revalidate] {summary}", file=sys.stderr)
+        except Exception as e:
+            print(f"[Revalidate Error] {e}", file=sys.stderr)
+
+@app.post("/revalidate")
+async def start_revalidation(limit: int = 0) -> Dict[str, Any]:
+    """Revalidate due files now instead of waiting for the next round"""
+    return await run_revalidation(limit)
+
+def clear_store():
+    """Remove every stored file not being served. Runs in the executor."""
+    flush_store_access()
+    with store_lock():
+        for key, file_path in db_query_all("SELECT key, file_path FROM files"):
+            if not is_pinned(file_path):
+                remove_store_entry(key)
+
+@app.delete("/cache")
+async def clear_cache():
+    global url_cache
+    
+    await in_executor(clear_store)
     
     url_cache = {}
-    file_cache = {}
+    resolution_failures.clear()
+    for table in ("slugs", "resolutions", "resolution_failures"):
+        db_execute(f"DELETE FROM {table}")
     
-    return {"status": "cache_cleared", "source": "apkpure"}
+    return {"status": "cache_cleared", "source": "apkpure", "pinned_files": store_count()}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="localhost", port=8000, log_level="info", workers=1)
+    if API_WORKERS > 1:
+        # Workers coordinate through shared.db and lock files under app_cache/.
+        uvicorn.run("api_server:app", host="localhost", port=8000, log_level="info", workers=API_WORKERS,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
+    else:
+        uvicorn.run(app, host="localhost", port=8000, log_level="info", workers=1)
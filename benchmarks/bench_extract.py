@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Compare the lxml page extractors in api_server.py with the previous
+BeautifulSoup html.parser implementation.
+
+Usage:
+    python3 benchmarks/bench_extract.py [--fixtures DIR] [--rounds N]
+
+Without --fixtures, synthetic APKPure-like search and download pages are
+generated. With --fixtures, every search_*.html and download_*.html file in
+DIR is used instead (save real pages there with curl or a browser).
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from api_server import extract_app_slug, extract_download_url
+
+PACKAGE_NAME = "com.whatsapp"
+
+def legacy_app_slug(page: str, package_name: str) -> str:
+    soup = BeautifulSoup(page, 'html.parser')
+    for link in soup.find_all('a', href=True):
+        href = str(link.get('href') or '')
+        if f'/{package_name}' in href and '/download' not in href:
+            parts = href.strip('/').split('/')
+            if len(parts) >= 1:
+                return parts[0]
+    return package_name
+
+def legacy_download_url(page: str):
+    soup = BeautifulSoup(page, 'html.parser')
+    
+    download_link = soup.find('a', {'id': 'download_link'})
+    if download_link and download_link.get('href'):
+        url = str(download_link.get('href'))
+        if url.startswith('http'):
+            return url
+    
+    for a_tag in soup.find_all('a', href=True):
+        href = str(a_tag.get('href') or '')
+        if 'download.apkpure.com' in href or 'd.apkpure.com' in href:
+            if 'token' in href or 'key' in href:
+                return href
+    
+    iframe = soup.find('iframe', {'id': 'iframe_download'})
+    if iframe and iframe.get('src'):
+        return str(iframe.get('src'))
+    
+    meta_refresh = soup.find('meta', {'http-equiv': 'refresh'})
+    if meta_refresh:
+        match = re.search(r'url=(.+)', str(meta_refresh.get('content') or ''), re.IGNORECASE)
+        if match:
+            return match.group(1).strip()
+    
+    for script in soup.find_all('script'):
+        url_match = re.search(r'(https?://[^"\'<>\s]+\.(?:apk|xapk)[^"\'<>\s]*)', script.string or '', re.IGNORECASE)
+        if url_match:
+            return url_match.group(1)
+    
+    return None
+
+def synthetic_page(kind: str, filler_links: int = 1500, filler_scripts: int = 40) -> str:
+    parts = ['<!DOCTYPE html><html><head><title>APKPure</title>']
+    for i in range(filler_scripts):
+        parts.append(f'<script>window.__data{i} = {{"id": {i}, "items": [{", ".join(str(n) for n in range(50))}]}};</script>')
+    parts.append('</head><body><div class="main">')
+    for i in range(filler_links):
+        parts.append(f'<div class="item"><a href="/app-{i}/com.example.app{i}" title="App {i}">'
+                     f'<img src="https://image.winudf.com/{i}.png" alt="App {i}"><p>App {i} description</p></a></div>')
+    if kind == "search":
+        parts.append(f'<a href="/whatsapp-messenger/{PACKAGE_NAME}">WhatsApp Messenger</a>')
+    else:
+        parts.append(f'<a id="download_link" href="https://d.apkpure.com/b/XAPK/{PACKAGE_NAME}?version=latest&token=abc">Download</a>')
+    parts.append('</div></body></html>')
+    return ''.join(parts)
+
+def load_fixtures(directory: str):
+    fixtures = []
+    for kind in ("search", "download"):
+        for path in sorted(glob.glob(os.path.join(directory, f"{kind}_*.html"))):
+            with open(path, encoding='utf-8', errors='replace') as f:
+                fixtures.append((kind, os.path.basename(path), f.read()))
+    return fixtures
+
+def timed(func, page: str, rounds: int):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        result = func(page)
+    return (time.perf_counter() - started) / rounds * 1000, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', help="directory with search_*.html / download_*.html pages")
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+    
+    if args.fixtures:
+        fixtures = load_fixtures(args.fixtures)
+        if not fixtures:
+            print(f"No search_*.html or download_*.html files in {args.fixtures}", file=sys.stderr)
+            sys.exit(1)
+    else:
+        fixtures = [("search", "synthetic search", synthetic_page("search")),
+                    ("download", "synthetic download", synthetic_page("download"))]
+    
+    print(f"{'page':<32}{'KB':>8}{'bs4 ms':>10}{'lxml ms':>10}{'speedup':>9}  match")
+    for kind, name, page in fixtures:
+        if kind == "search":
+            legacy = lambda p: legacy_app_slug(p, PACKAGE_NAME)
+            current = lambda p: extract_app_slug(p, PACKAGE_NAME)
+        else:
+            legacy, current = legacy_download_url, extract_download_url
+        
+        legacy_ms, legacy_result = timed(legacy, page, args.rounds)
+        current_ms, current_result = timed(current, page, args.rounds)
+        print(f"{name:<32}{len(page) / 1024:>8.0f}{legacy_ms:>10.2f}{current_ms:>10.2f}"
+              f"{legacy_ms / current_ms:>8.1f}x  {'yes' if legacy_result == current_result else f'no ({legacy_result!r} vs {current_result!r})'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Local stand-in for APKPure, serving the pages and download endpoints that
+api_server.py talks to.
+
+Usage:
+    python3 benchmarks/fake_apkpure.py [--port 8765] [--latency 0.05] [--size 8000000]
+                                       [--block-rate 0.0] [--challenge-rate 0.0]
+                                       [--xapk-percent 50]
+
+Point the API server at it with
+    APKPURE_BASE_URL=http://127.0.0.1:8765 APKPURE_DOWNLOAD_BASE_URL=http://127.0.0.1:8765
+
+Routes:
+    GET  /search?q=<package>                 search page linking /<slug>/<package>
+    GET  /<slug>/<package>/download          download page with #download_link
+    HEAD|GET /b/XAPK/<package>, /b/APK/<package>
+                                             a valid APK or XAPK of --size bytes, with
+                                             Range, If-None-Match and a versioned filename
+    POST /_publish/<package>                 release a new build (1.0.0, 1.0.1, ...)
+    GET  /_stats, POST /_reset               request counters per route and outcome
+
+Files are generated once per package in a temporary directory. --block-rate
+answers that share of requests with 403 and --challenge-rate with a small
+CloudFlare-style HTML page, after --latency seconds.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+import zipfile
+import zlib
+from collections import defaultdict
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import FileResponse, HTMLResponse, JSONResponse, Response
+from starlette.routing import Route
+
+CHALLENGE_PAGE = ('<!DOCTYPE html><html><head><title>Just a moment...</title></head>'
+                  '<body><div id="cf-challenge">Checking your browser before accessing apkpure.com</div></body></html>')
+
+def binary_manifest(package_name: str, version_code: int, version_name: str) -> bytes:
+    """Minimal compiled AndroidManifest.xml: a <manifest> element carrying
+    package, versionCode and versionName"""
+    strings = ['versionCode', 'versionName', 'package', 'manifest', version_name, package_name]
+    encoded = [struct.pack('<H', len(s)) + s.encode('utf-16-le') + b'\0\0' for s in strings]
+    offsets, position = [], 0
+    for item in encoded:
+        offsets.append(position)
+        position += len(item)
+    data = b''.join(encoded)
+    data += b'\0' * (-len(data) % 4)
+    strings_start = 28 + 4 * len(strings)
+    string_pool = (struct.pack('<HHIIIIII', 0x0001, 28, strings_start + len(data), len(strings), 0, 0, strings_start, 0)
+                   + struct.pack(f'<{len(strings)}I', *offsets) + data)
+    resource_map = struct.pack('<HHIII', 0x0180, 8, 16, 0x0101021b, 0x0101021c)
+    attributes = [(0, 0xffffffff, 0x10, version_code), (1, 4, 0x03, 4), (2, 5, 0x03, 5)]
+    attribute_data = b''.join(struct.pack('<IIIHBBI', 0xffffffff, name, raw, 8, 0, value_type, value)
+                              for name, raw, value_type, value in attributes)
+    element_ext = struct.pack('<IIHHHHHH', 0xffffffff, 3, 20, 20, len(attributes), 0, 0, 0)
+    element = (struct.pack('<HHIII', 0x0102, 16, 16 + len(element_ext) + len(attribute_data), 1, 0xffffffff)
+               + element_ext + attribute_data)
+    body = string_pool + resource_map + element
+    return struct.pack('<HHI', 0x0003, 8, 8 + len(body)) + body
+
+def write_apk(path: str, package_name: str, size: int, version_code: int, version_name: str):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('AndroidManifest.xml', binary_manifest(package_name, version_code, version_name))
+        archive.writestr('classes.dex', os.urandom(max(0, size - 1024)))
+
+def write_xapk(path: str, package_name: str, size: int, version_code: int, version_name: str):
+    base_apk = f"{path}.base"
+    write_apk(base_apk, package_name, size, version_code, version_name)
+    manifest = {
+        "xapk_version": 2,
+        "package_name": package_name,
+        "version_code": str(version_code),
+        "version_name": version_name,
+        "split_apks": [{"file": f"{package_name}.apk", "id": "base"}]
+    }
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('manifest.json', json.dumps(manifest))
+        archive.write(base_apk, f"{package_name}.apk")
+    os.remove(base_apk)
+
+def create_app(latency: float = 0.05, size: int = 8_000_000, block_rate: float = 0.0,
+               challenge_rate: float = 0.0, xapk_percent: int = 50, files_dir: str = None) -> Starlette:
+    files_dir = files_dir or tempfile.mkdtemp(prefix='fake-apkpure-')
+    counters = defaultdict(int)
+    builds = defaultdict(int)
+    generating = {}
+
+    def package_type(package_name: str) -> str:
+        return 'xapk' if zlib.crc32(package_name.encode()) % 100 < xapk_percent else 'apk'
+
+    def package_version(package_name: str) -> str:
+        return f"1.0.{builds[package_name]}"
+
+    def generate(path: str, file_type: str, package_name: str, version_code: int, version_name: str):
+        # Written aside and renamed, so no request ever sees a partial file.
+        if os.path.exists(path):
+            return
+        writer = write_xapk if file_type == 'xapk' else write_apk
+        tmp_path = f"{path}.tmp"
+        writer(tmp_path, package_name, size, version_code, version_name)
+        os.replace(tmp_path, path)
+
+    async def package_file(package_name: str) -> str:
+        file_type = package_type(package_name)
+        version = package_version(package_name)
+        path = os.path.join(files_dir, f"{package_name}_{version}.{file_type}")
+        if path not in generating:
+            generating[path] = asyncio.get_event_loop().run_in_executor(
+                None, generate, path, file_type, package_name, 100 + builds[package_name], version)
+        await generating[path]
+        return path
+
+    async def gate(route: str):
+        """Apply latency and fault injection; returns a response to send instead, if any"""
+        counters[f"{route}.requests"] += 1
+        if latency:
+            await asyncio.sleep(latency)
+        roll = random.random()
+        if roll < block_rate:
+            counters[f"{route}.blocked"] += 1
+            return HTMLResponse(CHALLENGE_PAGE, status_code=403)
+        if roll < block_rate + challenge_rate:
+            counters[f"{route}.challenged"] += 1
+            return HTMLResponse(CHALLENGE_PAGE)
+        return None
+
+    async def search(request: Request):
+        package_name = request.query_params.get('q', '')
+        return await gate('search') or HTMLResponse(
+            f'<html><body><div class="search-res"><a href="/fake-{package_name.replace(".", "-")}/{package_name}">'
+            f'{package_name}</a></div></body></html>')
+
+    async def download_page(request: Request):
+        package_name = request.path_params['package_name']
+        file_url = f"{request.base_url}b/{package_type(package_name).upper()}/{package_name}?version=latest&token=bench"
+        return await gate('download_page') or HTMLResponse(
+            f'<html><body><a id="download_link" href="{file_url}">Download</a></body></html>')
+
+    async def download_file(request: Request):
+        kind = request.path_params['kind'].lower()
+        package_name = request.path_params['package_name']
+        route = f"{kind}_{request.method.lower()}"
+        blocked = await gate(route)
+        if blocked:
+            return blocked
+        if kind == 'xapk' and package_type(package_name) != 'xapk':
+            return Response(status_code=404)
+        path = await package_file(package_name)
+        response = FileResponse(path, media_type='application/vnd.android.package-archive', stat_result=os.stat(path),
+                                filename=f"{package_name}_{package_version(package_name)}_APKPure.{package_type(package_name)}")
+        if request.headers.get('if-none-match') == response.headers['etag']:
+            counters[f"{route}.not_modified"] += 1
+            return Response(status_code=304, headers={"ETag": response.headers['etag']})
+        counters[f"{route}.served"] += 1
+        return response
+
+    async def publish(request: Request):
+        package_name = request.path_params['package_name']
+        builds[package_name] += 1
+        return JSONResponse({"package_name": package_name, "version": package_version(package_name)})
+
+    async def get_stats(request: Request):
+        return JSONResponse(dict(counters))
+
+    async def reset_stats(request: Request):
+        counters.clear()
+        return JSONResponse({"status": "reset"})
+
+    return Starlette(routes=[
+        Route('/search', search),
+        Route('/b/{kind}/{package_name}', download_file, methods=['GET', 'HEAD']),
+        Route('/_stats', get_stats),
+        Route('/_reset', reset_stats, methods=['POST']),
+        Route('/_publish/{package_name}', publish, methods=['POST']),
+        Route('/{slug}/{package_name}/download', download_page),
+    ])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds added to every request")
+    parser.add_argument('--size', type=int, default=8_000_000, help="approximate bytes per package file")
+    parser.add_argument('--block-rate', type=float, default=0.0, help="share of requests answered with 403")
+    parser.add_argument('--challenge-rate', type=float, default=0.0, help="share answered with an HTML challenge")
+    parser.add_argument('--xapk-percent', type=int, default=50, help="percentage of packages published as XAPK")
+    parser.add_argument('--files-dir', help="where generated packages are kept (default: a temp dir)")
+    args = parser.parse_args()
+
+    app = create_app(args.latency, args.size, args.block_rate, args.challenge_rate, args.xapk_percent, args.files_dir)
+    print(f"[Fake APKPure] Listening on http://{args.host}:{args.port}", file=sys.stderr)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
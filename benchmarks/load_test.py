@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""Drive api_server.py against the local APKPure stand-in and report
+throughput, latency percentiles, peak RSS and upstream request counts.
+
+Usage:
+    python3 benchmarks/load_test.py [--endpoints info,url,download] [--requests 500]
+                                    [--concurrency 50] [--packages 100] [--rounds 2]
+                                    [--latency 0.05] [--size 8000000] [--block-rate 0.0]
+                                    [--challenge-rate 0.0] [--workers 1] [--json]
+
+Both servers are started as subprocesses on free ports; the API server gets
+an empty cache directory, so the first round measures cold resolution and
+downloads and later rounds measure the caches. Packages are drawn from a
+Zipf-like distribution (--skew) so a few hot apps dominate, as in production.
+Extra API server settings (UPSTREAM_RATE, DOWNLOAD_SLOTS, ...) are taken
+from the environment.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+def process_tree(pid: int) -> list:
+    pids = [pid]
+    for child in open(f'/proc/{pid}/task/{pid}/children').read().split():
+        pids += process_tree(int(child))
+    return pids
+
+def peak_rss_mb(pid: int) -> float:
+    """Sum of VmHWM (peak resident set) over the server and its workers"""
+    total = 0
+    try:
+        for member in process_tree(pid):
+            with open(f'/proc/{member}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+    except OSError:
+        return 0.0
+    return total / 1024
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def pick_packages(count: int, total: int, skew: float) -> list:
+    weights = [1 / (rank + 1) ** skew for rank in range(total)]
+    return random.choices([f"com.bench.app{i}" for i in range(total)], weights=weights, k=count)
+
+async def run_round(api_url: str, endpoints: list, requests: int, concurrency: int, packages: int,
+                    skew: float, users: int) -> dict:
+    results = {endpoint: {"latencies": [], "statuses": Counter(), "bytes": 0} for endpoint in endpoints}
+    jobs = asyncio.Queue()
+    for i, package_name in enumerate(pick_packages(requests, packages, skew)):
+        jobs.put_nowait((endpoints[i % len(endpoints)], package_name, f"bench-user-{i % users}"))
+
+    async def worker(client: httpx.AsyncClient):
+        while not jobs.empty():
+            endpoint, package_name, user_id = jobs.get_nowait()
+            result = results[endpoint]
+            started = time.perf_counter()
+            try:
+                if endpoint == 'download':
+                    async with client.stream('GET', f"{api_url}/download/{package_name}",
+                                             params={"user_id": user_id}) as response:
+                        async for chunk in response.aiter_bytes():
+                            result["bytes"] += len(chunk)
+                        status = response.status_code
+                else:
+                    status = (await client.get(f"{api_url}/{endpoint}/{package_name}")).status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            result["latencies"].append(time.perf_counter() - started)
+            result["statuses"][status] += 1
+
+    started = time.perf_counter()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=600, limits=limits) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    report = {"elapsed": round(elapsed, 2), "endpoints": {}}
+    for endpoint, result in results.items():
+        latencies = result["latencies"]
+        report["endpoints"][endpoint] = {
+            "requests": len(latencies),
+            "throughput_rps": round(len(latencies) / elapsed, 1),
+            "mb_per_s": round(result["bytes"] / elapsed / 1024 / 1024, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+            "max_ms": round(max(latencies, default=0) * 1000, 1),
+            "statuses": {str(status): count for status, count in result["statuses"].items()}
+        }
+    return report
+
+def print_report(index: int, report: dict):
+    print(f"\nRound {index + 1} ({report['elapsed']}s, peak RSS {report['peak_rss_mb']:.0f} MB)")
+    print(f"{'endpoint':<10}{'reqs':>7}{'req/s':>9}{'MB/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}  statuses")
+    for endpoint, row in report["endpoints"].items():
+        statuses = ' '.join(f"{status}:{count}" for status, count in sorted(row["statuses"].items()))
+        print(f"{endpoint:<10}{row['requests']:>7}{row['throughput_rps']:>9}{row['mb_per_s']:>8}{row['p50_ms']:>9}"
+              f"{row['p95_ms']:>9}{row['p99_ms']:>9}{row['max_ms']:>9}  {statuses}")
+    upstream = ' '.join(f"{route}={count}" for route, count in sorted(report["upstream"].items()) if route.endswith('.requests'))
+    print(f"upstream: {upstream or 'none'}")
+    cache = report["server"]
+    print(f"server: resolutions coalesced={cache.get('coalesced_resolutions')} url hits={cache.get('cache_hits')} "
+          f"file hits={cache.get('file_cache_hits')} downloads={cache.get('downloads')} "
+          f"rejected={cache.get('admission_rejections')} hot tier={cache.get('hot_tier_hits')} "
+          f"disk tier={cache.get('disk_tier_hits')}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoints', default='info,url,download', help="comma-separated: info, url, download")
+    parser.add_argument('--requests', type=int, default=500, help="requests per round")
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--users', type=int, help="distinct user_id values for /download (default: concurrency)")
+    parser.add_argument('--packages', type=int, default=100, help="distinct packages to draw from")
+    parser.add_argument('--skew', type=float, default=1.0, help="Zipf exponent of package popularity")
+    parser.add_argument('--rounds', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=1, help="API server worker processes")
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--size', type=int, default=8_000_000)
+    parser.add_argument('--block-rate', type=float, default=0.0)
+    parser.add_argument('--challenge-rate', type=float, default=0.0)
+    parser.add_argument('--xapk-percent', type=int, default=50)
+    parser.add_argument('--json', action='store_true', help="print the full report as JSON")
+    args = parser.parse_args()
+
+    endpoints = [endpoint.strip() for endpoint in args.endpoints.split(',') if endpoint.strip()]
+    fake_port, api_port = free_port(), free_port()
+    fake_url, api_url = f"http://127.0.0.1:{fake_port}", f"http://127.0.0.1:{api_port}"
+    work_dir = tempfile.mkdtemp(prefix='apk-bench-')
+    # The hot tier lives in RAM and outlasts the process, so it gets a scratch directory too.
+    hot_dir = tempfile.mkdtemp(prefix='apk-bench-hot-', dir='/dev/shm') if os.path.isdir('/dev/shm') else ''
+    env = {
+        "HOT_TIER_DIR": hot_dir,
+        **os.environ,
+        "APP_CACHE_DIR": os.path.join(work_dir, 'app_cache'),
+        "APKPURE_BASE_URL": fake_url,
+        "APKPURE_DOWNLOAD_BASE_URL": fake_url,
+    }
+
+    os.makedirs(os.path.join(work_dir, 'upstream'))
+    fake = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'benchmarks', 'fake_apkpure.py'),
+                             '--port', str(fake_port), '--latency', str(args.latency), '--size', str(args.size),
+                             '--block-rate', str(args.block_rate), '--challenge-rate', str(args.challenge_rate),
+                             '--xapk-percent', str(args.xapk_percent), '--files-dir', os.path.join(work_dir, 'upstream')],
+                            stderr=subprocess.DEVNULL)
+    api = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'api_server:app', '--app-dir', REPO_DIR,
+                            '--host', '127.0.0.1', '--port', str(api_port), '--workers', str(args.workers),
+                            '--log-level', 'warning'],
+                           env={**env, "API_WORKERS": str(args.workers)}, stderr=subprocess.DEVNULL)
+    reports = []
+    try:
+        wait_until_up(f"{fake_url}/_stats", fake)
+        wait_until_up(f"{api_url}/health", api)
+        for index in range(args.rounds):
+            httpx.post(f"{fake_url}/_reset")
+            report = asyncio.run(run_round(api_url, endpoints, args.requests, args.concurrency, args.packages,
+                                           args.skew, args.users or args.concurrency))
+            report["peak_rss_mb"] = peak_rss_mb(api.pid)
+            report["upstream"] = httpx.get(f"{fake_url}/_stats").json()
+            report["server"] = httpx.get(f"{api_url}/stats").json()
+            reports.append(report)
+            if not args.json:
+                print_report(index, report)
+    finally:
+        for process in (api, fake):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if hot_dir:
+            shutil.rmtree(hot_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(reports, indent=2, default=str))
+
+if __name__ == "__main__":
+    main()
@@ -500,18 +500,57 @@ function formatSearchResults(results) {
     return text;
 }
 
-async function downloadAPKWithAxios(packageName, appTitle) {
+// The server downloads into its store as a job while we long-poll its progress,
+// so no single request has to stay open for the whole upstream transfer.
+async function waitForDownloadJob(API_URL, packageName, userPhone, onProgress) {
+    let { data: job } = await axios.post(`${API_URL}/jobs`,
+        { package_name: packageName, user_id: userPhone || undefined }, { timeout: 30000 });
+    while (job.stage !== 'done' && job.stage !== 'failed') {
+        ({ data: job } = await axios.get(`${API_URL}/jobs/${job.job_id}`, {
+            params: { wait: 25, since: job.seq },
+            timeout: 40000
+        }));
+        if (onProgress) {
+            try { await onProgress(job); } catch {}
+        }
+    }
+    if (job.stage === 'failed') {
+        throw new Error(job.error || 'فشل التحميل');
+    }
+    return job;
+}
+
+async function downloadAPKWithAxios(packageName, appTitle, userPhone, onProgress) {
     const API_URL = process.env.API_URL || 'http://localhost:8000';
+    const fallbackUrl = `${API_URL}/download/${packageName}`;
+    let downloadUrl = fallbackUrl;
+    
+    try {
+        const job = await waitForDownloadJob(API_URL, packageName, userPhone, onProgress);
+        downloadUrl = `${API_URL}/jobs/${job.job_id}/file`;
+    } catch (error) {
+        console.log(`   ⚠️ مهمة التحميل فشلت، استخدام /download: ${error.message}`);
+    }
     
     console.log(`📥 جاري التحميل عبر Axios (Streaming)...`);
     
+    // Bytes received so far survive failed attempts; a retry asks only for the
+    // rest with Range, and If-Range makes the server resend everything if the
+    // file changed in between.
+    let chunks = [];
+    let downloadedBytes = 0;
+    let etag = null;
+    
     for (let attempt = 0; attempt < 3; attempt++) {
         try {
             console.log(`   محاولة ${attempt + 1}/3...`);
             
+            const resumeFrom = etag ? downloadedBytes : 0;
             const response = await axios({
                 method: 'GET',
-                url: `${API_URL}/download/${packageName}`,
+                url: downloadUrl,
+                params: userPhone ? { user_id: userPhone } : undefined,
+                headers: resumeFrom > 0 ? { Range: `bytes=${resumeFrom}-`, 'If-Range': etag } : undefined,
                 responseType: 'stream',
                 timeout: 600000,
                 maxContentLength: Infinity,
@@ -520,10 +559,15 @@ async function downloadAPKWithAxios(packageName, appTitle) {
             
             const fileType = response.headers['x-file-type'] || 'apk';
             const source = response.headers['x-source'] || 'apkpure';
-            const contentLength = parseInt(response.headers['content-length'] || '0');
+            etag = response.headers['etag'] || null;
+            if (response.status === 206) {
+                console.log(`   ↩️  استكمال من ${(resumeFrom / 1024 / 1024).toFixed(1)}MB`);
+            } else {
+                chunks = [];
+                downloadedBytes = 0;
+            }
+            const contentLength = downloadedBytes + parseInt(response.headers['content-length'] || '0');
             
-            const chunks = [];
-            let downloadedBytes = 0;
             const startTime = Date.now();
             
             await new Promise((resolve, reject) => {
@@ -555,12 +599,19 @@ async function downloadAPKWithAxios(packageName, appTitle) {
                 return { buffer, filename, size: fileSize, fileType };
             }
             
+            etag = null;
             throw new Error('الملف المحمل صغير جداً');
             
         } catch (error) {
             console.log(`\n   ❌ المحاولة ${attempt + 1} فشلت: ${error.message}`);
             if (attempt < 2) {
-                await new Promise(r => setTimeout(r, 2000 * (attempt + 1)));
+                const status = error.response?.status;
+                if (status === 404 || status === 409 || status === 410) {
+                    // The job's file is gone; /download fetches it again.
+                    downloadUrl = fallbackUrl;
+                }
+                const retryAfter = status === 429 || status === 503 ? parseInt(error.response.headers['retry-after'] || '0') : 0;
+                await new Promise(r => setTimeout(r, retryAfter > 0 ? retryAfter * 1000 : 2000 * (attempt + 1)));
             }
         }
     }
@@ -1242,7 +1293,25 @@ async function handleAppDownload(sock, remoteJid, userId, senderPhone, msg, appI
 
         await sock.sendMessage(remoteJid, { react: { text: '📥', key: msg.key } });
 
-        const apkStream = await downloadAPKWithAxios(appDetails.appId, appDetails.title);
+        let progressKey = null;
+        let lastProgressAt = 0;
+        const showProgress = async (job) => {
+            if (job.stage !== 'downloading' || !job.total || Date.now() - lastProgressAt < 5000) return;
+            lastProgressAt = Date.now();
+            const percent = Math.floor((job.bytes / job.total) * 100);
+            const eta = job.eta ? ` → ⏱️ ${Math.ceil(job.eta)}s` : '';
+            const text = `⬇️ ${percent}% → ${formatFileSize(job.bytes)} / ${formatFileSize(job.total)}${eta}`;
+            if (progressKey) {
+                await sock.sendMessage(remoteJid, { text, edit: progressKey });
+            } else {
+                progressKey = (await sock.sendMessage(remoteJid, { text }))?.key || null;
+            }
+        };
+
+        const apkStream = await downloadAPKWithAxios(appDetails.appId, appDetails.title, senderPhone, showProgress);
+        if (progressKey) {
+            try { await sock.sendMessage(remoteJid, { delete: progressKey }); } catch {}
+        }
 
         if (apkStream) {
             if (apkStream.size > MAX_FILE_SIZE) {
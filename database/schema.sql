@@ -31,8 +31,25 @@ CREATE TABLE IF NOT EXISTS downloads (
     FOREIGN KEY (user_phone) REFERENCES users(phone_number) ON DELETE CASCADE
 );
 
+-- إنشاء جدول أحداث خادم API (التحميل والاستعلام) - يكتبه api_server.py على دفعات
+CREATE TABLE IF NOT EXISTS api_events (
+    id BIGSERIAL PRIMARY KEY,
+    event_type VARCHAR(20) NOT NULL,
+    package_name VARCHAR(255) NOT NULL,
+    version VARCHAR(100),
+    user_id VARCHAR(100),
+    outcome VARCHAR(20) NOT NULL,
+    file_type VARCHAR(10),
+    file_size BIGINT,
+    duration_ms INTEGER,
+    count INTEGER NOT NULL DEFAULT 1,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
 -- إنشاء فهارس لتحسين الأداء
 CREATE INDEX IF NOT EXISTS idx_users_phone ON users(phone_number);
 CREATE INDEX IF NOT EXISTS idx_blacklist_phone ON blacklist(phone_number);
 CREATE INDEX IF NOT EXISTS idx_downloads_user ON downloads(user_phone);
 CREATE INDEX IF NOT EXISTS idx_downloads_date ON downloads(downloaded_at);
+CREATE INDEX IF NOT EXISTS idx_api_events_package ON api_events(package_name, created_at);
+CREATE INDEX IF NOT EXISTS idx_api_events_date ON api_events(created_at);
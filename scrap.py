@@ -1,12 +1,29 @@
 #!/usr/bin/env python3
+"""Download APKs from APKPure.
+
+    python3 scrap.py <package_name>
+        One package into downloads/, printing its path (the bot's fallback).
+
+    python3 scrap.py --bulk packages.txt [--concurrency 4] [--summary summary.json]
+    python3 scrap.py --bulk - < packages.txt
+        Mirror many packages into the API server's store (app_cache/) with the
+        server's own resolution and download code. Packages already stored are
+        skipped and interrupted downloads resume from their checkpoints, so a run
+        can simply be started again. A JSON summary goes to stdout or --summary.
+"""
 import sys
 import os
-import cloudscraper
-from bs4 import BeautifulSoup
+import argparse
+import asyncio
+import json
 import re
 import time
 
 def download_apk(package_name):
+    # Only this mode scrapes with cloudscraper; bulk mirroring uses the server's code.
+    import cloudscraper
+    from bs4 import BeautifulSoup
+    
     scraper = cloudscraper.create_scraper(
         browser={
             'browser': 'chrome',
@@ -121,13 +138,97 @@ def download_apk(package_name):
         traceback.print_exc(file=sys.stderr)
         return None
 
+def read_package_list(source):
+    """Package names from a file, or stdin for '-': one per line, '#' starts a comment"""
+    stream = sys.stdin if source == '-' else open(source, encoding='utf-8')
+    try:
+        names = [line.split('#', 1)[0].strip() for line in stream]
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    return list(dict.fromkeys(name for name in names if name))
+
+async def mirror_packages(package_names, concurrency):
+    """Resolve and download packages into the server's store, at most concurrency at a time"""
+    # Imported here so the single-package mode works without the server's dependencies.
+    import api_server as server
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    results = {}
+    
+    async def mirror_one(package_name):
+        async with semaphore:
+            started = time.perf_counter()
+            result = {"package_name": package_name}
+            try:
+                status = "cached"
+                entry = server.latest_store_entry(package_name)
+                if entry is None:
+                    info = await server.get_download_info(package_name, record=False)
+                    entry = server.find_store_entry(server.store_key(package_name, info.get('version')))
+                    if entry is None:
+                        status = "downloaded"
+                        entry = await server.download_file_to_cache(
+                            package_name, info['download_url'], info.get('file_type', 'apk'), info.get('version'),
+                            int(info.get('size') or 0), bool(info.get('accept_ranges')), info.get('validator'))
+                result.update(status=status, version=entry['version'], file_type=entry['file_type'],
+                              size=entry['size'], sha256=entry['sha256'])
+            except Exception as e:
+                result.update(status="failed", error=str(e) or type(e).__name__)
+            
+            elapsed = time.perf_counter() - started
+            result["seconds"] = round(elapsed, 2)
+            if result["status"] == "downloaded":
+                result["bytes_per_second"] = round(result["size"] / max(elapsed, 1e-6))
+            results[package_name] = result
+            print(f"[{len(results)}/{len(package_names)}] {package_name}: {result['status']}"
+                  f"{' - ' + result['error'] if 'error' in result else ''}", file=sys.stderr)
+    
+    started = time.perf_counter()
+    try:
+        async with server.upstream_clients():
+            await asyncio.gather(*(mirror_one(package_name) for package_name in package_names))
+    finally:
+        if server.shared_db is not None:
+            server.shared_db.close()
+    elapsed = time.perf_counter() - started
+    
+    ordered = [results[name] for name in package_names if name in results]
+    downloaded_bytes = sum(r['size'] for r in ordered if r['status'] == 'downloaded')
+    return {
+        "packages": len(package_names),
+        **{status: sum(1 for r in ordered if r['status'] == status) for status in ("downloaded", "cached", "failed")},
+        "bytes": downloaded_bytes,
+        "seconds": round(elapsed, 2),
+        "bytes_per_second": round(downloaded_bytes / max(elapsed, 1e-6)),
+        "results": ordered
+    }
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("الاستخدام: python3 scrap.py <package_name>", file=sys.stderr)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('package_name', nargs='?')
+    parser.add_argument('--bulk', metavar='FILE', help="ملف بأسماء الحزم، أو - للقراءة من stdin")
+    parser.add_argument('--concurrency', type=int, default=4, help="عدد التحميلات المتزامنة")
+    parser.add_argument('--summary', metavar='FILE', help="حفظ ملخص JSON في ملف بدلاً من stdout")
+    args = parser.parse_args()
+    
+    if args.bulk:
+        summary = asyncio.run(mirror_packages(read_package_list(args.bulk), max(1, args.concurrency)))
+        if args.summary:
+            with open(args.summary, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=2, ensure_ascii=False)
+        else:
+            print(json.dumps(summary, indent=2, ensure_ascii=False))
+        print(f"تم: {summary['downloaded']} تحميل، {summary['cached']} موجود مسبقاً، {summary['failed']} فشل، "
+              f"{summary['bytes'] / (1024*1024):.2f} MB في {summary['seconds']} ثانية", file=sys.stderr)
+        sys.exit(1 if summary['failed'] else 0)
+    
+    if not args.package_name:
+        print("الاستخدام: python3 scrap.py <package_name>\n"
+              "          python3 scrap.py --bulk <packages.txt | -> [--concurrency N] [--summary FILE]", file=sys.stderr)
         sys.exit(1)
     
-    package_name = sys.argv[1]
-    result = download_apk(package_name)
+    result = download_apk(args.package_name)
     
     if not result:
         sys.exit(1)
@@ -0,0 +1,134 @@
+"""Write-behind event queue of api_server.py against the shared.db sink:
+batching, folding past the queue limit, requeueing failed batches and retention."""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+os.environ['APP_CACHE_DIR'] = tempfile.mkdtemp(prefix='apk-events-')
+os.environ['HOT_TIER_BYTES'] = '0'
+os.environ.pop('DATABASE_URL', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api_server  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def empty_queue():
+    api_server.event_queue.clear()
+    api_server.event_overflow.clear()
+    api_server.get_shared_db().execute("DELETE FROM api_events")
+    yield
+    api_server.event_queue.clear()
+    api_server.event_overflow.clear()
+
+
+def stored_events() -> list:
+    return api_server.get_shared_db().execute(
+        "SELECT package_name, outcome, file_size, count FROM api_events ORDER BY id").fetchall()
+
+
+def queued_packages() -> list:
+    return [row[2] for row in api_server.event_queue]
+
+
+def test_flush_writes_queued_events():
+    written = api_server.stats["events_written"]
+    api_server.record_event("download", "com.a", "hit", user="u1", file_type="apk", size=10, duration=0.5)
+    api_server.record_event("download", "com.b", "miss", user="u2", file_type="xapk", size=20)
+    api_server.record_event("resolve", "com.c", "failed")
+
+    asyncio.run(api_server.flush_events())
+
+    assert not api_server.event_queue
+    assert stored_events() == [("com.a", "hit", 10, 1), ("com.b", "miss", 20, 1), ("com.c", "failed", None, 1)]
+    assert api_server.stats["events_written"] == written + 3
+
+
+def test_events_past_queue_limit_are_folded(monkeypatch):
+    monkeypatch.setattr(api_server, "EVENT_QUEUE_MAX", 2)
+    aggregated = api_server.stats["events_aggregated"]
+    for _ in range(5):
+        api_server.record_event("download", "com.a", "hit", file_type="apk", size=10)
+
+    assert len(api_server.event_queue) == 2
+    (folded,) = api_server.event_overflow.values()
+    assert folded[1:] == [3, 30]
+    assert api_server.stats["events_aggregated"] == aggregated + 3
+
+    asyncio.run(api_server.flush_events())
+
+    assert not api_server.event_overflow
+    assert stored_events() == [("com.a", "hit", 10, 1), ("com.a", "hit", 10, 1), ("com.a", "hit", 30, 3)]
+
+
+def test_events_dropped_once_folded_counts_are_full(monkeypatch):
+    monkeypatch.setattr(api_server, "EVENT_QUEUE_MAX", 0)
+    monkeypatch.setattr(api_server, "EVENT_OVERFLOW_MAX", 1)
+    dropped = api_server.stats["events_dropped"]
+    api_server.record_event("download", "com.a", "hit")
+    api_server.record_event("download", "com.a", "hit")
+    api_server.record_event("download", "com.b", "hit")
+
+    assert [folded[1] for folded in api_server.event_overflow.values()] == [2]
+    assert api_server.stats["events_dropped"] == dropped + 1
+
+
+def test_failed_flush_requeues_ahead_of_newer_events(monkeypatch):
+    def unavailable(batch):
+        raise RuntimeError("database is locked")
+
+    api_server.record_event("download", "com.a", "hit")
+    api_server.record_event("download", "com.b", "hit")
+    monkeypatch.setattr(api_server, "write_events_sqlite", unavailable)
+    with pytest.raises(RuntimeError):
+        asyncio.run(api_server.flush_events())
+    api_server.record_event("download", "com.c", "hit")
+
+    assert queued_packages() == ["com.a", "com.b", "com.c"]
+    assert stored_events() == []
+
+    monkeypatch.undo()
+    asyncio.run(api_server.flush_events())
+
+    assert [row[0] for row in stored_events()] == ["com.a", "com.b", "com.c"]
+
+
+def test_requeue_folds_what_no_longer_fits(monkeypatch):
+    monkeypatch.setattr(api_server, "EVENT_QUEUE_MAX", 2)
+    api_server.record_event("download", "com.a", "hit", file_type="apk", size=10)
+    api_server.record_event("download", "com.a", "hit", file_type="apk", size=10)
+    batch = api_server.take_event_batch()
+    # The queue fills up again while the failed batch was being written.
+    api_server.record_event("download", "com.b", "miss")
+    api_server.record_event("download", "com.b", "miss")
+    api_server.requeue_events(batch)
+
+    assert queued_packages() == ["com.b", "com.b"]
+    assert [folded[1:] for folded in api_server.event_overflow.values()] == [[2, 20]]
+
+    asyncio.run(api_server.flush_events())
+
+    totals = {}
+    for package_name, _, _, count in stored_events():
+        totals[package_name] = totals.get(package_name, 0) + count
+    assert totals == {"com.a": 2, "com.b": 2}
+
+
+def test_prune_events_drops_rows_past_retention(monkeypatch):
+    db = api_server.get_shared_db()
+    now = time.time()
+    for package_name, created_at in (("com.old", now - 31 * 86400), ("com.new", now - 86400)):
+        db.execute("INSERT INTO api_events (created_at, event_type, package_name, outcome) VALUES (?, ?, ?, ?)",
+                   (created_at, "download", package_name, "hit"))
+
+    monkeypatch.setattr(api_server, "EVENT_RETENTION_DAYS", 0)
+    api_server.prune_events()
+    assert len(stored_events()) == 2
+
+    monkeypatch.setattr(api_server, "EVENT_RETENTION_DAYS", 30)
+    api_server.prune_events()
+    assert [row[0] for row in stored_events()] == ["com.new"]